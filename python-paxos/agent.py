@@ -1,102 +1,990 @@
 import logging
 import collections
+import itertools
 import json
+import os
+import time
+import uuid
 
 import tornado.httpclient
 import tornado.ioloop
+import tornado.iostream
 import tornado.httpserver
+import tornado.httputil
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 import tornado.gen
+import tornado.locks
 from tornado.options import define, options
 
-from settings import TORNADO_SETTINGS
+from settings import (
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+    BATCH_LINGER,
+    BATCH_SIZE,
+    CATCHUP_DELAY,
+    CATCHUP_TIMEOUT,
+    DEDUP_SIZE,
+    FAST_ORDER_TIMEOUT,
+    FAST_QUORUM,
+    HOLE_TIMEOUT,
+    LEASE_DURATION,
+    PEER_PORT_OFFSET,
+    PHASE1_QUORUM,
+    PHASE2_QUORUM,
+    PIPELINE_WINDOW,
+    QUORUM_SPARE,
+    READ_CHUNK,
+    READ_TIMEOUT,
+    SNAPSHOT_EVERY,
+    TORNADO_SETTINGS,
+    WATCH_BUFFER,
+    WATCH_HEARTBEAT,
+    WRITE_DEADLINE
+)
+from backoff import Backoff
+from batching import Batcher, unbatch
+from catchup import CatchUp, catchup_lines
+from dedup import Dedup
+from codec import CODECS, codec_for
+from fast import FAST_PREDICATE, Unordered, commutes, ordered, unorder
+from groups import Groups, group_port
+from metrics import COUNTER, GAUGE, metrics
+from slot_log import NOOP_PREDICATE, Holes, SlotLog, SlotTaken, Window
+from snapshot import Snapshotter
+from state_machine import KeyValueStore
+from transport import PeerServer
+from watch import Feed, line_for
+from storage import (
+    ACCEPTED,
+    AcceptorStore,
+    ELECTED,
+    FAST_ACCEPTED,
+    LEARNED,
+    PROMISED,
+    PROPOSED,
+    WITHDRAWN
+)
 from models import (
     Accept, 
     agents,
+    ballot_node,
+    Elect,
+    Elected,
+    FastAccept,
+    Leader,
+    LeaderPromise,
     Learn,
+    node_id_for,
+    NotLeader,
     Prepare, 
     Promise, 
     Promises,
     Propose, 
-    Success
+    Success,
+    Withdraw
 )
 
 define("port", default=8888, help="run on the given port", type=int)
+define("node_id", default=None, type=int,
+       help="low part of every ballot this agent issues; must be unique. "
+            "Defaults to the port's position in AGENT_PORTS")
+define("multi_paxos", default=False, type=bool,
+       help="skip Phase 1 while this agent holds the leader ballot")
+define("batch_size", default=BATCH_SIZE, type=int,
+       help="commit up to this many writes to a key as one instance")
+define("batch_linger", default=BATCH_LINGER, type=int,
+       help="milliseconds to hold a write while its batch fills up")
+define("pipeline_window", default=PIPELINE_WINDOW, type=int,
+       help="how many instances this agent may have in flight at once")
+define("write_deadline", default=WRITE_DEADLINE, type=float,
+       help="seconds a write may spend retrying before it fails")
+define("data_dir", default=None, type=str,
+       help="keep acceptor state on disk in this directory")
+define("snapshot_every", default=SNAPSHOT_EVERY, type=int,
+       help="snapshot and truncate the log every this many applied slots")
+define("phase1_quorum", default=PHASE1_QUORUM, type=int,
+       help="agents that must promise in Prepare and Elect (default: a majority)")
+define("phase2_quorum", default=PHASE2_QUORUM, type=int,
+       help="agents that must accept in Propose and Accept (default: a majority)")
+define("fast_path", default=False, type=bool,
+       help="commit writes that commute in one round trip, without a leader")
+define("fast_quorum", default=FAST_QUORUM, type=int,
+       help="agents that must accept a fast write (default: the fewest that "
+            "intersect both phases' quorums)")
+define("lease_duration", default=LEASE_DURATION, type=float,
+       help="seconds a leader may serve reads locally after a quorum admits it")
+define("paxos_groups", default=1, type=int,
+       help="split the keys over this many Paxos groups, one process each, "
+            "sharing the port")
+define("codec", default='json', type=str,
+       help="wire format for agent-to-agent messages: {}".format(', '.join(CODECS)))
+define("peer_transport", default=False, type=bool,
+       help="talk to other agents over persistent streams on port + {}".format(PEER_PORT_OFFSET))
 
 logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
 logger = logging.getLogger('agent')
 current_promises = Promises()
 completed_rounds = Promises()
-ordered_rounds = []
+log = SlotLog()
+window = Window(PIPELINE_WINDOW)
+leader = Leader()
+leader_promise = LeaderPromise()
+election = tornado.locks.Lock()
+backoff = Backoff(BACKOFF_BASE, BACKOFF_MAX, WRITE_DEADLINE)
+store = None
+groups = Groups()
+unordered = Unordered()
+fast_paths = collections.Counter()
+# Writes without a client_id are proposed under ours.
+proposer_id = uuid.uuid4().hex
+proposals = itertools.count()
+accepted_at = {}
+slot_ballots = {}
+kv = KeyValueStore(log)
+feed = Feed(log, WATCH_BUFFER, kv)
+snapshotter = Snapshotter(log, SNAPSHOT_EVERY)
+snapshotter.register('learned', completed_rounds)
+snapshotter.register('leader', leader_promise)
+snapshotter.register('kv', kv)
+
+
+def apply_record(kind, prepare):
+    """
+    Applies one acceptor state change to memory. The handlers and recovery
+    both go through here so a replayed store rebuilds exactly what was there.
+
+    :return: The slot, for `LEARNED`.
+    """
+    Prepare.observe(prepare.id)
+    if kind in (PROMISED, PROPOSED) and prepare.slot is not None and prepare.slot not in log:
+        hold_slot(prepare)
+    if kind == PROMISED:
+        current_promises.add(Promise(prepare=prepare))
+        leader_promise.promise(prepare) # Pre-empts any older leader.
+    elif kind == PROPOSED:
+        if Promise(prepare=prepare) in current_promises:
+            current_promises.remove(prepare)
+        unordered.accepted(prepare)
+        if prepare.slot is not None and prepare.slot not in log:
+            accepted_at[prepare.slot] = prepare
+    elif kind == WITHDRAWN:
+        current_promises.remove(prepare)
+    elif kind == ELECTED:
+        leader_promise.elect(prepare)
+    elif kind == ACCEPTED:
+        leader_promise.accept(prepare)
+        unordered.accepted(prepare)
+    elif kind == FAST_ACCEPTED:
+        unordered.add(prepare)
+        tornado.ioloop.IOLoop.current().call_later(
+            FAST_ORDER_TIMEOUT, order_orphan, prepare)
+    elif kind == LEARNED:
+        learn = Learn(prepare=prepare)
+        completed_rounds.add(learn)
+        slot = log.learn(learn)
+        if prepare.slot is None:
+            prepare = Prepare(**dict(prepare.to_json(), slot=slot))
+        if Promise(prepare=prepare) in current_promises:
+            current_promises.remove(prepare) # Chosen, so there's nothing left to promise.
+        abandoned = current_promises.at_slot(slot)
+        if abandoned is not None:
+            current_promises.remove(abandoned.prepare)
+        accepted_at.pop(slot, None)
+        slot_ballots.pop(slot, None)
+        unordered.learned(prepare)
+        leader_promise.learned(slot)
+        dedup.settled(slot)
+        window.learned(slot)
+        holes.learned()
+        return slot
+
+
+def promised_for(slot):
+    """
+    :return: The highest ballot our acceptor has promised `slot` to, whether
+        by a Prepare for the slot or by an Elect for a range that covers it.
+    """
+    ballots = [b for b in (slot_ballots.get(slot), leader_promise.promised(slot)) if b is not None]
+    return max(ballots) if ballots else None
+
+
+def accepted_for(slot):
+    """
+    :return: The value our acceptor accepted for `slot` with the highest
+        ballot, from a Propose or from a leader's Accept.
+    """
+    values = [p for p in (accepted_at.get(slot), leader_promise.accepted.get(slot)) if p is not None]
+    return max(values, key=lambda p: p.id) if values else None
+
+
+def elected_here(ballot):
+    """
+    What our acceptor answers an Elect for `ballot` with: every value it has
+    accepted from `ballot.slot` on, on either path.
+    """
+    elected = leader_promise.elected(ballot)
+    values = {prepare.slot: prepare for prepare in elected.accepted}
+    for slot, prepare in accepted_at.items():
+        if slot >= ballot.slot and (slot not in values or values[slot].id < prepare.id):
+            values[slot] = prepare
+    next_slot = max([elected.prepare.slot] + [slot + 1 for slot in values])
+    return Elected(prepare=Prepare(id=ballot.id, slot=next_slot),
+                   accepted=[values[slot] for slot in sorted(values)])
+
+
+def hold_slot(prepare):
+    """
+    From here on the acceptor refuses lower ballots for `prepare.slot`.
+    """
+    slot_ballots[prepare.slot] = max(slot_ballots.get(prepare.slot, prepare.id), prepare.id)
+
+
+@tornado.gen.coroutine
+def record(kind, prepare):
+    """
+    Applies a state change and, when there is a store, waits until it is on
+    disk. Acceptors must not answer before this resolves.
+    """
+    result = apply_record(kind, prepare)
+    if store is not None:
+        store.append(kind, prepare)
+        yield store.sync()
+    raise tornado.gen.Return(result)
+
+
+def live_records():
+    """
+    Everything the store needs to rebuild the acceptor once the log prefix a
+    snapshot covers has been dropped.
+    """
+    for promise in current_promises:
+        yield PROMISED, promise.prepare
+    for slot in sorted(accepted_at):
+        yield PROPOSED, accepted_at[slot]
+    for prepare in unordered:
+        yield FAST_ACCEPTED, prepare
+    if leader_promise.election is not None:
+        yield ELECTED, leader_promise.election
+    for slot in sorted(leader_promise.accepted):
+        yield ACCEPTED, leader_promise.accepted[slot]
+    for slot in sorted(log.entries):
+        prepare = log.entries[slot].prepare
+        yield LEARNED, Prepare(**dict(prepare.to_json(), slot=slot))
+
+
+@tornado.gen.coroutine
+def compact_store(snapshot):
+    if store is not None and not (yield store.rewrite(live_records())):
+        logger.info("Store busy flushing. Will compact it after the next snapshot.")
+
+
+snapshotter.listeners.append(compact_store)
+
+
+def install_snapshot(snapshot):
+    snapshotter.adopt(snapshot)
+    for slots in (accepted_at, slot_ballots):
+        for slot in [slot for slot in slots if slot <= snapshot.index]:
+            del slots[slot]
+    window.learned(snapshot.index)
+    leader_promise.learned(snapshot.index)
+
+
+@tornado.gen.coroutine
+def learn_all(prepares):
+    yield [record(LEARNED, prepare) for prepare in prepares]
+
+
+def catchup_peers():
+    others = agents.others(excluding=options.port)
+    return agents.quorum(excluding=options.port, size=len(others))
+
+
+catchup = CatchUp(log, catchup_peers, learn_all, install_snapshot,
+                  CATCHUP_DELAY, CATCHUP_TIMEOUT)
+
+
+@tornado.gen.coroutine
+def fill_hole(slot):
+    """
+    Runs Phase 1 for an empty slot with a no-op. If a value was accepted
+    there it is repaired instead, and a chosen one is learned.
+    """
+    if slot in window.in_flight:
+        return # Ours, and still being proposed.
+    request = {'key': None, 'predicate': NOOP_PREDICATE, 'argument': None}
+    try:
+        yield basic_paxos(request, slot, backoff.start())
+    except SlotTaken:
+        pass
+    except Exception as e:
+        logger.warning("Failed to fill slot %s: %s", slot, e)
+
+
+holes = Holes(log, fill_hole, HOLE_TIMEOUT, PIPELINE_WINDOW)
+
+
+def recover(acceptor_store):
+    global store
+    started = time.time()
+    records = 0
+    for kind, prepare in acceptor_store.replay():
+        apply_record(kind, prepare)
+        records += 1
+    store = acceptor_store
+    if leader_promise.prepare is not None:
+        # We may have leased the leadership just before going down.
+        leader_promise.grant(leader_promise.prepare)
+    logger.info("Recovered %s records from %s in %.3fs", records,
+                acceptor_store.filename, time.time() - started)
 
 
 class Handler(tornado.web.RequestHandler):
+
+    def on_finish(self):
+        handler = (('handler', type(self).__name__),)
+        metrics.observe('paxos_request_seconds', self.request.request_time(), handler)
+        metrics.count('paxos_requests_total', handler + (('code', self.get_status()),))
     
     def respond(self, message, code=200):
+        """
+        Answers in whatever format the request was sent in.
+        """
+        codec = codec_for(self.request.headers.get('Content-Type'))
         self.set_status(code)
-        self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps(message.to_json()))
+        self.set_header('Content-Type', codec.content_type)
+        self.write(codec.encode(message))
         self.finish()
 
-
-class Proposer(Handler):
-
     @tornado.gen.coroutine
-    def post(self):
+    def forward(self, group):
+        """
+        Hands the request to the process running `group` and relays its
+        answer.
+        """
+        response = yield groups.fetch(group, self.request)
+        self.set_status(response.code)
+        for header in ('Content-Type', 'X-Log-Start', 'X-Commit-Index'):
+            if header in response.headers:
+                self.set_header(header, response.headers[header])
+        self.write(response.body or b'')
+        self.finish()
+
+    def requested_group(self):
         """
+        The `group` argument, for state every group keeps its own copy of.
+        It's required on a sharded agent and defaults to ours otherwise.
+        """
+        group = self.get_argument('group', None)
+        if group is None and groups.count > 1:
+            raise tornado.web.HTTPError(status_code=400,
+                log_message='Each of the {} groups keeps its own. Pick one.'.format(groups.count))
+        group = groups.index if group is None else int(group)
+        if not 0 <= group < groups.count:
+            raise tornado.web.HTTPError(status_code=400,
+                log_message='There is no group {}'.format(group))
+        return group
+
+
+@tornado.gen.coroutine
+def commit(request):
+    """
+    Runs consensus on a single client write.
+
+    :param request: A dict of the form
         {
             key: <str>,
             predicate: <str>,
             argument: <str|int>
         }
-        """
-        request = json.loads(self.request.body)
-        prepare = Prepare(**request)
-        prepares = collections.deque([prepare])
-        current_promises.add(Promise(prepare=prepare))
-        quorum = agents.quorum(excluding=options.port)
-        while prepares: # TODO: Timeout here.
-            prepare = prepares.popleft()
+    :return: The `Success` to send back to the client.
+    """
+    if goes_fast(request):
+        success = yield fast_commit(request)
+        raise tornado.gen.Return(success)
+    request = identified(request) # Whichever path it takes, it's the same write.
+    if options.multi_paxos:
+        success = yield lead(request)
+        if success is not None:
+            raise tornado.gen.Return(success)
+        logger.warning("Falling back to Prepare/Promise for %s", request)
+    success = yield propose(request)
+    raise tornado.gen.Return(success)
+
+
+@tornado.gen.coroutine
+def propose(request, after=None):
+    """
+    Basic Paxos: Prepare/Promise, then Propose/Accept, then Learn, for the
+    next free slot in the pipeline window. If another proposer got to that
+    slot first we move on to the next one.
+
+    :param after: The write has to go to a slot later than this one.
+    """
+    request = identified(request)
+    deadline = backoff.start()
+    while True:
+        success = chosen_before(request)
+        if success is not None:
+            raise tornado.gen.Return(success)
+        slot = yield window.acquire(after)
+        success, taken, moved = None, False, False
+        try:
+            success = yield basic_paxos(request, slot, deadline)
+        except SlotTaken as e:
+            if e.follow is None:
+                logger.info("Slot %s belongs to another proposer. Trying the next one.", slot)
+                taken = True
+            else:
+                logger.info("Write has to follow slot %s. Moving it from slot %s.", e.follow, slot)
+                after, moved = max(after or -1, e.follow), True
+        finally:
+            window.release(slot, chosen=success is not None or taken or slot in log)
+        if not (taken or moved):
+            raise tornado.gen.Return(success)
+        if backoff.expired(deadline):
+            raise tornado.web.HTTPError(status_code=503,
+                log_message='Ran out of time looking for a free slot')
+
+
+def identified(request):
+    """
+    Every instance is told apart from its copies by who proposed it. A write
+    without a `client_id` gets ours and the next of our sequence numbers.
+    """
+    if request.get('client_id') is None:
+        request = dict(request, client_id=proposer_id, sequence=next(proposals))
+    return request
+
+
+def observe(conflicting):
+    """
+    Rejections carry the ballot that beat ours. Our next one must be higher.
+    """
+    for response in conflicting:
+        promise = Promise.from_response(response)
+        if promise.prepare is not None:
+            Prepare.observe(promise.prepare.id)
+
+
+def outbid(conflicting, ballot):
+    """
+    :return: Whether any of the rejections carries a ballot higher than
+        `ballot`.
+    """
+    return any(promise.prepare is not None and promise.prepare.id > ballot
+               for promise in map(Promise.from_response, conflicting))
+
+
+def quorum_for(size):
+    """
+    :param size: How many agents a phase needs, out of all of them. Our own
+        acceptor is one of them, so the peers only have to make up the rest.
+    :return: A tuple of (the peers to send it to, how many of them must accept).
+    """
+    required = min(size - 1, len(agents.others(excluding=options.port)))
+    return agents.quorum(excluding=options.port, size=required + QUORUM_SPARE), required
+
+
+@tornado.gen.coroutine
+def basic_paxos(request, slot, deadline, proposed=False):
+    """
+    Prepare/Promise, then Propose/Accept, for `request` on `slot` alone.
+
+    :param proposed: Whether the write went out for `slot` already, as a
+        pre-empted leader's Accept. It may be chosen there, so a claim by
+        another proposer doesn't move it on.
+    :raise SlotTaken: If the slot went to another write.
+    """
+    prepare = claim = Prepare(slot=slot, **request)
+    if leader_promise.leased(claim):
+        # Promising it here would pre-empt the leader on our own acceptor.
+        raise NotLeader(leader_promise.lease_node)
+    yield record(PROMISED, claim)
+    promisers, promises_required = quorum_for(agents.phase1)
+    acceptors, accepts_required = quorum_for(agents.phase2)
+    sent = [] # Every Prepare the peers may have promised.
+    accepted = [] # Proposals a quorum accepted, which replaced their promises.
+    attempt = 0
+    try:
+        while True:
+            hold_slot(prepare) # Our own acceptor promises it too.
+            sent.append(prepare)
             logging.info("Sending prepare for %s", prepare)
-            responses, issued, conflicting = yield prepare.send(quorum)
+            responses, issued, conflicting = yield prepare.send(promisers, promises_required)
             logger.info("Got %s issued and %s conflicting", len(issued), len(conflicting))
             logger.info("Response codes: %s", ", ".join([str(r.code) for r in responses]))
+            refused = [Promise.from_response(r).prepare for r in responses if r.code == 409]
+            # A claim by another proposer names no value. Anything else is a
+            # value chosen for the slot, or a slot the write has to follow.
+            claims = [p for p in refused if p is not None and p.slot == slot and p.predicate is None]
+            taken = [p for p in refused if p not in claims]
+            for p in taken:
+                if p is not None and p.slot == slot:
+                    yield record(LEARNED, p) # In case its Learn never reached us.
+                if p is not None and same_write(p, request):
+                    logger.info("An earlier attempt of ours was chosen for slot %s", slot)
+                    raise tornado.gen.Return(Success(Prepare(**dict(p.to_json(), slot=slot))))
+            if taken:
+                later = [p.slot for p in taken
+                         if p is not None and p.slot is not None and p.slot > slot]
+                raise SlotTaken(slot, follow=max(later) if later else None)
+            leased = [Promise.from_response(r).prepare for r in responses if r.code == 423]
+            if leased:
+                raise NotLeader(leased[0] and ballot_node(leased[0].id))
             if conflicting: # Issue another promise.
-                logger.warning("%s was pre-empted by a higher ballot. retrying.".format(prepare.id))
-                prepares.append(
-                    Prepare(key=prepare.key,
-                            predicate=prepare.predicate,
-                            argument=prepare.argument))
+                logger.warning("%s was pre-empted by a higher ballot. retrying.", prepare.id)
+                observe(conflicting)
+                attempt += 1
+                yield back_off(attempt, deadline)
+                prepare = Prepare(slot=slot, **request)
                 continue
-            elif len(issued) != len(quorum):
+            elif len(issued) < promises_required:
+                if claims and proposed:
+                    # Whoever claimed it may repair our write into the slot,
+                    # so the write can't move on until we know.
+                    logger.info("Slot %s is claimed, but may still choose our write. retrying.", slot)
+                    attempt += 1
+                    yield back_off(attempt, deadline)
+                    prepare = Prepare(slot=slot, **request)
+                    continue
+                elif claims:
+                    logger.info("Another proposer claimed slot %s first", slot)
+                    raise SlotTaken(slot)
                 raise tornado.web.HTTPError(status_code=500,
                     log_message='FAILED to acquire quorum on Promise')
-            promises = Promises.from_responses(responses)
-            earlier_promise = promises.highest_numbered()
-            if earlier_promise and earlier_promise not in current_promises: # Repair.
-                prepares.append(prepare)
-                prepare = earlier_promise.prepare
-
-            # Now we have a promise.
-            responses, issued, conflicting = yield Propose(prepare=prepare).send(quorum)
-            if len(issued) == len(quorum):
-                logger.info("Got success for propose %s. Learning...", prepare)
-                successes = yield Learn(prepare).fanout(expected=Success)
+            # Repair: a value accepted for the slot may already be chosen, so
+            # the one with the highest ballot goes in before ours can.
+            promises = Promises.from_responses(issued)
+            if accepted_for(slot) is not None: # Our own acceptor is part of the quorum too.
+                promises.add(Promise(prepare=accepted_for(slot)))
+            earlier = promises.highest_numbered()
+            value = prepare
+            if earlier is not None and not same_write(earlier.prepare, request):
+                logger.info("Repairing %s at slot %s", earlier.prepare, slot)
+                value = Prepare(**dict(earlier.prepare.to_json(), id=prepare.id, slot=slot))
+
+            promised = promised_for(slot)
+            if promised is not None and promised > prepare.id:
+                # Our own acceptor has promised the slot to a higher ballot since.
+                logger.warning("%s was pre-empted by %s. retrying.", prepare.id, promised)
+                Prepare.observe(promised)
+                attempt += 1
+                yield back_off(attempt, deadline)
+                prepare = Prepare(slot=slot, **request)
+                continue
+
+            # Now we have a promise. Our own acceptor takes the value too, so
+            # it reports it to anyone else who prepares the slot.
+            yield record(PROPOSED, value)
+            proposed = proposed or value is prepare
+            responses, issued, conflicting = yield Propose(prepare=value).send(acceptors, accepts_required)
+            if len(issued) >= accepts_required:
+                logger.info("Got success for propose %s. Learning...", value)
+                accepted.append(value)
+                yield chosen(value)
+                if value is not prepare:
+                    # The slot went to the write we repaired. Ours needs another.
+                    raise SlotTaken(slot)
+                raise tornado.gen.Return(Success(value))
+            taken = [Promise.from_response(r).prepare for r in responses if r.code == 409]
+            if taken:
+                chosen_value = taken[0]
+                if chosen_value is not None and same_write(chosen_value, request):
+                    raise tornado.gen.Return(Success(Prepare(**dict(chosen_value.to_json(), slot=slot))))
+                # Whatever we were proposing lost the slot to another write.
+                raise SlotTaken(slot)
             elif conflicting:
-                logger.error("Conflicting promise detected. Will re-issue.")
-                raise Exception("Conflicting promise detected.")
+                logger.warning("Propose %s was pre-empted by a higher ballot. retrying.", value.id)
+                observe(conflicting)
+                attempt += 1
+                yield back_off(attempt, deadline)
+                prepare = Prepare(slot=slot, **request)
             else:
                 raise tornado.web.HTTPError(status_code=500,
                     log_message='Failed to acquire quorum on Accept')
+    except (SlotTaken, tornado.gen.Return):
+        raise
+    except Exception as e:
+        if proposed:
+            e.unsettled = slot # Retrying it elsewhere could apply it twice.
+        raise
+    finally:
+        # However it ended, nobody should go on holding the slot for us.
+        yield withdraw(claim, [p for p in sent if not any(
+            p.id == q.id and p.key == q.key for q in accepted)], promisers)
 
-        if len(successes) == len(agents.all()):
-            current_promises.remove(prepare)
-            self.respond(Success(prepare))
+
+@tornado.gen.coroutine
+def withdraw(claim, prepares, peers):
+    """
+    Drops the promises a proposal leaves behind: `claim` on our own acceptor
+    and `prepares` on `peers`. Values that were accepted stay, since one of
+    them may have been chosen.
+    """
+    if Promise(prepare=claim) in current_promises:
+        yield record(WITHDRAWN, claim)
+    for prepare in prepares:
+        Withdraw(prepare=prepare).notify(peers)
+
+
+@tornado.gen.coroutine
+def back_off(attempt, deadline):
+    """
+    Waits before the next ballot after being pre-empted, or gives up if the
+    write has run out of time.
+    """
+    retrying = yield backoff.wait(attempt, deadline)
+    if not retrying:
+        raise tornado.web.HTTPError(status_code=503,
+            log_message='Gave up after being pre-empted {} times'.format(attempt))
+
+
+def same_write(prepare, request):
+    """
+    Whether `prepare` is the write `request` describes: the same client_id
+    and sequence, or the same fields for a write that has none.
+    """
+    if request.get('client_id') is not None:
+        return (prepare.client_id, prepare.sequence) == (request['client_id'], request.get('sequence'))
+    return all(getattr(prepare, field) == request.get(field) for field in WRITE_FIELDS)
+
+
+def chosen_before(request):
+    """
+    Looks `request` up by its `(client_id, sequence)` among the writes we
+    have learned, so a retry of a write that is already in the log gets its
+    slot back instead of a second one.
+
+    :return: The `Success` of the earlier slot, or `None` if there is none.
+    """
+    write = (request.get('client_id'), request.get('sequence'))
+    if write[0] is None:
+        return None
+    slot = kv.written.get(write)
+    if slot is not None:
+        learn = log.entries.get(slot)
+        for prepare in (unbatch(learn.prepare) if learn is not None else []):
+            if same_write(prepare, request):
+                return Success(Prepare(**dict(prepare.to_json(), slot=slot)))
+        return Success(Prepare(slot=slot, **request)) # Truncated since.
+    for slot in sorted(slot for slot in log.entries if slot > log.apply_index):
+        prepare = log.entries[slot].prepare
+        if prepare.predicate == FAST_PREDICATE:
+            continue # Fast writes are told apart by their ballot instead.
+        for write in unbatch(prepare):
+            if same_write(write, request):
+                return Success(Prepare(**dict(write.to_json(), slot=slot)))
+    return None
+
+
+@tornado.gen.coroutine
+def chosen(prepare):
+    """
+    A quorum has accepted `prepare`, so it is chosen. We learn it before the
+    client hears back and tell everyone else in the background. An agent
+    that misses the Learn picks the value up from the leader's next Accept.
+    """
+    yield record(LEARNED, prepare)
+    Learn(prepare).notify(agents.others(excluding=options.port))
+
+
+def goes_fast(request):
+    return options.fast_path and not options.multi_paxos and commutes(request.get('predicate'))
+
+
+def fast_conflict(prepare):
+    """
+    :return: A promise in progress for a write to the same key as `prepare`
+        that doesn't commute with it, if there is one.
+    """
+    for promise in list(current_promises.promises.get(prepare.key, {}).values()):
+        if not commutes(promise.prepare.predicate):
+            return promise
+
+
+@tornado.gen.coroutine
+def fast_commit(request):
+    """
+    The fast path: a write that commutes is chosen as soon as a fast quorum
+    has accepted it, without a slot and without a leader. It is ordered into
+    the log in the background. If an acceptor holds a write to the key that
+    doesn't commute, the write is ordered before we answer instead.
+    """
+    prepare = Prepare(**request)
+    if fast_conflict(prepare) is not None or leader_promise.leased(prepare):
+        fast_paths['conflicts'] += 1
+        success = yield propose(request)
+        raise tornado.gen.Return(success)
+    yield record(FAST_ACCEPTED, prepare)
+    quorum, required = quorum_for(agents.fast)
+    responses, issued, conflicting = yield FastAccept(prepare=prepare).send(quorum, required)
+    after = max([unordered.last_slow.get(prepare.key, -1)] +
+                [FastAccept.from_response(r).prepare.slot or -1 for r in issued])
+    if len(issued) >= required:
+        fast_paths['commits'] += 1
+        tornado.ioloop.IOLoop.current().spawn_callback(order, [prepare], after)
+        raise tornado.gen.Return(Success(prepare))
+    logger.info("Fast path for %s got %s of %s accepts. Ordering it now.",
+                prepare, len(issued), required)
+    fast_paths['conflicts'] += 1
+    success = yield order([prepare], after)
+    raise tornado.gen.Return(Success(unorder(success.prepare)[0]))
+
+
+@tornado.gen.coroutine
+def order(prepares, after=None):
+    """
+    Puts fast writes to one key into the log, in a slot after `after`.
+    """
+    success = yield propose(ordered(prepares[0].key, prepares), after)
+    raise tornado.gen.Return(success)
+
+
+@tornado.gen.coroutine
+def order_orphan(prepare):
+    """
+    Orders a fast write accepted here whose proposer hasn't, and tries again
+    later if that fails.
+    """
+    if prepare not in unordered:
+        return
+    logger.warning("Fast write %s is still unordered. Ordering it here.", prepare)
+    fast_paths['orphans'] += 1
+    try:
+        yield order([prepare], unordered.last_slow.get(prepare.key))
+    except Exception as e:
+        logger.warning("Failed to order %s: %s", prepare, e)
+        tornado.ioloop.IOLoop.current().call_later(
+            FAST_ORDER_TIMEOUT, order_orphan, prepare)
+
+
+@tornado.gen.coroutine
+def lead(request):
+    """
+    Multi-Paxos steady state. Once this agent holds a ballot for a range of
+    slots each write is a single Accept round followed by Learn.
+
+    :return: The `Success` to send back, or `None` if the ballot was
+        pre-empted and the caller should fall back to Prepare/Promise.
+    """
+    phase1, phase2 = quorum_for(agents.phase1), quorum_for(agents.phase2)
+    if not leader.elected:
+        with (yield election.acquire()):
+            if not leader.elected:
+                repairs = yield elect(phase1, phase2)
+                if repairs is None:
+                    raise tornado.gen.Return(None)
+                success = yield repaired(request, repairs)
+                if success is not None or not all(accepted for _, accepted in repairs):
+                    raise tornado.gen.Return(success)
+    while leader.elected:
+        success = chosen_before(request)
+        if success is not None:
+            raise tornado.gen.Return(success)
+        slot = yield window.acquire()
+        try:
+            prepare = Prepare(id=leader.ballot, slot=slot, **request)
+            if (yield accept(prepare, *phase2)):
+                success = Success(prepare)
+            elif not leader.elected and slot not in log:
+                # Pre-empted after our Accepts went out. A new leader may
+                # still choose the write here, so it can't go anywhere else
+                # before Phase 1 has settled this slot.
+                success = yield settle(request, slot)
+        except Exception as e:
+            if not isinstance(e, tornado.gen.Return):
+                e.unsettled = slot # Our Accepts may have been enough.
+            raise
+        finally:
+            # Once our acceptor has taken a value for the slot, our ballot
+            # must not propose another one there. A hole fill completes it.
+            window.release(slot, chosen=success is not None or slot in log
+                           or slot in leader_promise.accepted)
+        if success is not None:
+            raise tornado.gen.Return(success)
+        # The slot went to another write. Unless we were pre-empted too, the
+        # next one will do.
+    raise tornado.gen.Return(None)
+
+
+@tornado.gen.coroutine
+def repaired(request, repairs):
+    """
+    An earlier attempt at `request` may be among the values a new leader
+    repairs, in which case that is its slot.
+
+    :param repairs: `(prepare, accepted)` pairs, as `elect` returns them.
+    :return: The `Success`, or `None` if the write wasn't repaired anywhere
+        or another write took the slot.
+    """
+    for repair, accepted in repairs:
+        if same_write(repair, request):
+            if accepted:
+                raise tornado.gen.Return(Success(repair))
+            success = yield settle(request, repair.slot)
+            raise tornado.gen.Return(success)
+    raise tornado.gen.Return(None)
+
+
+@tornado.gen.coroutine
+def settle(request, slot):
+    """
+    Runs Basic Paxos for `request` on `slot`, where it may already be chosen.
+
+    :return: The `Success`, or `None` if another write took the slot.
+    """
+    try:
+        success = yield basic_paxos(request, slot, backoff.start(), proposed=True)
+    except SlotTaken:
+        success = None
+    raise tornado.gen.Return(success)
+
+
+@tornado.gen.coroutine
+def elect(phase1, phase2):
+    """
+    Runs Phase 1 once for every slot past the end of our committed log. Any
+    value an acceptor reports in that range is re-proposed under the new
+    ballot, and gaps nobody reports are filled with no-ops so the log can
+    commit past them.
+
+    :param phase1: `(quorum, required)` for Elect.
+    :param phase2: `(quorum, required)` for the repairing Accepts.
+    :return: A `(prepare, accepted)` pair for every repair, or `None` if we
+        weren't elected.
+    """
+    quorum, required = phase1
+    if leader_promise.prepare is not None:
+        Prepare.observe(leader_promise.prepare.id) # Or our own acceptor refuses it.
+    ballot = Prepare(slot=len(log))
+    if not leader_promise.admits(ballot) or leader_promise.leased(ballot):
+        logger.warning("Our own acceptor won't elect ballot %s", ballot.id)
+        raise tornado.gen.Return(None)
+    logger.info("Running for leader with ballot %s at slot %s", ballot.id, ballot.slot)
+    responses, issued, conflicting = yield Elect(prepare=ballot).send(quorum, required)
+    if conflicting or len(issued) < required:
+        logger.warning("Failed to get elected with ballot %s", ballot.id)
+        observe(conflicting)
+        raise tornado.gen.Return(None)
+    yield record(ELECTED, ballot)
+    next_slot, pending = ballot.slot, {}
+    # Our own acceptor is one of the quorum, so what it accepted counts too.
+    for elected in [Elected.from_response(r) for r in issued] + [elected_here(ballot)]:
+        next_slot = max(next_slot, elected.prepare.slot)
+        for prepare in elected.accepted:
+            if prepare.slot not in pending or pending[prepare.slot].id < prepare.id:
+                pending[prepare.slot] = prepare
+    leader.elect(ballot.id) # The lease comes with the first quorum of Accepts.
+    window.advance(next_slot)
+    repairs = []
+    for slot in range(ballot.slot, next_slot):
+        if slot in log or slot in window.in_flight:
+            continue
+        window.taken(slot) # The same ballot must not propose anything else there.
+        previous = pending.get(slot)
+        if previous is None:
+            repairs.append(Prepare(id=ballot.id, slot=slot, predicate=NOOP_PREDICATE))
         else:
-            logger.error("Got %s successes with a required quorum of %s", len(successes), len(agents.all()))
-            raise tornado.web.HTTPError(status_code=500,
-                log_message='Failed to acquire quorum on Learn')
+            repairs.append(Prepare(**dict(previous.to_json(), id=ballot.id, slot=slot)))
+    if repairs:
+        logger.info("Completing %s slots left by an earlier leader", len(repairs))
+    accepted = yield [accept(repair, *phase2) for repair in repairs]
+    raise tornado.gen.Return(list(zip(repairs, accepted)))
+
+
+@tornado.gen.coroutine
+def accept(prepare, quorum, required):
+    if prepare.slot in log:
+        raise tornado.gen.Return(False) # Chosen already. The write needs another slot.
+    if not leader_promise.admits(prepare):
+        # Our own acceptor, one of the quorum, has promised a newer leader.
+        leader.step_down()
+        raise tornado.gen.Return(False)
+    started = time.monotonic()
+    yield record(ACCEPTED, prepare)
+    leader_promise.grant(prepare)
+    message = Accept(prepare=prepare, commit=log.commit_index)
+    responses, issued, conflicting = yield message.send(quorum, required)
+    if len(issued) >= required:
+        leader.renew(started)
+        yield chosen(prepare)
+        raise tornado.gen.Return(True)
+    observe(conflicting)
+    if outbid(conflicting, prepare.id):
+        leader.step_down()
+        raise tornado.gen.Return(False)
+    if any(r.code == 409 for r in responses):
+        logger.warning("Slot %s was chosen before we got to it", prepare.slot)
+        raise tornado.gen.Return(False)
+    # Timeouts and short replies don't mean anyone else leads, so we stay on.
+    raise tornado.web.HTTPError(status_code=500,
+        log_message='Failed to acquire quorum on Accept')
+
+
+batcher = Batcher(commit, BATCH_SIZE, BATCH_LINGER)
+dedup = Dedup(DEDUP_SIZE)
+WRITE_FIELDS = ('key', 'predicate', 'argument')
+IDENTITY_FIELDS = ('client_id', 'sequence')
+
+
+def submit(write):
+    if batcher.max_size > 1 and not goes_fast(write):
+        return batcher.submit(write)
+    return commit(write)
+
+
+class Proposer(Handler):
+
+    @tornado.gen.coroutine
+    def post(self):
+        """
+        {
+            key: <str>,
+            predicate: <str>,
+            argument: <str|int>,
+            client_id: <str>, (optional)
+            sequence: <int> (optional)
+        }
+
+        A write that carries a `client_id` and `sequence` may be retried
+        safely: a repeat of a recent pair, or of one in the log already,
+        gets the first attempt's outcome.
+        """
+        request = json.loads(self.request.body)
+        owner = groups.owner(request.get('key'))
+        if owner != groups.index:
+            yield self.forward(owner)
+            return
+        write = {field: request[field] for field in WRITE_FIELDS + IDENTITY_FIELDS
+                 if request.get(field) is not None}
+        client_id, sequence = request.get('client_id'), request.get('sequence')
+        try:
+            success = chosen_before(write) # A retry of a write that is in the log already.
+            if success is None and client_id is not None and sequence is not None:
+                success = yield dedup.run((client_id, sequence), lambda: submit(write))
+            elif success is None:
+                success = yield submit(write)
+        except NotLeader as e:
+            self.redirect_to_leader(e.node)
+            return
+        self.respond(success)
+
+    def redirect_to_leader(self, node):
+        """
+        Turns a write away with a 503 naming the leader, in the X-Leader
+        header and as `leader` in the body, so the client can send it there.
+        """
+        self.set_status(503)
+        leader = agents.node(node)
+        if leader is not None:
+            url = '{}:{}'.format(leader.url, leader.port)
+            self.set_header('X-Leader', url)
+            self.write({'leader': url})
+        self.finish()
 
 
 class PrepareAcceptor(Handler):
@@ -104,33 +992,78 @@ class PrepareAcceptor(Handler):
     @tornado.gen.coroutine
     def post(self):
         prepare = Prepare.from_request(self.request)
-        in_progress = current_promises.get(prepare.key)
-        last_accepted = completed_rounds.highest_numbered(prepare.key)
-        if in_progress:
-            logger.info("Promise in progress already %s", in_progress)
-            if in_progress.prepare.id == prepare.id:
-                raise Exception("Prepare IDs match.")
-            if in_progress.prepare.id > prepare.id:
-                # Some replica has issued a higher promise 
-                # than ours. Abort.
-                logger.warning("Existing promise is higher.")
-                self.respond(code=400, message=in_progress) 
-            elif last_accepted is None or (in_progress.prepare.id > last_accepted.prepare.id): # >= since we could have just learned but not removed the existing process because this is all async
-                # Complete the in-progress promise first
-                # Possible for the incoming promise to have the same ID as the existing one.
-                logger.info("Must complete earlier promise first: %s", in_progress)
-                self.respond(code=200, message=in_progress)
-            else:
-                logger.info("New promise is higher. Issuing promise.")
-                self.respond(code=200, message=Promise())
-        elif last_accepted is None or prepare.id > last_accepted.prepare.id:
-            logger.info("Adding a new promise for prepare %s", prepare)
-            current_promises.add(Promise(prepare=prepare))
-            self.respond(code=200, message=Promise())
+        if leader_promise.leased(prepare):
+            # The leader answers reads from memory, so every write has to
+            # go through it until its lease runs out.
+            logger.warning("Node %s holds a read lease. Refusing %s", leader_promise.lease_node, prepare)
+            self.respond(code=423, message=Promise(prepare=leader_promise.prepare))
+            return
+        if prepare.slot is not None and (prepare.slot in log or prepare.slot < log.start):
+            logger.warning("Slot %s was already chosen. Refusing %s", prepare.slot, prepare)
+            chosen = log.entries.get(prepare.slot)
+            self.respond(code=409, message=Promise(prepare=chosen and chosen.prepare))
+            return
+        if prepare.key is not None and not commutes(prepare.predicate):
+            waiting = unordered.waiting(prepare.key)
+            if waiting is not None:
+                logger.warning("Fast write %s isn't ordered yet. Refusing %s", waiting, prepare)
+                self.respond(code=400, message=Promise(prepare=waiting))
+                return
+            last_fast = unordered.last_fast.get(prepare.key, -1)
+            if prepare.slot is not None and last_fast > prepare.slot:
+                # Fast writes acknowledged before this one are at last_fast.
+                logger.warning("%s has to follow the fast writes at slot %s", prepare, last_fast)
+                self.respond(code=409, message=Promise(prepare=Prepare(
+                    id=prepare.id, key=prepare.key, slot=last_fast)))
+                return
+        promised = promised_for(prepare.slot)
+        if promised is not None and promised > prepare.id:
+            logger.warning("Slot %s is promised to a higher ballot %s than %s", prepare.slot, promised, prepare)
+            self.respond(code=400, message=Promise(prepare=Prepare(id=promised, slot=prepare.slot)))
+            return
+        accepted = accepted_for(prepare.slot)
+        if accepted is not None:
+            # A value accepted for the slot may already be chosen. The
+            # proposer has to repair it before it can have the slot.
+            logger.info("Slot %s has accepted %s. Repair it first.", prepare.slot, accepted)
+            self.promise(prepare, Promise(prepare=accepted))
+            return
+        if prepare.slot is None:
+            in_progress = current_promises.get(prepare.key) # Only the key orders it.
         else:
+            in_progress = current_promises.at_slot(prepare.slot)
+        last_accepted = completed_rounds.highest_numbered(prepare.key)
+        if in_progress is not None and in_progress.prepare.id > prepare.id:
+            # Some replica has issued a higher promise 
+            # than ours. Abort.
+            logger.warning("Existing promise is higher: %s", in_progress)
+            self.respond(code=400, message=in_progress) 
+        elif (in_progress is not None and prepare.slot is not None
+              and ballot_node(in_progress.prepare.id) != ballot_node(prepare.id)
+              and prepare.predicate != NOOP_PREDICATE):
+            # Another proposer claimed the slot first. A promise is not a
+            # value, so there is nothing to repair: let it finish. If it
+            # never does, the slot is filled with a no-op.
+            logger.info("Slot %s is claimed by %s", prepare.slot, in_progress)
+            self.respond(code=409, message=Promise(prepare=Prepare(
+                id=in_progress.prepare.id, slot=prepare.slot)))
+        elif last_accepted is not None and prepare.id <= last_accepted.prepare.id:
             logger.warning("Prepare has a lower ID than the last accepted proposal")
             logger.warning("prepare: %s, last_accepted: %s", prepare, last_accepted)
             self.respond(code=400, message=last_accepted)
+        else:
+            if in_progress is None or in_progress.prepare.id != prepare.id:
+                logger.info("Adding a new promise for prepare %s", prepare)
+                yield record(PROMISED, prepare)
+            self.promise(prepare, Promise())
+
+    def promise(self, prepare, message):
+        """
+        Answers `prepare` and holds its slot to its ballot from here on.
+        """
+        if prepare.slot is not None:
+            hold_slot(prepare)
+        self.respond(code=200, message=message)
 
 
 class ProposeAcceptor(Handler):
@@ -138,58 +1071,472 @@ class ProposeAcceptor(Handler):
     @tornado.gen.coroutine
     def post(self):
         propose = Propose.from_request(self.request)
+        chosen = log.entries.get(propose.prepare.slot)
+        if chosen is not None and not same_write(propose.prepare, chosen.prepare.to_json()):
+            logger.warning("Slot %s was already chosen. Refusing %s", propose.prepare.slot, propose)
+            self.respond(code=409, message=Promise(prepare=chosen.prepare))
+            return
+        promised = promised_for(propose.prepare.slot)
+        if promised is not None and promised > propose.prepare.id:
+            logger.warning("Slot %s is promised to a higher ballot %s than %s", propose.prepare.slot, promised, propose)
+            self.respond(code=400, message=Promise(prepare=Prepare(id=promised, slot=propose.prepare.slot)))
+            return
         logger.info("Removing old promise, %s, on Accept", propose.prepare)
-        current_promises.remove(propose.prepare)
+        yield record(PROPOSED, propose.prepare)
         self.respond(code=200, 
             message=Accept(prepare=propose.prepare))
 
 
+class WithdrawAcceptor(Handler):
+
+    @tornado.gen.coroutine
+    def post(self):
+        prepare = Withdraw.from_request(self.request).prepare
+        if Promise(prepare=prepare) in current_promises:
+            logger.info("Dropping the abandoned promise %s", prepare)
+            yield record(WITHDRAWN, prepare)
+        self.respond(code=200, message=Promise())
+
+
+class FastAcceptor(Handler):
+
+    @tornado.gen.coroutine
+    def post(self):
+        prepare = FastAccept.from_request(self.request).prepare
+        if leader_promise.leased(prepare):
+            logger.warning("Node %s holds a read lease. Refusing %s", leader_promise.lease_node, prepare)
+            self.respond(code=423, message=Promise(prepare=leader_promise.prepare))
+            return
+        conflict = fast_conflict(prepare)
+        if conflict is not None:
+            logger.warning("%s doesn't commute with %s. Refusing it.", prepare, conflict)
+            self.respond(code=400, message=conflict)
+            return
+        yield record(FAST_ACCEPTED, prepare)
+        self.respond(code=200, message=FastAccept(prepare=Prepare(
+            id=prepare.id, key=prepare.key, slot=unordered.last_slow.get(prepare.key))))
+
+
+class ElectAcceptor(Handler):
+
+    @tornado.gen.coroutine
+    def post(self):
+        elect = Elect.from_request(self.request)
+        promised = leader_promise.prepare
+        if promised is not None and promised.id > elect.prepare.id:
+            logger.warning("Already promised a higher ballot %s than %s", promised, elect)
+            self.respond(code=400, message=Promise(prepare=promised))
+        elif leader_promise.leased(elect.prepare):
+            logger.warning("Node %s holds a read lease. Refusing %s", leader_promise.lease_node, elect)
+            self.respond(code=400, message=Promise(prepare=promised))
+        else:
+            logger.info("Promising slots from %s to ballot %s", elect.prepare.slot, elect.prepare.id)
+            yield record(ELECTED, elect.prepare)
+            self.respond(code=200, message=elected_here(elect.prepare))
+
+
+class LeaderAcceptor(Handler):
+
+    @tornado.gen.coroutine
+    def post(self):
+        accept = Accept.from_request(self.request)
+        promised = slot_ballots.get(accept.prepare.slot)
+        chosen = log.entries.get(accept.prepare.slot)
+        if chosen is not None and not same_write(accept.prepare, chosen.prepare.to_json()):
+            logger.warning("Slot %s was already chosen. Refusing %s", accept.prepare.slot, accept)
+            self.respond(code=409, message=Promise(prepare=chosen.prepare))
+        elif not leader_promise.admits(accept.prepare):
+            logger.warning("%s was pre-empted by %s", accept, leader_promise.prepare)
+            self.respond(code=400, message=Promise(prepare=leader_promise.prepare))
+        elif promised is not None and promised > accept.prepare.id:
+            logger.warning("Slot %s is promised to a higher ballot %s than %s", accept.prepare.slot, promised, accept)
+            self.respond(code=400, message=Promise(prepare=Prepare(id=promised, slot=accept.prepare.slot)))
+        else:
+            yield record(ACCEPTED, accept.prepare)
+            leader_promise.grant(accept.prepare)
+            yield learn_committed(accept.prepare.id, accept.commit)
+            if accept.commit is not None:
+                catchup.behind(accept.commit)
+            self.respond(code=200, message=accept)
+
+
+@tornado.gen.coroutine
+def learn_committed(ballot, commit):
+    """
+    Learns the values we accepted under `ballot` for slots up to the leader's
+    commit index `commit`, unless we have learned them already.
+    """
+    if commit is None:
+        return
+    slots = range(max(log.commit_index + 1, log.start), commit + 1)
+    missed = [leader_promise.accepted[slot] for slot in slots
+              if slot not in log and slot in leader_promise.accepted
+              and leader_promise.accepted[slot].id == ballot]
+    if missed:
+        logger.info("Learned %s slots from a piggybacked commit index", len(missed))
+        yield [record(LEARNED, prepare) for prepare in missed]
+
+
 class Learner(Handler):
 
     @tornado.gen.coroutine
     def post(self):
         learn = Learn.from_request(self.request)
         logger.info("Adding new learn, %s, to completed rounds.", learn.to_json())
-        completed_rounds.add(learn)
-        ordered_rounds.append(learn)
+        slot = yield record(LEARNED, learn.prepare)
+        if slot > log.commit_index + 1:
+            catchup.behind(slot - 1)
         success = Success(prepare=learn.prepare)
         self.respond(code=200, message=success)
 
 
+class Stats(Handler):
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        :param group: Whose numbers to return. Required on a sharded agent,
+            where each group runs in a process of its own.
+        """
+        group = self.requested_group()
+        if group != groups.index:
+            yield self.forward(group)
+            return
+        self.set_status(200)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            'batches': batcher.report(),
+            'log': log.report(),
+            'window': window.report(),
+            'storage': store.report() if store is not None else None,
+            'snapshot': snapshotter.report(),
+            'kv': kv.report(),
+            'retries': backoff.report(),
+            'catchup': catchup.report(),
+            'holes': holes.report(),
+            'watch': feed.report(),
+            'dedup': dedup.report(),
+            'fast': dict(fast_paths, unordered=len(unordered)),
+            'agents': agents.report(),
+            'group': groups.report(),
+            'lease': leader.holds_lease()
+        }))
+        self.finish()
+
+
+def quorum_sizes():
+    return {(('phase', phase),): size for phase, size in
+            (('1', agents.phase1), ('2', agents.phase2), ('fast', agents.fast))}
+
+
+metrics.declare('paxos_in_flight_instances', GAUGE,
+                'Slots this agent is proposing right now.', lambda: len(window.in_flight))
+metrics.declare('paxos_promises_in_progress', GAUGE,
+                'Promises this acceptor has made that are not accepted yet.',
+                lambda: len(current_promises))
+metrics.declare('paxos_unordered_fast_writes', GAUGE,
+                'Fast writes accepted here that are not in the log yet.', lambda: len(unordered))
+metrics.declare('paxos_commit_index', GAUGE,
+                'Last slot of the contiguous learned prefix.', lambda: log.commit_index)
+metrics.declare('paxos_apply_index', GAUGE,
+                'Last slot applied to the key-value store.', lambda: log.apply_index)
+metrics.declare('paxos_quorum_size', GAUGE,
+                'Agents that must answer in each phase.', quorum_sizes)
+metrics.declare('paxos_retries_total', COUNTER,
+                'Times a write backed off and tried again with a higher ballot.',
+                lambda: backoff.retries)
+metrics.declare('paxos_gave_up_total', COUNTER,
+                'Writes that ran out of time while being pre-empted.', lambda: backoff.gave_up)
+metrics.declare('paxos_fast_path_total', COUNTER,
+                'Fast path writes, by what happened to them.',
+                lambda: {(('result', result),): count for result, count in fast_paths.items()})
+
+
+class Metrics(Handler):
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        :param group: As for `/stats`.
+        """
+        group = self.requested_group()
+        if group != groups.index:
+            yield self.forward(group)
+            return
+        self.set_status(200)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render())
+        self.finish()
+
+
 class Reader(Handler):
 
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Streams committed entries as newline delimited JSON.
+
+        :param since: The first slot to return. Slots truncated by a snapshot
+            are skipped; `X-Log-Start` says where the log now begins.
+        :param limit: The most slots to return.
+        :param group: Whose log to read. Required on a sharded agent, where
+            each group has a log of its own.
+
+        A write that was chosen more than once is returned at the first slot
+        only, as it was applied.
+        """
+        group = self.requested_group()
+        if group != groups.index:
+            yield self.forward(group)
+            return
+        since = int(self.get_argument('since', 0))
+        limit = self.get_argument('limit', None)
+        limit = int(limit) if limit is not None else None
+        self.set_status(200)
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('X-Log-Start', str(log.start))
+        self.set_header('X-Commit-Index', str(log.commit_index))
+        written = 0
+        for slot, learn in enumerate(log.committed(since, limit), max(since, log.start)):
+            learn = kv.without_copies(learn, slot)
+            if learn is None or learn.prepare.predicate == NOOP_PREDICATE:
+                continue
+            self.write(json.dumps(learn.to_json()) + "\n")
+            written += 1
+            if written % READ_CHUNK == 0:
+                yield self.flush()
+        self.finish()
+
+
+@tornado.gen.coroutine
+def barrier(key=None):
+    """
+    Commits a no-op and returns its slot. Once that slot is applied every
+    write acknowledged before the barrier started is visible locally.
+
+    :param key: The key about to be read. Acceptors order a no-op for a key
+        like any write that doesn't commute: after every fast write to it
+        they have acknowledged.
+    """
+    success = yield commit({'key': key, 'predicate': NOOP_PREDICATE, 'argument': None})
+    raise tornado.gen.Return(success.prepare.slot)
+
+
+class KeyReader(Handler):
+
+    @tornado.gen.coroutine
+    def get(self, key):
+        """
+        Linearizable read of one key. A leader holding a lease answers from
+        memory once it has applied every slot it has learned; anyone else
+        first commits a barrier.
+        """
+        owner = groups.owner(key)
+        if owner != groups.index:
+            yield self.forward(owner)
+            return
+        if leader.holds_lease():
+            read_index = log.next_slot - 1
+        else:
+            read_index = yield barrier(key)
+        caught_up = yield kv.wait_for(read_index, READ_TIMEOUT)
+        if not caught_up:
+            raise tornado.web.HTTPError(status_code=503,
+                log_message='Timed out applying the log up to slot {}'.format(read_index))
+        value, version = kv.get(key)
+        self.set_status(200 if version is not None else 404)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'key': key, 'value': value, 'version': version}))
+        self.finish()
+
+
+def backlog(slot):
+    """
+    Up to `READ_CHUNK` applied entries from `slot` on, read from the log for
+    watchers that have fallen out of the feed's buffer.
+    """
+    entries = []
+    for slot in range(slot, min(log.apply_index + 1, slot + READ_CHUNK)):
+        learn = log.entries.get(slot)
+        if learn is None:
+            break
+        entries.append((slot, line_for(kv.without_copies(learn, slot))))
+    return entries
+
+
+class Watcher(Handler):
+
+    def initialize(self):
+        self.gone = False
+
+    def on_connection_close(self):
+        self.gone = True
+
+    @tornado.gen.coroutine
     def get(self):
-        for promise in ordered_rounds:
-            self.write(json.dumps(promise.to_json()) + "\n")
+        """
+        Streams learned entries as newline delimited JSON as they are
+        applied, in the same format as `/read` and likewise without copies
+        of writes chosen more than once. An empty line is sent every
+        `WATCH_HEARTBEAT` seconds while there is nothing new.
+
+        :param since: The first slot to send.
+        :param timeout: Seconds to hold the connection open. By default it
+            stays open until the client goes away.
+        :param group: Whose log to watch, as for `/read`.
+        """
+        group = self.requested_group()
+        if group != groups.index:
+            yield self.relay(group)
+            return
+        next_slot = int(self.get_argument('since', 0))
+        timeout = self.get_argument('timeout', None)
+        io_loop = tornado.ioloop.IOLoop.current()
+        stop = io_loop.time() + float(timeout) if timeout is not None else None
         self.set_status(200)
         self.set_header('Content-Type', 'application/json')
+        self.set_header('X-Log-Start', str(log.start))
+        feed.watchers += 1
+        try:
+            while not self.gone:
+                next_slot = max(next_slot, log.start)
+                entries = feed.since(next_slot)
+                if entries is None:
+                    entries = backlog(next_slot)
+                if entries:
+                    for slot, line in entries:
+                        if line is not None:
+                            self.write(line)
+                    next_slot = entries[-1][0] + 1
+                    yield self.flush()
+                    continue
+                if stop is not None and io_loop.time() >= stop:
+                    break
+                wake = io_loop.time() + WATCH_HEARTBEAT
+                woken = yield feed.changed.wait(timeout=min(wake, stop or wake))
+                if not woken and io_loop.time() >= wake:
+                    self.write("\n")
+                    yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            return
+        finally:
+            feed.watchers -= 1
         self.finish()
 
+    @tornado.gen.coroutine
+    def relay(self, group):
+        """
+        Like `forward`, but passes the stream on as it arrives. Once our
+        client has gone away the next chunk or heartbeat ends it.
+        """
+        headers = tornado.httputil.HTTPHeaders()
+
+        def header_line(line):
+            if line.startswith('HTTP/'):
+                self.set_status(tornado.httputil.parse_response_start_line(line.strip()).code)
+            elif line.strip():
+                headers.parse_line(line)
+            else:
+                for header in ('Content-Type', 'X-Log-Start'):
+                    if header in headers:
+                        self.set_header(header, headers[header])
+
+        def chunk(data):
+            if self.gone:
+                raise tornado.iostream.StreamClosedError()
+            self.write(data)
+            self.flush()
+
+        response = yield groups.fetch(group, self.request,
+                                      header_callback=header_line, streaming_callback=chunk)
+        if not self.gone:
+            if response.code == 599: # The group never answered.
+                self.set_status(502)
+            self.finish()
+
 
+class CatchUpServer(Handler):
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Streams what a lagging agent is missing as newline delimited JSON:
+        a snapshot first if `since` has been truncated, then every committed
+        slot after it.
+        """
+        since = int(self.get_argument('since', 0))
+        self.set_status(200)
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('X-Log-Start', str(log.start))
+        self.set_header('X-Commit-Index', str(log.commit_index))
+        for written, line in enumerate(catchup_lines(log, snapshotter, since), 1):
+            self.write(line + "\n")
+            if written % READ_CHUNK == 0:
+                yield self.flush()
+        self.finish()
 
 
 def get_app():
     return tornado.web.Application([
+        (r"/catchup", CatchUpServer),
+        (r"/watch", Watcher),
+        (r"/kv/(.+)", KeyReader),
         (r"/read", Reader),
+        (r"/stats", Stats),
+        (r"/metrics", Metrics),
         (r"/write", Proposer),
         (r"/prepare", PrepareAcceptor),
         (r"/propose", ProposeAcceptor),
+        (r"/withdraw", WithdrawAcceptor),
+        (r"/fast", FastAcceptor),
+        (r"/elect", ElectAcceptor),
+        (r"/accept", LeaderAcceptor),
         (r"/learn", Learner)
     ], **TORNADO_SETTINGS)
 
     
 def main():
     """
-    This guy has to run synchronously in order to prevent proposal ids from conflicting.
-
-    We're using only a single proposer to avoid the dueling proposers issue.
+    Every agent is a proposer. Ballots carry the agent's node id so no two
+    agents ever issue the same one.
 
     :return:
     """
     tornado.options.parse_command_line()
+    Prepare.node_id = options.node_id if options.node_id is not None else node_id_for(options.port)
+    public = None
+    if options.paxos_groups > 1:
+        # Each group is a process of its own from here on, and takes the
+        # group's private port as its identity among its peers. Every one
+        # binds the public port itself so the kernel balances between them.
+        group = tornado.process.fork_processes(options.paxos_groups)
+        public = tornado.netutil.bind_sockets(options.port, reuse_port=True)
+        groups.configure(options.paxos_groups, group, options.port)
+        agents.shift_ports(group_port(0, group))
+        options.port = group_port(options.port, group)
+    agents.set_quorums(options.phase1_quorum, options.phase2_quorum, options.fast_quorum)
+    batcher.max_size = options.batch_size
+    batcher.linger = options.batch_linger
+    window.resize(options.pipeline_window)
+    backoff.deadline = options.write_deadline
+    snapshotter.every = options.snapshot_every
+    leader.lease_duration = leader_promise.lease_duration = options.lease_duration
+    if options.data_dir:
+        snapshotter.filename = os.path.join(
+            options.data_dir, 'snapshot-{}.json'.format(options.port))
+        snapshotter.load()
+        recover(AcceptorStore(os.path.join(
+            options.data_dir, 'acceptor-{}.log'.format(options.port))))
     application = get_app()
     http_server = tornado.httpserver.HTTPServer(application)
     http_server.listen(options.port)
+    if public is not None:
+        http_server.add_sockets(public)
+    agents.use_codec(CODECS[options.codec])
+    if options.peer_transport:
+        PeerServer(application).listen(options.port + PEER_PORT_OFFSET)
+        agents.use_streams(PEER_PORT_OFFSET)
+    catchup.behind(log.commit_index + 1)
     logger.info("Proposer listening on port %s", options.port)
     tornado.ioloop.IOLoop.current().start()
 
@@ -0,0 +1,64 @@
+import logging
+import random
+
+import tornado.gen
+import tornado.ioloop
+
+logger = logging.getLogger('agent')
+
+
+class Backoff:
+    """
+    Randomized exponential backoff for proposals that were pre-empted. The
+    n-th retry sleeps for a random time up to `base * 2 ** n` seconds, capped
+    at `cap`, so dueling proposers drift apart instead of pre-empting each
+    other forever. Every write gets `deadline` seconds in total.
+    """
+
+    def __init__(self, base, cap, deadline):
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.clear()
+
+    def clear(self):
+        self.writes = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.gave_up = 0
+
+    def start(self):
+        """
+        :return: The deadline for a write starting now.
+        """
+        return tornado.ioloop.IOLoop.current().time() + self.deadline
+
+    def expired(self, deadline):
+        return tornado.ioloop.IOLoop.current().time() >= deadline
+
+    @tornado.gen.coroutine
+    def wait(self, attempt, deadline):
+        """
+        Sleeps before retry number `attempt` (counting from 1).
+
+        :return: False, without sleeping, if the retry would start after
+            `deadline`.
+        """
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if tornado.ioloop.IOLoop.current().time() + delay >= deadline:
+            self.gave_up += 1
+            raise tornado.gen.Return(False)
+        if attempt == 1:
+            self.writes += 1
+        self.retries += 1
+        self.seconds += delay
+        yield tornado.gen.sleep(delay)
+        raise tornado.gen.Return(True)
+
+    def report(self):
+        return {
+            'writes_retried': self.writes,
+            'retries': self.retries,
+            'seconds_backing_off': self.seconds,
+            'gave_up': self.gave_up
+        }
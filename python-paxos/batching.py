@@ -0,0 +1,100 @@
+import collections
+import logging
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from models import Prepare, Success
+
+logger = logging.getLogger('agent')
+
+BATCH_PREDICATE = 'batch'
+
+
+def batched(key, requests):
+    """
+    Folds several client writes to the same key into a single write whose
+    argument is the list of the original writes.
+    """
+    if len(requests) == 1:
+        return requests[0]
+    return {
+        'key': key,
+        'predicate': BATCH_PREDICATE,
+        'argument': [{k: v for k, v in request.items() if k != 'key'}
+                     for request in requests]
+    }
+
+
+def unbatch(prepare):
+    """
+    The inverse of `batched`. Every write in the batch comes back as its own
+    `Prepare` carrying the ballot and slot the batch was chosen with.
+    """
+    if prepare.predicate != BATCH_PREDICATE:
+        return [prepare]
+    return [Prepare(id=prepare.id, key=prepare.key, slot=prepare.slot, **entry)
+            for entry in prepare.argument]
+
+
+class Batcher:
+    """
+    Group commit. Writes to the same key are held for up to `linger`
+    milliseconds or until `max_size` of them are waiting, and are then
+    committed together as one Paxos instance.
+    """
+
+    def __init__(self, commit, max_size=1, linger=0):
+        self.commit = commit
+        self.max_size = max_size
+        self.linger = linger
+        self.pending = {}
+        self.timers = {}
+        self.sizes = collections.Counter()
+
+    def submit(self, request):
+        """
+        :return: A future resolving to the `Success` for this write alone.
+        """
+        future = tornado.concurrent.Future()
+        key = request.get('key')
+        batch = self.pending.setdefault(key, [])
+        batch.append((request, future))
+        if len(batch) >= self.max_size:
+            self.flush(key)
+        elif len(batch) == 1:
+            self.timers[key] = tornado.ioloop.IOLoop.current().call_later(
+                self.linger / 1000.0, self.flush, key)
+        return future
+
+    def flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(timer)
+        batch = self.pending.pop(key, None)
+        if batch:
+            self.sizes[len(batch)] += 1
+            logger.debug("Committing a batch of %s writes to %s", len(batch), key)
+            tornado.ioloop.IOLoop.current().spawn_callback(self.run, key, batch)
+
+    @tornado.gen.coroutine
+    def run(self, key, batch):
+        try:
+            success = yield self.commit(batched(key, [r for r, _ in batch]))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), prepare in zip(batch, unbatch(success.prepare)):
+            future.set_result(Success(prepare=prepare))
+
+    def report(self):
+        batches = sum(self.sizes.values())
+        writes = sum(size * count for size, count in self.sizes.items())
+        return {
+            'batches': batches,
+            'writes': writes,
+            'mean': float(writes) / batches if batches else 0.0,
+            'sizes': {str(size): count for size, count in sorted(self.sizes.items())}
+        }
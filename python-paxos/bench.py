@@ -0,0 +1,50 @@
+"""
+Microbenchmarks for the acceptor's hot paths.
+
+    python bench.py [keys ...]
+
+For each key count, fills a `Promises` with one promise per key and times
+the lookups `PrepareAcceptor` makes on every Prepare. The per-call cost
+should stay flat as the number of keys grows.
+"""
+import sys
+import timeit
+
+from models import Prepare, Promise, Promises
+
+CALLS = 10000
+
+
+def promises_for(keys):
+    promises = Promises()
+    for i in range(keys):
+        promises.add(Promise(prepare=Prepare(
+            id=i, key='key-{}'.format(i), predicate='set', argument=i)))
+    return promises
+
+
+def bench_promises(keys):
+    promises = promises_for(keys)
+    key = 'key-{}'.format(keys // 2)
+    ids = iter(range(keys, keys + CALLS))
+
+    def add_and_remove():
+        prepare = Prepare(id=next(ids), key=key, predicate='set', argument=0)
+        promises.add(Promise(prepare=prepare))
+        promises.highest_numbered()
+        promises.remove(prepare)
+
+    cases = [
+        ('get', lambda: promises.get(key)),
+        ('highest_numbered', lambda: promises.highest_numbered()),
+        ('add+remove', add_and_remove),
+    ]
+    for name, call in cases:
+        seconds = timeit.timeit(call, number=CALLS)
+        print("{:>8} keys  {:<18} {:8.2f} us/call".format(
+            keys, name, seconds / CALLS * 1e6))
+
+
+if __name__ == '__main__':
+    for keys in [int(arg) for arg in sys.argv[1:]] or [1000, 100000]:
+        bench_promises(keys)
@@ -0,0 +1,136 @@
+import json
+import logging
+
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.queues
+
+from models import Prepare
+from snapshot import Snapshot
+
+logger = logging.getLogger('agent')
+
+
+def catchup_lines(log, snapshotter, since):
+    """
+    What `GET /catchup?since=<slot>` streams, one JSON document per line: a
+    snapshot of the applied state if `since` has already been truncated away,
+    then every committed slot from there on, no-ops included.
+    """
+    if since < log.start:
+        snapshot = snapshotter.capture()
+        yield json.dumps({'snapshot': snapshot.to_json()})
+        since = snapshot.index + 1
+    for slot in range(since, log.commit_index + 1):
+        learn = log.entries.get(slot)
+        if learn is None: # Truncated by a snapshot while we were streaming.
+            return
+        yield json.dumps({'slot': slot, 'prepare': learn.prepare.to_json()})
+
+
+class CatchUp:
+    """
+    Pulls the committed slots this agent has missed from a peer in one
+    streamed transfer, instead of waiting for every lost `Learn` to be
+    repaired one instance at a time.
+
+    Call `behind(slot)` whenever there is evidence that the cluster has
+    committed up to `slot`. After `delay` seconds, so that Learns already in
+    flight can land, whatever is still missing is fetched from `peers()` in
+    turn until one of them has it. `learn(prepares)` is a coroutine that
+    records learned values and `install(snapshot)` adopts a snapshot.
+    """
+
+    def __init__(self, log, peers, learn, install, delay, timeout):
+        self.log = log
+        self.peers = peers
+        self.learn = learn
+        self.install = install
+        self.delay = delay
+        self.timeout = timeout
+        self.clear()
+
+    def clear(self):
+        self.target = -1
+        self.running = False
+        self.transfers = 0
+        self.slots = 0
+        self.snapshots = 0
+        self.failures = 0
+
+    def behind(self, slot):
+        self.target = max(self.target, slot)
+        if self.target > self.log.commit_index and not self.running:
+            self.running = True
+            tornado.ioloop.IOLoop.current().call_later(self.delay, self.run)
+
+    @tornado.gen.coroutine
+    def run(self):
+        try:
+            for peer in self.peers():
+                if self.log.commit_index >= self.target:
+                    break
+                try:
+                    yield self.transfer(peer)
+                except Exception as e:
+                    self.failures += 1
+                    logger.warning("Catching up from %s failed: %s", peer, e)
+        finally:
+            self.running = False
+        if self.log.commit_index < self.target:
+            logger.info("Still behind at slot %s of %s", self.log.commit_index, self.target)
+
+    @tornado.gen.coroutine
+    def transfer(self, peer):
+        since = self.log.commit_index + 1
+        logger.info("Catching up from slot %s via %s", since, peer)
+        batches = tornado.queues.Queue()
+        buffered = [b'']
+
+        def on_chunk(chunk):
+            lines = (buffered[0] + chunk).split(b'\n')
+            buffered[0] = lines.pop()
+            if lines:
+                batches.put_nowait([json.loads(line) for line in lines if line])
+
+        applying = self.apply(batches)
+        try:
+            response = yield tornado.httpclient.AsyncHTTPClient().fetch(
+                '{}:{}/catchup?since={}'.format(peer.url, peer.port, since),
+                streaming_callback=on_chunk, request_timeout=self.timeout)
+        finally:
+            batches.put_nowait(None)
+        yield applying
+        self.transfers += 1
+        logger.info("Caught up to slot %s; %s had %s", self.log.commit_index, peer,
+                    response.headers.get('X-Commit-Index'))
+
+    @tornado.gen.coroutine
+    def apply(self, batches):
+        while True:
+            batch = yield batches.get()
+            if batch is None:
+                return
+            prepares = []
+            for line in batch:
+                if 'snapshot' in line:
+                    snapshot = Snapshot.from_json(line['snapshot'])
+                    if snapshot.index > self.log.commit_index:
+                        self.install(snapshot)
+                        self.snapshots += 1
+                else:
+                    prepares.append(Prepare(**dict(line['prepare'], slot=line['slot'])))
+            if prepares:
+                yield self.learn(prepares)
+                self.slots += len(prepares)
+
+    def report(self):
+        return {
+            'target': self.target,
+            'running': self.running,
+            'transfers': self.transfers,
+            'slots': self.slots,
+            'snapshots': self.snapshots,
+            'failures': self.failures
+        }
@@ -1,41 +1,94 @@
-import random
-import tornado.httpclient
-import tornado.ioloop
+import itertools
 import json
+import random
 import sys
-import collections
+import uuid
+import zlib
 
-import requests
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
 
 from settings import AGENT_URL, AGENT_PORTS
-    
-failures = collections.defaultdict(int)
 
-# Distinguished proposer/learner
-url = AGENT_URL + ':8888/write'
 
-client = tornado.httpclient.AsyncHTTPClient()
+class Router:
+    """
+    Spreads writes over every agent. Each key goes to the same agent so
+    concurrent writes to it don't duel for ballots. If that agent refuses
+    the connection the write moves on to the next one.
 
-def get_results(resp):
-    if 200 <= resp.code < 300:
-        sys.stdout.write(resp.body + "\n")
-        # sys.stdout.write('.')
-    else:
-        sys.stdout.write('x')
+    Every write carries this router's `client_id` and a sequence number, so
+    an agent recognizes a retry and answers it without running consensus
+    again. That makes it safe to retry a write that timed out, but only on
+    the agent that may have seen it, so it is retried there. An agent that
+    answers 503 with an `X-Leader` header isn't leading, and the write goes
+    to the one it names instead. Should both have proposed it, the state
+    machine applies only the first copy.
+    """
+
+    def __init__(self, url=AGENT_URL, ports=AGENT_PORTS, client_id=None, retries=1, redirects=3):
+        self.urls = ['{}:{}'.format(url, port) for port in ports]
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.client_id = client_id or uuid.uuid4().hex
+        self.sequence = itertools.count()
+        self.retries = retries
+        self.redirects = redirects
+
+    def route(self, key):
+        """
+        :return: The agents to try for `key`, in order.
+        """
+        start = zlib.crc32(str(key).encode('utf-8')) % len(self.urls)
+        return self.urls[start:] + self.urls[:start]
+
+    @tornado.gen.coroutine
+    def write(self, key, predicate, argument):
+        body = json.dumps({'key': key, 'predicate': predicate, 'argument': argument,
+                           'client_id': self.client_id, 'sequence': next(self.sequence)})
+        urls = self.route(key)
+        url, attempt, redirects = urls.pop(0), 0, 0
+        while True:
+            try:
+                response = yield self.client.fetch(
+                    url + '/write', method='POST', body=body,
+                    headers={'Content-Type': 'application/json'},
+                    raise_error=False)
+            except ConnectionRefusedError as e:
+                # It never got the write, so another agent can take it.
+                sys.stderr.write("{} is unreachable: {}\n".format(url, e))
+                if not urls:
+                    raise tornado.gen.Return(None)
+                url, attempt = urls.pop(0), 0
+                continue
+            except (OSError, tornado.httpclient.HTTPClientError) as e:
+                if getattr(e, 'code', 599) != 599:
+                    raise
+                attempt += 1
+                if attempt > self.retries:
+                    raise tornado.gen.Return(None)
+                sys.stderr.write("{} failed: {}. Retrying.\n".format(url, e))
+                continue
+            leader = response.headers.get('X-Leader')
+            if response.code == 503 and leader and leader != url and redirects < self.redirects:
+                sys.stderr.write("{} isn't leading. Sending the write to {}.\n".format(url, leader))
+                url, attempt, redirects = leader, 0, redirects + 1
+                continue
+            raise tornado.gen.Return(response)
+
+
+@tornado.gen.coroutine
+def main():
+    router = Router()
+    writes = [router.write("key-{}".format(i), "set", random.random())
+              for i in range(10)]
+    for response in (yield writes):
+        if response is not None and 200 <= response.code < 300:
+            sys.stdout.write(response.body.decode('utf-8') + "\n")
+        else:
+            sys.stdout.write('x')
     sys.stdout.flush()
 
-for i in range(10):
-    print("url", url)
-    request = tornado.httpclient.HTTPRequest(
-        url=url,
-        method='POST',
-        headers={'Content-Type': 'application/json'},
-        body=json.dumps({
-            "key": "foo", 
-            "predicate": "This is update #{}".format(i),
-            "argument": random.random()
-        }), 
-    )
-    client.fetch(request, callback=get_results)
-
-tornado.ioloop.IOLoop.current().start()
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,153 @@
+"""
+Wire formats for the phase messages. JSON stays the default and the debug
+format; the binary codec packs the same fields with `struct` and tags each
+value with a single byte, msgpack style.
+
+A codec is picked by content type. Messages implement `to_json`/`from_json`
+for the JSON codec and `pack`/`unpack` for the binary one.
+"""
+import json
+import struct
+
+NONE, TRUE, FALSE, INT, FLOAT, STR, LIST, DICT, BIGINT = range(9)
+
+TAG = struct.Struct('>B')
+INT64 = struct.Struct('>q')
+DOUBLE = struct.Struct('>d')
+LENGTH = struct.Struct('>I')
+INT_BOUNDS = (-2 ** 63, 2 ** 63 - 1)
+
+
+class Writer:
+
+    __slots__ = ('parts',)
+
+    def __init__(self):
+        self.parts = []
+
+    def value(self, value):
+        parts = self.parts
+        if value is None:
+            parts.append(TAG.pack(NONE))
+        elif value is True:
+            parts.append(TAG.pack(TRUE))
+        elif value is False:
+            parts.append(TAG.pack(FALSE))
+        elif isinstance(value, int):
+            if INT_BOUNDS[0] <= value <= INT_BOUNDS[1]:
+                parts.append(TAG.pack(INT) + INT64.pack(value))
+            else:
+                self.string(BIGINT, str(value))
+        elif isinstance(value, float):
+            parts.append(TAG.pack(FLOAT) + DOUBLE.pack(value))
+        elif isinstance(value, str):
+            self.string(STR, value)
+        elif isinstance(value, (list, tuple)):
+            parts.append(TAG.pack(LIST) + LENGTH.pack(len(value)))
+            for item in value:
+                self.value(item)
+        elif isinstance(value, dict):
+            parts.append(TAG.pack(DICT) + LENGTH.pack(len(value)))
+            for key, item in value.items():
+                self.string(STR, str(key))
+                self.value(item)
+        else:
+            raise TypeError("Can't encode {!r}".format(value))
+
+    def string(self, tag, value):
+        encoded = value.encode('utf-8')
+        self.parts.append(TAG.pack(tag) + LENGTH.pack(len(encoded)) + encoded)
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class Reader:
+
+    __slots__ = ('buf', 'offset')
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.offset = 0
+
+    def value(self):
+        tag = self.buf[self.offset]
+        self.offset += 1
+        if tag == NONE:
+            return None
+        elif tag == TRUE:
+            return True
+        elif tag == FALSE:
+            return False
+        elif tag == INT:
+            value = INT64.unpack_from(self.buf, self.offset)[0]
+            self.offset += INT64.size
+            return value
+        elif tag == FLOAT:
+            value = DOUBLE.unpack_from(self.buf, self.offset)[0]
+            self.offset += DOUBLE.size
+            return value
+        elif tag == STR:
+            return self.string()
+        elif tag == BIGINT:
+            return int(self.string())
+        elif tag == LIST:
+            return [self.value() for _ in range(self.length())]
+        elif tag == DICT:
+            items = {}
+            for _ in range(self.length()):
+                key = self.value()
+                items[key] = self.value()
+            return items
+        raise ValueError("Unknown tag {} at offset {}".format(tag, self.offset - 1))
+
+    def length(self):
+        length = LENGTH.unpack_from(self.buf, self.offset)[0]
+        self.offset += LENGTH.size
+        return length
+
+    def string(self):
+        length = self.length()
+        start = self.offset
+        self.offset += length
+        return bytes(self.buf[start:self.offset]).decode('utf-8')
+
+
+class JsonCodec:
+
+    content_type = 'application/json'
+
+    def encode(self, message):
+        return json.dumps(message.to_json())
+
+    def decode(self, cls, body):
+        return cls.from_json(json.loads(body))
+
+
+class BinaryCodec:
+
+    content_type = 'application/x-paxos'
+
+    def encode(self, message):
+        writer = Writer()
+        message.pack(writer)
+        return writer.getvalue()
+
+    def decode(self, cls, body):
+        return cls.unpack(Reader(body))
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {'json': JSON, 'binary': BINARY}
+BY_CONTENT_TYPE = {codec.content_type: codec for codec in CODECS.values()}
+
+
+def codec_for(content_type):
+    """
+    :return: The codec for a Content-Type header, falling back to JSON.
+    """
+    if isinstance(content_type, str):
+        content_type = content_type.split(';')[0].strip()
+        return BY_CONTENT_TYPE.get(content_type, JSON)
+    return JSON
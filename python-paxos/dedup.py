@@ -0,0 +1,80 @@
+import collections
+import logging
+
+import tornado.concurrent
+import tornado.gen
+
+logger = logging.getLogger('agent')
+
+
+class Dedup:
+    """
+    Remembers the outcome of the last `size` client writes by their
+    `(client_id, sequence)` pair, least recently used first out. A retry of
+    a write that is still running waits for the first attempt; a retry of
+    one that succeeded gets its `Success` back without another round.
+
+    A write that failed is forgotten so it can be retried, unless its value
+    went out for a slot and may still be chosen there: the error then
+    carries that slot as `unsettled`, and the failure stands until
+    `settled(slot)` says the slot has been learned.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.results = collections.OrderedDict()
+        self.unsettled = collections.defaultdict(list) # slot -> [(request_id, result)]
+        self.hits = 0
+        self.misses = 0
+
+    @tornado.gen.coroutine
+    def run(self, request_id, write):
+        """
+        :param write: Called with no arguments to run the write the first
+            time `request_id` is seen; returns a future.
+        """
+        result = self.results.get(request_id)
+        if result is not None:
+            self.hits += 1
+            self.results.move_to_end(request_id)
+            logger.info("Write %s was retried. Returning the first outcome.", request_id)
+            success = yield result
+            raise tornado.gen.Return(success)
+        self.misses += 1
+        result = tornado.concurrent.Future()
+        self.results[request_id] = result
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+        try:
+            success = yield write()
+        except Exception as e:
+            slot = getattr(e, 'unsettled', None)
+            if slot is not None:
+                self.unsettled[slot].append((request_id, result))
+            elif self.results.get(request_id) is result:
+                del self.results[request_id]
+            result.set_exception(e)
+            result.exception() # Whoever was waiting has it; don't log it again.
+            raise
+        result.set_result(success)
+        raise tornado.gen.Return(success)
+
+    def settled(self, slot):
+        """
+        Forgets the writes that failed while `slot` was undecided. Whatever
+        was chosen there has been learned, so a retry finds out if it was
+        one of them.
+        """
+        for request_id, result in self.unsettled.pop(slot, []):
+            if self.results.get(request_id) is result:
+                del self.results[request_id]
+
+    def report(self):
+        return {
+            'size': len(self.results),
+            'hits': self.hits,
+            'misses': self.misses
+        }
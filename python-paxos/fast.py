@@ -0,0 +1,109 @@
+"""
+The fast path for writes that commute, after Generalized Paxos. The order
+of two increments doesn't change the result, so such a write doesn't need a
+slot before the client hears back: it commits once a fast quorum of
+acceptors has it, and is put into the log later as part of a `fast` entry
+so every agent applies it at the same point relative to writes that don't
+commute.
+
+Acceptors keep the two kinds apart. They refuse a fast write to a key while
+a write to it that doesn't commute is in progress, and the other way round
+while a fast write to it is waiting to be ordered.
+"""
+import logging
+
+from models import Prepare
+from settings import COMMUTATIVE_PREDICATES
+
+logger = logging.getLogger('agent')
+
+FAST_PREDICATE = 'fast'
+
+
+def commutes(predicate):
+    return predicate in COMMUTATIVE_PREDICATES or predicate == FAST_PREDICATE
+
+
+def ordered(key, prepares):
+    """
+    The write that puts fast-committed `prepares` to `key` into the log.
+    Each keeps its ballot so a write ordered twice is only applied once.
+    """
+    return {
+        'key': key,
+        'predicate': FAST_PREDICATE,
+        'argument': [{'id': prepare.id,
+                      'predicate': prepare.predicate,
+                      'argument': prepare.argument} for prepare in prepares]
+    }
+
+
+def unorder(prepare):
+    """
+    The inverse of `ordered`. Every fast write comes back as its own
+    `Prepare` with its own ballot and the slot it was ordered at.
+    """
+    if prepare.predicate != FAST_PREDICATE:
+        return [prepare]
+    return [Prepare(key=prepare.key, slot=prepare.slot, **entry)
+            for entry in prepare.argument]
+
+
+class Unordered:
+    """
+    Acceptor-side fast path state. `pending` holds the fast writes accepted
+    here that have not been learned in the log yet, by key. For every key we
+    also remember the last slot a write that doesn't commute was accepted or
+    learned at (`last_slow`), and the last slot fast writes were ordered at
+    (`last_fast`).
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.pending = {}
+        self.last_slow = {}
+        self.last_fast = {}
+
+    def add(self, prepare):
+        self.pending.setdefault(prepare.key, {})[prepare.id] = prepare
+
+    def waiting(self, key):
+        """
+        :return: A fast write to `key` that is still waiting to be ordered.
+        """
+        by_id = self.pending.get(key)
+        if by_id:
+            return next(iter(by_id.values()))
+
+    def accepted(self, prepare):
+        """
+        Called for every write accepted for a slot, before it is learned.
+        """
+        if prepare.key is None or prepare.slot is None or commutes(prepare.predicate):
+            return
+        self.last_slow[prepare.key] = max(self.last_slow.get(prepare.key, -1), prepare.slot)
+
+    def learned(self, prepare):
+        self.accepted(prepare)
+        if prepare.predicate != FAST_PREDICATE:
+            return
+        key = prepare.key
+        self.last_fast[key] = max(self.last_fast.get(key, -1), prepare.slot)
+        by_id = self.pending.get(key, {})
+        for write in unorder(prepare):
+            by_id.pop(write.id, None)
+        if not by_id:
+            self.pending.pop(key, None)
+
+    def __contains__(self, prepare):
+        return prepare.id in self.pending.get(prepare.key, {})
+
+    def __iter__(self):
+        for by_id in list(self.pending.values()):
+            for prepare in list(by_id.values()):
+                yield prepare
+
+    def __len__(self):
+        return sum(len(by_id) for by_id in self.pending.values())
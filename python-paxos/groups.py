@@ -0,0 +1,76 @@
+"""
+Sharding an agent across cores. With `--paxos_groups=N` an agent forks N
+processes, each running an independent Paxos group over its share of the
+keys, with its own log, acceptor state and peers. Every process listens on
+the agent's public port with SO_REUSEPORT so the kernel spreads clients over
+them, and on a private port of its own, `port + GROUP_PORT_OFFSET * (group +
+1)`, where its counterparts in the other agents reach it. A request that
+lands on the wrong process is forwarded to the group that owns its key.
+"""
+import logging
+import zlib
+
+import tornado.gen
+import tornado.httpclient
+
+from settings import AGENT_URL, GROUP_PORT_OFFSET
+
+logger = logging.getLogger('agent')
+
+
+def group_port(port, group):
+    return port + GROUP_PORT_OFFSET * (group + 1)
+
+
+class Groups:
+    """
+    Which group this process runs, out of `count`, and where to find the
+    others on this host. A single group owns every key.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, count=1, index=0, port=None):
+        """
+        :param port: The agent's public port.
+        """
+        self.count = count
+        self.index = index
+        self.port = port
+        self.forwarded = 0
+
+    def owner(self, key):
+        if self.count == 1 or key is None:
+            return self.index
+        return zlib.crc32(str(key).encode('utf-8')) % self.count
+
+    def url(self, group):
+        return '{}:{}'.format(AGENT_URL, group_port(self.port, group))
+
+    @tornado.gen.coroutine
+    def fetch(self, group, request, header_callback=None, streaming_callback=None):
+        """
+        Sends a copy of `request` to `group` and returns its response.
+
+        :param streaming_callback: Given the body chunk by chunk as it
+            arrives, for a response that streams. It has no time limit.
+        """
+        self.forwarded += 1
+        response = yield tornado.httpclient.AsyncHTTPClient().fetch(
+            self.url(group) + request.uri,
+            method=request.method,
+            headers={'Content-Type': request.headers.get('Content-Type', 'application/json')},
+            body=request.body if request.method == 'POST' else None,
+            header_callback=header_callback,
+            streaming_callback=streaming_callback,
+            request_timeout=0 if streaming_callback is not None else None,
+            raise_error=False)
+        raise tornado.gen.Return(response)
+
+    def report(self):
+        return {
+            'count': self.count,
+            'index': self.index,
+            'forwarded': self.forwarded
+        }
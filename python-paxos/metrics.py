@@ -0,0 +1,123 @@
+"""
+Counters and latency histograms for `GET /metrics`, in the Prometheus text
+format. Recording is a dict lookup and a bisect into fixed buckets, so it is
+left on. Anything that is already tracked elsewhere (the pipeline window, the
+log, backoff) is read when the endpoint is scraped instead of being copied
+on every change.
+"""
+import bisect
+import collections
+
+from settings import LATENCY_BUCKETS
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class Histogram:
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: `(upper bound, samples at or below it)` for every bucket,
+            ending with `+Inf`.
+        """
+        total = 0
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+class Metrics:
+    """
+    Every metric is declared once with its type and help text. Samples are
+    kept per `(name, labels)`, where `labels` is a tuple of `(name, value)`
+    pairs. A metric declared with `read` is not recorded at all: `read()` is
+    called at scrape time and returns a number, or a dict of labels to
+    numbers.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.declared = collections.OrderedDict()
+        self.clear()
+
+    def clear(self):
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+
+    def declare(self, name, kind, help, read=None):
+        self.declared[name] = (kind, help, read)
+
+    def count(self, name, labels=(), value=1):
+        self.counters[(name, labels)] += value
+
+    def observe(self, name, value, labels=()):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def samples(self, name, kind, read):
+        if read is not None:
+            value = read()
+            return sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        recorded = self.histograms if kind == HISTOGRAM else self.counters
+        return sorted((labels, value) for (n, labels), value in recorded.items() if n == name)
+
+    def render(self):
+        lines = []
+        for name, (kind, help, read) in self.declared.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in self.samples(name, kind, read):
+                if kind != HISTOGRAM:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+                    continue
+                for bound, total in value.cumulative():
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels, [('le', bound)]), total))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), value.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.declare('paxos_phase_seconds', HISTOGRAM,
+                'Time a proposer waited for a phase to reach its quorum.')
+metrics.declare('paxos_phase_total', COUNTER,
+                'Phases sent, by outcome: quorum, preempted, refused or short of replies.')
+metrics.declare('paxos_phase_messages_total', COUNTER,
+                'Messages sent for each phase, one per agent in its quorum.')
+metrics.declare('paxos_peer_seconds', HISTOGRAM,
+                'Round-trip time of one message to one peer.')
+metrics.declare('paxos_peer_errors_total', COUNTER,
+                'Messages to a peer that failed or got a 5xx.')
+metrics.declare('paxos_request_seconds', HISTOGRAM,
+                'Time to answer a request, by handler.')
+metrics.declare('paxos_requests_total', COUNTER,
+                'Requests answered, by handler and status code.')
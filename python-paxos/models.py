@@ -1,61 +1,238 @@
 import threading
 import logging
-import collections
+import heapq
+import itertools
 import random
-import json
+import time
 
 import tornado.httpclient
+import tornado.ioloop
 import tornado.gen
 
-from settings import AGENT_URL, AGENT_PORTS
+from settings import (
+    AGENT_URL,
+    AGENT_PORTS,
+    BALLOT_NODES,
+    DEFAULT_PHASE_TIMEOUT,
+    FAST_QUORUM,
+    LEASE_DRIFT,
+    LEASE_DURATION,
+    PHASE1_QUORUM,
+    PHASE2_QUORUM,
+    PHASE_TIMEOUTS,
+    PROBE_RATE,
+    RTT_ALPHA,
+    UNHEALTHY_ERROR_RATE
+)
+from codec import JSON, codec_for
+from metrics import metrics
+from transport import PeerConnection
 
 logging.basicConfig(format='%(levelname)s - %(filename)s:L%(lineno)d pid=%(process)d - %(message)s')
 prepare_id_mutex = threading.Lock()
 logger = logging.getLogger('agent')
 
+
+def make_ballot(round, node_id):
+    return round * BALLOT_NODES + node_id
+
+
+def ballot_round(ballot):
+    return ballot // BALLOT_NODES
+
+
+def ballot_node(ballot):
+    return ballot % BALLOT_NODES
+
+
+def node_id_for(port):
+    """
+    Agents listed in `AGENT_PORTS` are numbered by their position there.
+    """
+    if port in AGENT_PORTS:
+        return AGENT_PORTS.index(port)
+    return port % BALLOT_NODES
+
+
 class Agent:
+    """
+    A peer, and what we have seen of it: EWMAs of its round-trip time (in
+    seconds, `None` until the first reply) and of how often sending to it
+    fails.
+    """
 
     def __init__(self, url, port):
         self.url = url
         self.port = port
+        self.connection = None
+        self.codec = JSON
+        self.rtt = None
+        self.error_rate = 0.0
+        self.samples = 0
+
+    @property
+    def healthy(self):
+        return self.error_rate < UNHEALTHY_ERROR_RATE
+
+    def observe(self, rtt, ok):
+        self.samples += 1
+        self.error_rate += RTT_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.rtt = rtt if self.rtt is None else self.rtt + RTT_ALPHA * (rtt - self.rtt)
 
     @tornado.gen.coroutine
     def send(self, message):
+        started = time.monotonic()
+        labels = (('endpoint', message.endpoint), ('peer', self.port))
+        try:
+            resp = yield self.deliver(message)
+        except Exception:
+            self.observe(None, ok=False)
+            metrics.count('paxos_peer_errors_total', labels)
+            raise
+        rtt = time.monotonic() - started
+        self.observe(rtt, ok=resp.code < 500)
+        metrics.observe('paxos_peer_seconds', rtt, labels)
+        if resp.code >= 500:
+            metrics.count('paxos_peer_errors_total', labels)
+        raise tornado.gen.Return(resp)
+
+    @tornado.gen.coroutine
+    def deliver(self, message):
+        body = self.codec.encode(message)
+        if self.connection is not None:
+            resp = yield self.connection.fetch(
+                message.endpoint, body, self.codec.content_type, message.timeout())
+            raise tornado.gen.Return(resp)
         http_client = tornado.httpclient.AsyncHTTPClient()
         request = tornado.httpclient.HTTPRequest(
             url=self.url + ':' + str(self.port) + message.endpoint,
             method='POST',
-            headers={'Content-Type': 'application/json'},
-            body=json.dumps(message.to_json())
+            headers={'Content-Type': self.codec.content_type},
+            body=body
         )
         resp = yield http_client.fetch(request, raise_error=False)
         raise tornado.gen.Return(resp)
 
+    def report(self):
+        return {
+            'port': self.port,
+            'rtt_ms': self.rtt * 1000 if self.rtt is not None else None,
+            'error_rate': self.error_rate,
+            'samples': self.samples
+        }
+
     def __repr__(self):
         return "<Agent url={}, port={}>".format(self.url, self.port)
        
 
 class Agents:
 
-    def __init__(self, agents):
+    def __init__(self, agents, phase1=None, phase2=None, fast=None):
         self.agents = agents
-
-    def quorum(self, excluding=None):
-        random.shuffle(self.agents)
-        agents = [a for a in self.agents if a.port != excluding]
-        required_for_quorum = int(len(self.agents) / 2) + 1
-        return agents[0:required_for_quorum]
+        self.set_quorums(phase1, phase2, fast)
+
+    @property
+    def majority(self):
+        return int(len(self.agents) / 2) + 1
+
+    def set_quorums(self, phase1=None, phase2=None, fast=None):
+        """
+        Sets how many agents must accept in Phase 1 and in Phase 2. The two
+        only need to intersect, so a long-lived leader can commit with a
+        small Phase 2 quorum as long as elections use a large Phase 1 one.
+        Either defaults to a majority. A `fast` quorum has to intersect both,
+        and defaults to the smallest size that does.
+        """
+        phase1 = phase1 or self.majority
+        phase2 = phase2 or self.majority
+        count = len(self.agents)
+        if not (0 < phase1 <= count and 0 < phase2 <= count):
+            raise ValueError("Quorums of {} and {} don't fit {} agents".format(
+                phase1, phase2, count))
+        if phase1 + phase2 <= count:
+            raise ValueError("A Phase 1 quorum of {} and a Phase 2 quorum of {} "
+                             "need not intersect among {} agents".format(phase1, phase2, count))
+        fast = fast or count - min(phase1, phase2) + 1
+        if not (fast <= count and fast + min(phase1, phase2) > count):
+            raise ValueError("A fast quorum of {} need not intersect quorums of {} "
+                             "and {} among {} agents".format(fast, phase1, phase2, count))
+        self.phase1 = phase1
+        self.phase2 = phase2
+        self.fast = fast
+
+    def quorum(self, excluding=None, size=None):
+        """
+        The `size` (a majority by default) agents we expect to answer
+        fastest: healthy ones first, then by round-trip time. Agents we have
+        no samples for yet come first so they get measured. Now and then one
+        of the rest is swapped in so its stats don't go stale.
+        """
+        if size is None:
+            size = self.majority
+        ranked = sorted(self.others(excluding),
+                        key=lambda a: (not a.healthy, a.rtt or 0.0))
+        chosen, rest = ranked[:size], ranked[size:]
+        if chosen and rest and random.random() < PROBE_RATE:
+            chosen[-1] = random.choice(rest)
+        return chosen
+
+    def node(self, node_id):
+        """
+        :return: The agent numbered `node_id`, or `None`. Agents are numbered
+            by their position, like `node_id_for` numbers `AGENT_PORTS`.
+        """
+        if node_id is not None and 0 <= node_id < len(self.agents):
+            return self.agents[node_id]
+
+    def use_streams(self, port_offset):
+        """
+        Sends protocol messages over a persistent stream to each agent's peer
+        port instead of over HTTP.
+        """
+        for agent in self.agents:
+            agent.connection = PeerConnection.to(agent.url, agent.port + port_offset)
+
+    def shift_ports(self, offset):
+        """
+        Points every agent at its port plus `offset`, where the same group
+        of a sharded agent listens.
+        """
+        for agent in self.agents:
+            agent.port += offset
+
+    def use_codec(self, codec):
+        for agent in self.agents:
+            agent.codec = codec
+
+    def others(self, excluding=None):
+        return [a for a in self.agents if a.port != excluding]
 
     def all(self):
         return self.agents
 
+    def report(self):
+        return [agent.report() for agent in self.agents]
+
 
 agents = Agents([Agent(AGENT_URL, port) 
-    for port in AGENT_PORTS])
+    for port in AGENT_PORTS], PHASE1_QUORUM, PHASE2_QUORUM, FAST_QUORUM)
+
+
+def decode(cls, message):
+    """
+    Decodes the body of a request or response with the codec its
+    Content-Type asks for.
+    """
+    headers = getattr(message, 'headers', None) or {}
+    return codec_for(headers.get('Content-Type')).decode(cls, message.body)
 
 
 class Phase:
 
+    # `endpoint` is a slot so a bare Phase can still be pointed somewhere.
+    __slots__ = ('prepare', 'endpoint')
+
     def __init__(self, prepare=None):
         self.prepare = prepare 
 
@@ -63,74 +240,239 @@ class Phase:
         return {
             'prepare': self.prepare.to_json() if self.prepare else None
         }
-    
+
     @classmethod
-    def from_request(cls, request):
-        js = json.loads(request.body)
+    def from_json(cls, js):
         prepare = None
         if js.get('prepare'):
-            prepare = Prepare(**js.get('prepare'))
+            prepare = Prepare.from_json(js.get('prepare'))
         return cls(prepare=prepare)
 
+    def pack(self, writer):
+        if self.prepare is None:
+            writer.value(False)
+        else:
+            writer.value(True)
+            self.prepare.pack(writer)
+
+    @classmethod
+    def unpack(cls, reader):
+        prepare = None
+        if reader.value():
+            prepare = Prepare.unpack(reader)
+        return cls(prepare=prepare)
+    
+    @classmethod
+    def from_request(cls, request):
+        return decode(cls, request)
+
     @classmethod
     def from_response(cls, response):
         return cls.from_request(response)
 
 
+    def timeout(self):
+        return PHASE_TIMEOUTS.get(getattr(self, 'endpoint', None),
+                                  DEFAULT_PHASE_TIMEOUT)
+
+    @tornado.gen.coroutine
+    def send_to(self, agent):
+        """
+        Sends this message to a single agent. Transport errors are logged and
+        reported as a `None` response so one dead peer can't fail the phase.
+        """
+        logger.info("Sending request to agent %s", agent)
+        try:
+            resp = yield agent.send(self)
+        except Exception as e:
+            logger.warning("%s to %s failed: %s", self, agent, e)
+            raise tornado.gen.Return(None)
+        raise tornado.gen.Return(resp)
+
+    def issue(self, targets):
+        """
+        Sends this message to every target at once.
+
+        :return: The outstanding futures, in the same order as `targets`.
+        """
+        return [self.send_to(agent) for agent in targets]
+
+    def drain(self, futures):
+        """
+        Lets replies that arrive after a phase has returned finish in the
+        background instead of holding up the caller.
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        for future in futures:
+            if not future.done():
+                io_loop.add_future(future, self.late_reply)
+
+    def notify(self, targets):
+        """
+        Sends this message to every target without waiting for any of them.
+        """
+        metrics.count('paxos_phase_messages_total', (('phase', self.endpoint),), len(targets))
+        self.drain(self.issue(targets))
+
+    def late_reply(self, future):
+        resp = future.result()
+        if resp is not None:
+            logger.debug("Late reply to %s: %s", self, resp.code)
+
     @tornado.gen.coroutine
-    def fanout(self, expected=None):
+    def replies(self, futures, timeout, enough=None):
+        """
+        Collects replies in the order they arrive until `enough(replies)` is
+        true (which it may be before any arrive), every future has resolved,
+        or `timeout` seconds have passed.
+        """
+        replies = []
+        waiter = tornado.gen.WaitIterator(*futures)
+        deadline = tornado.ioloop.IOLoop.current().time() + timeout
+        while not waiter.done():
+            if enough is not None and enough(replies):
+                break
+            try:
+                resp = yield tornado.gen.with_timeout(deadline, waiter.next())
+            except tornado.gen.TimeoutError:
+                logger.warning("Timed out on %s after %s of %s replies",
+                               self, len(replies), len(futures))
+                break
+            replies.append(resp)
+        self.drain(futures)
+        raise tornado.gen.Return(replies)
+
+    @tornado.gen.coroutine
+    def fanout(self, expected=None, timeout=None):
         if not hasattr(self, 'endpoint'):
             raise NotImplementedError("Set an endpoint for the model")
+        futures = self.issue(agents.all())
+        replies = yield self.replies(futures, timeout or self.timeout())
         responses = []
-        for agent in agents.all():
-            resp = yield agent.send(self)
-            if expected is not None:
+        for resp in replies:
+            if resp is not None and expected is not None:
                 responses.append(expected.from_response(resp))
         raise tornado.gen.Return(responses)
 
     @tornado.gen.coroutine
-    def send(self, quorum):
+    def send(self, quorum, required=None, timeout=None):
+        """
+        Sends this message to every agent in `quorum` concurrently and returns
+        as soon as `required` of them (all of them by default) have issued, or
+        as soon as that is no longer possible.
+
+        :return: A tuple of (responses, issued, conflicting).
+        """
         if not hasattr(self, 'endpoint'):
             raise NotImplementedError("Set an endpoint for the model.")
+        if required is None:
+            required = len(quorum)
+
+        def enough(replies):
+            issued = sum(1 for r in replies if r is not None and r.code == 200)
+            outstanding = len(quorum) - len(replies)
+            return issued >= required or issued + outstanding < required
+
+        started = time.monotonic()
+        futures = self.issue(quorum)
+        replies = yield self.replies(futures, timeout or self.timeout(), enough)
         responses, issued, conflicting = [], [], []
-        for agent in quorum:
-            logger.info("Sending request to agent %s", agent)
-            resp = yield agent.send(self)
+        for resp in replies:
+            if resp is None:
+                continue
             responses.append(resp)
             if resp.code == 200:
                 issued.append(resp)
             elif resp.code == 400:
                 conflicting.append(resp)
+        self.measure(time.monotonic() - started, len(quorum), required,
+                     responses, issued, conflicting)
         raise tornado.gen.Return(tuple([responses, issued, conflicting]))
 
+    def measure(self, seconds, messages, required, responses, issued, conflicting):
+        if len(issued) >= required:
+            outcome = 'quorum'
+        elif conflicting:
+            outcome = 'preempted'
+        elif len(responses) > len(issued):
+            outcome = 'refused'
+        else:
+            outcome = 'short'
+        phase = (('phase', self.endpoint),)
+        metrics.observe('paxos_phase_seconds', seconds, phase)
+        metrics.count('paxos_phase_messages_total', phase, messages)
+        metrics.count('paxos_phase_total', phase + (('outcome', outcome),))
+
 
 class Prepare(Phase):
 
-    _id = 0
+    __slots__ = ('id', 'key', 'predicate', 'argument', 'slot', 'client_id', 'sequence')
+    _round = 0
+    node_id = 0
     endpoint = '/prepare'
     
-    def __init__(self, id=None, key=None, predicate=None, argument=None):
+    def __init__(self, id=None, key=None, predicate=None, argument=None,
+                 slot=None, client_id=None, sequence=None):
         self.id = id
         if id is None:
             with prepare_id_mutex: 
-                self.id = Prepare._id
-                Prepare._id += 1
+                self.id = make_ballot(Prepare._round, Prepare.node_id)
+                Prepare._round += 1
         
         self.key = key
         self.predicate = predicate
         self.argument = argument
+        self.slot = slot
+        # Who asked for the write, so copies of it can be told apart from
+        # writes that merely look the same.
+        self.client_id = client_id
+        self.sequence = sequence
+
+    @classmethod
+    def observe(cls, ballot):
+        """
+        Makes sure the next ballot we issue is higher than `ballot`, whoever
+        issued it.
+        """
+        if ballot is None:
+            return
+        with prepare_id_mutex:
+            cls._round = max(cls._round, ballot_round(ballot) + 1)
 
     def to_json(self):
-        return {
+        js = {
             'id': self.id,
             'key': self.key,
             'predicate': self.predicate,
             'argument': self.argument
         }
+        if self.slot is not None:
+            js['slot'] = self.slot
+        if self.client_id is not None:
+            js['client_id'] = self.client_id
+            js['sequence'] = self.sequence
+        return js
 
     @classmethod
-    def from_request(cls, request):
-        return Prepare(**json.loads(request.body))
+    def from_json(cls, js):
+        return Prepare(**js)
+
+    def pack(self, writer):
+        writer.value(self.id)
+        writer.value(self.slot)
+        writer.value(self.key)
+        writer.value(self.predicate)
+        writer.value(self.argument)
+        writer.value(self.client_id)
+        writer.value(self.sequence)
+
+    @classmethod
+    def unpack(cls, reader):
+        id = reader.value()
+        slot = reader.value()
+        return Prepare(id=id, slot=slot, key=reader.value(),
+                       predicate=reader.value(), argument=reader.value(),
+                       client_id=reader.value(), sequence=reader.value())
 
     def __repr__(self):
         return "<Prepare id={}>".format(self.id)
@@ -138,17 +480,9 @@ class Prepare(Phase):
 
 class Promise(Phase):
 
+    __slots__ = ()
     endpoint = '/promise'
 
-    @classmethod
-    def from_response(cls, response):
-        resp = json.loads(response.body)
-        prepare = resp.get('prepare')
-        if prepare:
-            return Promise(
-                prepare=Prepare(**prepare))
-        return Promise()
-
     def __repr__(self):
         if self.prepare:
             return "<Promise prepare={}>".format(self.prepare.to_json())
@@ -157,29 +491,94 @@ class Promise(Phase):
 
 
 class Promises(Phase):
+    """
+    Promises by key and ballot. Alongside the promises themselves we keep a
+    max-heap of ballots per key and one across all keys, so the highest
+    ballot is found in O(log n) instead of by scanning. Removal is lazy:
+    stale heap entries are skipped (and popped) when they reach the top, and
+    a heap is rebuilt once most of it is stale. Promises made for a slot are
+    also indexed by it. One ballot may be promised for several keys (a
+    leader's), so the global heap breaks ties by insertion order rather than
+    comparing keys, which needn't be comparable.
+    """
+
+    __slots__ = ('promises', 'by_key', 'ballots', 'slots', 'pushed')
 
     def __init__(self, promises=None):
-        self.promises = collections.defaultdict(dict)
+        self.clear()
         if promises is None:
             return
         for promise in promises:
-            self.promises[promise.prepare.key][promise.prepare.id] = promise
+            self.add(promise)
 
     def clear(self):
-        self.promises = collections.defaultdict(dict)
+        self.promises = {}
+        self.by_key = {}
+        self.ballots = []
+        self.slots = {}
+        self.pushed = itertools.count()
+
+    def __iter__(self):
+        for by_id in list(self.promises.values()):
+            for promise in list(by_id.values()):
+                yield promise
+
+    def __len__(self):
+        return sum(len(by_id) for by_id in self.promises.values())
 
     def __contains__(self, promise):
         key = promise.prepare.key
         id = promise.prepare.id
         return key in self.promises and id in self.promises[key]
 
+    def add(self, promise):
+        key, id = promise.prepare.key, promise.prepare.id
+        by_id = self.promises.setdefault(key, {})
+        if id not in by_id:
+            heapq.heappush(self.by_key.setdefault(key, []), -id)
+            heapq.heappush(self.ballots, (-id, next(self.pushed), key))
+        by_id[id] = promise
+        if promise.prepare.slot is not None:
+            self.slots[promise.prepare.slot] = promise
+
     def remove(self, prepare):
-        try:
-            del self.promises[prepare.key][prepare.id]
-            if not self.promises[prepare.key]:
-                del self.promises[prepare.key]
-        except KeyError:
+        by_id = self.promises.get(prepare.key)
+        if by_id is None or prepare.id not in by_id:
             logger.warning("Already removed promise %s", prepare)
+            return
+        was_highest = prepare.id == self.highest_id(prepare.key)
+        promise = by_id.pop(prepare.id)
+        if self.slots.get(promise.prepare.slot) is promise:
+            del self.slots[promise.prepare.slot]
+        if not by_id:
+            del self.promises[prepare.key]
+            del self.by_key[prepare.key]
+        else:
+            if len(self.by_key[prepare.key]) > 2 * len(by_id):
+                self.by_key[prepare.key] = [-id for id in by_id]
+                heapq.heapify(self.by_key[prepare.key])
+            if was_highest:
+                # The global heap may only hold this key's old highest ballot.
+                heapq.heappush(self.ballots, (-self.highest_id(prepare.key), next(self.pushed), prepare.key))
+        if len(self.ballots) > 2 * len(self.promises) + 64:
+            self.reindex()
+
+    def reindex(self):
+        """
+        Rebuilds the global heap from the highest ballot of every key.
+        """
+        self.ballots = [(self.by_key[key][0], next(self.pushed), key) for key in self.promises
+                        if self.highest_id(key) is not None]
+        heapq.heapify(self.ballots)
+
+    def highest_id(self, key):
+        by_id = self.promises.get(key)
+        if not by_id:
+            return
+        ids = self.by_key[key]
+        while -ids[0] not in by_id:
+            heapq.heappop(ids)
+        return -ids[0]
 
     @classmethod
     def from_responses(cls, responses):
@@ -188,39 +587,305 @@ class Promises(Phase):
         return Promises([p for p in promises if p.prepare is not None])
 
     def highest_promise_for_key(self, key):
-        promises = self.promises[key]
-        if promises:
-            return promises[max(promises)]
+        id = self.highest_id(key)
+        if id is not None:
+            return self.promises[key][id]
 
     def highest_numbered(self, key=None):
-        highest = None
         if key:
             return self.highest_promise_for_key(key)
-        for key in self.promises:
-            promise = self.highest_promise_for_key(key)
-            if promise.prepare:
-                if not highest:
-                    highest = promise
-                elif highest.prepare.id < promise.prepare.id:
-                    highest = promise
-        return highest
-
-    def add(self, promise):
-        self.promises[promise.prepare.key][promise.prepare.id] = promise
+        ballots = self.ballots
+        while ballots:
+            id, _, key = ballots[0]
+            if key in self.promises and -id in self.promises[key]:
+                return self.promises[key][-id]
+            heapq.heappop(ballots)
 
     def get(self, key):
-        if not self.promises[key]:
-            return
-        id = max(self.promises[key])
-        return self.promises[key][id]
+        return self.highest_promise_for_key(key)
+
+    def at_slot(self, slot):
+        """
+        :return: The latest promise made for `slot`, if any.
+        """
+        if slot is not None:
+            return self.slots.get(slot)
+
+    def snapshot(self):
+        return {key: self.highest_promise_for_key(key).prepare.to_json()
+                for key in self.promises}
+
+    def restore(self, state):
+        for prepare in state.values():
+            self.add(Promise(prepare=Prepare(**prepare)))
+
+    def compact(self, index):
+        """
+        Only the highest ballot per key is ever consulted, so that is all we
+        keep once a snapshot has been taken.
+        """
+        highest = [self.highest_promise_for_key(key) for key in self.promises]
+        self.clear()
+        for promise in highest:
+            self.add(promise)
 
 class Propose(Phase):
+    __slots__ = ()
     endpoint = '/propose'
- 
+
+
+class Withdraw(Phase):
+    """
+    Tells an acceptor that the proposer of `prepare` has given up on it, so
+    its promise no longer holds anything up.
+    """
+    __slots__ = ()
+    endpoint = '/withdraw'
+
+
 class Accept(Phase):
+    """
+    Phase 2 of Multi-Paxos. `commit` piggybacks the leader's commit index:
+    every slot up to it has been chosen, so an acceptor holding a value it
+    accepted under the same ballot for such a slot can learn it.
+    """
+
+    __slots__ = ('commit',)
     endpoint = '/accept'
 
+    def __init__(self, prepare=None, commit=None):
+        self.prepare = prepare
+        self.commit = commit
+
+    def to_json(self):
+        js = Phase.to_json(self)
+        if self.commit is not None:
+            js['commit'] = self.commit
+        return js
+
+    @classmethod
+    def from_json(cls, js):
+        accept = super(Accept, cls).from_json(js)
+        accept.commit = js.get('commit')
+        return accept
+
+    def pack(self, writer):
+        Phase.pack(self, writer)
+        writer.value(self.commit)
+
+    @classmethod
+    def unpack(cls, reader):
+        accept = super(Accept, cls).unpack(reader)
+        accept.commit = reader.value()
+        return accept
+
+    def __repr__(self):
+        return "<Accept id={} slot={}>".format(self.prepare.id, self.prepare.slot)
+
+
+class FastAccept(Phase):
+    """
+    The fast path's only round. `prepare` is a write that commutes and has
+    no slot yet. In an acceptor's reply `prepare.slot` is the last slot it
+    knows a write to the same key that doesn't commute went to, which the
+    write must be ordered after.
+    """
+    __slots__ = ()
+    endpoint = '/fast'
+
+    def __repr__(self):
+        return "<FastAccept id={} key={}>".format(self.prepare.id, self.prepare.key)
+
+
+class Elect(Phase):
+    """
+    Phase 1 of Multi-Paxos. `prepare.id` is the ballot the proposer wants to
+    hold for every slot from `prepare.slot` onwards.
+    """
+    __slots__ = ()
+    endpoint = '/elect'
+
+    def __repr__(self):
+        return "<Elect id={} slot={}>".format(self.prepare.id, self.prepare.slot)
+
+
+class Elected(Phase):
+    """
+    An acceptor's reply to `Elect`. `prepare.slot` is the first slot the
+    acceptor knows nothing about, and `accepted` holds the values it accepted
+    at or after the requested slot.
+    """
+
+    __slots__ = ('accepted',)
+
+    def __init__(self, prepare=None, accepted=None):
+        self.prepare = prepare
+        self.accepted = accepted or []
+
+    def to_json(self):
+        return {
+            'prepare': self.prepare.to_json() if self.prepare else None,
+            'accepted': [prepare.to_json() for prepare in self.accepted]
+        }
+
+    @classmethod
+    def from_json(cls, js):
+        prepare = None
+        if js.get('prepare'):
+            prepare = Prepare.from_json(js.get('prepare'))
+        accepted = [Prepare.from_json(p) for p in js.get('accepted', [])]
+        return cls(prepare=prepare, accepted=accepted)
+
+    def pack(self, writer):
+        Phase.pack(self, writer)
+        writer.value(len(self.accepted))
+        for prepare in self.accepted:
+            prepare.pack(writer)
+
+    @classmethod
+    def unpack(cls, reader):
+        elected = super(Elected, cls).unpack(reader)
+        elected.accepted = [Prepare.unpack(reader) for _ in range(reader.value())]
+        return elected
+
+
+class NotLeader(Exception):
+    """
+    Raised for a write while node `node` holds the leader's lease. Only the
+    leader can commit it until the lease runs out.
+    """
+
+    def __init__(self, node):
+        super(NotLeader, self).__init__(node)
+        self.node = node
+
+
+class Leader:
+    """
+    Proposer-side Multi-Paxos state. While `ballot` is set this agent has a
+    quorum's promise for every slot from the one it was elected at, so it can
+    skip Phase 1. Until `lease_expires` no other agent can be elected, so
+    reads may be served locally.
+    """
+
+    lease_duration = LEASE_DURATION
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ballot = None
+        self.lease_expires = 0
+
+    @property
+    def elected(self):
+        return self.ballot is not None
+
+    def elect(self, ballot):
+        self.ballot = ballot
+
+    def renew(self, started):
+        """
+        Extends the lease after a quorum admitted a message sent at `started`.
+        Acceptors count from when they received it, which is later.
+        """
+        expires = started + self.lease_duration * (1 - LEASE_DRIFT)
+        self.lease_expires = max(self.lease_expires, expires)
+
+    def holds_lease(self):
+        return self.elected and time.monotonic() < self.lease_expires
+
+    def step_down(self):
+        logger.warning("Leader ballot %s was pre-empted. Stepping down.", self.ballot)
+        self.ballot = None
+        self.lease_expires = 0
+
+
+class LeaderPromise:
+    """
+    Acceptor-side Multi-Paxos state: the highest ballot promised for a range
+    of slots, and the values accepted in those slots. Accepted values are kept
+    after they are learned so a new leader can never overwrite a chosen slot.
+    `election` is the highest Elect promised, which covers every slot from
+    its own on.
+    """
+
+    lease_duration = LEASE_DURATION
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.prepare = None
+        self.election = None
+        self.accepted = {}
+        self.next_slot = 0
+        self.lease_node = None
+        self.lease_expires = 0
+
+    def grant(self, prepare):
+        """
+        Leases the leadership to the node that issued `prepare.id` for another
+        `lease_duration`. Only accepting an elected leader's Accept grants
+        one. The lease belongs to the node rather than the ballot, so a
+        leader that stepped down can be elected again. An Accept from a later
+        leader, which a quorum must have elected, takes the lease over.
+        """
+        self.lease_node = ballot_node(prepare.id)
+        self.lease_expires = time.monotonic() + self.lease_duration
+
+    def leased(self, prepare):
+        """
+        :return: Whether another node still holds a lease we granted.
+        """
+        return (self.lease_node is not None and self.lease_node != ballot_node(prepare.id)
+                and time.monotonic() < self.lease_expires)
+
+    def promise(self, prepare):
+        if self.prepare is None or prepare.id > self.prepare.id:
+            self.prepare = prepare
+
+    def elect(self, prepare):
+        self.promise(prepare)
+        if self.election is None or prepare.id > self.election.id:
+            self.election = prepare
+
+    def promised(self, slot):
+        """
+        :return: The ballot an Elect promised `slot` to, if one covers it.
+        """
+        if self.election is not None and slot is not None and slot >= self.election.slot:
+            return self.election.id
+
+    def admits(self, prepare):
+        return self.prepare is None or prepare.id >= self.prepare.id
+
+    def accept(self, prepare):
+        self.promise(prepare)
+        self.accepted[prepare.slot] = prepare
+        self.next_slot = max(self.next_slot, prepare.slot + 1)
+
+    def learned(self, slot):
+        self.next_slot = max(self.next_slot, slot + 1)
+
+    def snapshot(self):
+        return None
+
+    def restore(self, state):
+        pass
+
+    def compact(self, index):
+        for slot in [slot for slot in self.accepted if slot <= index]:
+            del self.accepted[slot]
+
+    def elected(self, elect):
+        accepted = [self.accepted[slot] for slot in sorted(self.accepted)
+                    if slot >= elect.slot]
+        prepare = Prepare(id=elect.id, slot=max(elect.slot, self.next_slot))
+        return Elected(prepare=prepare, accepted=accepted)
+
 class Learn(Phase):
+    __slots__ = ()
     endpoint = '/learn'
 
     def __repr__(self):
@@ -228,6 +893,8 @@ class Learn(Phase):
 
 class Success(Phase):
 
+    __slots__ = ()
+
     def to_json(self):
         return {
             'prepare': self.prepare.to_json(),
@@ -1,5 +1,111 @@
 AGENT_PORTS = [8888, 8889, 8890]
 AGENT_URL = 'http://127.0.0.1'
 
+# A ballot is a (round, node id) pair packed into one integer as
+# round * BALLOT_NODES + node_id, so ballots from different agents never tie
+# and compare by round first.
+BALLOT_NODES = 1024
+
 TORNADO_SETTINGS = {'autoreload': True}
 
+# With --peer_transport agents also listen on port + PEER_PORT_OFFSET for
+# framed agent-to-agent traffic.
+PEER_PORT_OFFSET = 1000
+
+# With --paxos_groups=N each of an agent's N processes also listens on
+# port + GROUP_PORT_OFFSET * (group + 1), where the same group in the other
+# agents reaches it. Keep N * GROUP_PORT_OFFSET below PEER_PORT_OFFSET.
+GROUP_PORT_OFFSET = 100
+
+# A pre-empted proposal is retried after a random delay of up to
+# BACKOFF_BASE * 2 ** retries seconds, capped at BACKOFF_MAX. A write is given
+# up on, with a 503, once WRITE_DEADLINE seconds have passed.
+BACKOFF_BASE = 0.01
+BACKOFF_MAX = 1.0
+WRITE_DEADLINE = 5.0
+
+# Flexible Paxos. How many of the agents must accept in Phase 1 (Prepare,
+# Elect) and in Phase 2 (Propose, Accept). Any Phase 1 quorum has to intersect
+# any Phase 2 quorum, so the two must add up to more than len(AGENT_PORTS).
+# None means a majority.
+PHASE1_QUORUM = None
+PHASE2_QUORUM = None
+
+# The fast path (--fast_path). Writes whose predicate is listed here commute
+# with each other, so they commit once FAST_QUORUM agents have accepted them
+# and are ordered into the log afterwards. A fast quorum has to intersect
+# every Phase 1 and Phase 2 quorum. None means the smallest size that does.
+# An acceptor orders a fast write itself if it is still unordered after
+# FAST_ORDER_TIMEOUT seconds, in case its proposer went down.
+COMMUTATIVE_PREDICATES = ('incr',)
+FAST_QUORUM = None
+FAST_ORDER_TIMEOUT = 1.0
+
+# Seconds a phase waits for its quorum before it gives up on the stragglers.
+PHASE_TIMEOUTS = {
+    '/prepare': 1.0,
+    '/propose': 1.0,
+    '/withdraw': 1.0,
+    '/elect': 1.0,
+    '/accept': 1.0,
+    '/fast': 1.0,
+    '/learn': 2.0
+}
+DEFAULT_PHASE_TIMEOUT = 1.0
+
+# Quorum selection. Each agent keeps an EWMA (weight RTT_ALPHA per sample) of
+# its peers' round-trip times and error rates. A phase goes to the fastest
+# healthy peers it needs plus QUORUM_SPARE more. A peer whose error rate is
+# at least UNHEALTHY_ERROR_RATE is only used when there is no one else.
+# PROBE_RATE of the time one slower peer is swapped in so its stats stay fresh.
+RTT_ALPHA = 0.2
+UNHEALTHY_ERROR_RATE = 0.5
+QUORUM_SPARE = 1
+PROBE_RATE = 0.05
+
+# Group commit. Writes to a key are held for up to BATCH_LINGER milliseconds,
+# or until BATCH_SIZE of them are waiting, and are committed as one instance.
+BATCH_SIZE = 1
+BATCH_LINGER = 5
+
+# Writes that carry a client_id and sequence are remembered, up to this many,
+# so a retried write is answered without running consensus again.
+DEDUP_SIZE = 10000
+
+# How many instances a proposer may have in flight at once.
+PIPELINE_WINDOW = 16
+
+# Snapshot the applied state and truncate the log every this many slots.
+SNAPSHOT_EVERY = 10000
+
+# GET /read flushes to the client every this many entries.
+READ_CHUNK = 500
+
+# GET /watch serves subscribers from a shared buffer of the last WATCH_BUFFER
+# applied slots, and sends an empty line when nothing has happened for
+# WATCH_HEARTBEAT seconds.
+WATCH_BUFFER = 10000
+WATCH_HEARTBEAT = 15.0
+
+# Seconds an acceptor that admits a leader's Elect or Accept refuses to elect
+# anyone else. The leader counts its lease from before it sent the message and
+# gives up LEASE_DRIFT of it to allow for clock rate differences.
+LEASE_DURATION = 2.0
+LEASE_DRIFT = 0.1
+
+# Seconds GET /kv waits for the log to catch up before giving up.
+READ_TIMEOUT = 2.0
+
+# An agent that sees the cluster commit past it waits CATCHUP_DELAY seconds for
+# Learns in flight, then streams the missing slots from a peer. One transfer
+# may take up to CATCHUP_TIMEOUT seconds.
+CATCHUP_DELAY = 0.5
+CATCHUP_TIMEOUT = 60.0
+
+# A slot below the highest learned one that is still empty after HOLE_TIMEOUT
+# seconds was most likely abandoned by its proposer. It is filled with a no-op.
+HOLE_TIMEOUT = 1.0
+
+# Upper bounds, in seconds, of the latency histograms served at GET /metrics.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
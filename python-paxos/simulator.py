@@ -0,0 +1,436 @@
+"""
+A deterministic, in-process cluster for measuring protocol changes.
+
+    python simulator.py [--agents 3] [--writes 1000] [--clients 8] [--seed 1]
+                        [--latency 1] [--jitter 0.5] [--loss 0.01] ...
+
+Every agent is a fresh import of `agent` and the modules it uses, so each
+has its own globals, ballots and log, and they serve each other's messages
+through the same handlers as a real cluster. Messages travel over a
+`Network` that delays, drops and reorders them and can partition agents.
+
+Time is virtual. The event loop never waits: whenever nothing is ready it
+moves the clock straight to the next timer. A run takes as long as the CPU
+work it does, and the same seed always gives the same numbers.
+"""
+import argparse
+import asyncio
+import collections
+import importlib
+import itertools
+import json
+import logging
+import os
+import random
+import selectors
+import sys
+import time
+import types
+import zlib
+
+import tornado
+import tornado.concurrent
+import tornado.gen
+import tornado.httputil
+import tornado.ioloop
+
+from transport import FrameConnection, PeerResponse
+
+logger = logging.getLogger('agent')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+URL = 'http://simulated'
+FIRST_PORT = 7000
+# How many times a client follows a 503 to the leader it names.
+REDIRECTS = 3
+
+
+class VirtualClock(selectors.BaseSelector):
+    """
+    Stands in for the event loop's selector. Nothing here does real I/O, so
+    rather than wait `timeout` seconds for some we move the clock on.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.keys = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.keys[fd] = selectors.SelectorKey(fileobj, fd, events, data)
+        return self.keys[fd]
+
+    def unregister(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        return self.keys.pop(fd)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Nothing is scheduled. The simulation is stuck.")
+        self.now += timeout
+        return []
+
+    def get_map(self):
+        return self.keys
+
+    def close(self):
+        self.keys.clear()
+
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self):
+        self.clock = VirtualClock()
+        super(VirtualLoop, self).__init__(selector=self.clock)
+
+    def time(self):
+        return self.clock.now
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def is_ours(module):
+    filename = getattr(module, '__file__', None) or ''
+    return os.path.dirname(os.path.abspath(filename)) == HERE
+
+
+def load_agent(clock):
+    """
+    Imports a private copy of `agent`, everything of ours it depends on and
+    `tornado.options`, and points their `time` at the virtual clock.
+
+    :return: A dict of module name to module for the copy.
+    """
+    names = [name for name, module in sys.modules.items()
+             if is_ours(module) and name != __name__] + ['tornado.options']
+    saved = {name: sys.modules.pop(name) for name in names if name in sys.modules}
+    try:
+        importlib.import_module('agent')
+        copy = {name: module for name, module in sys.modules.items()
+                if (is_ours(module) and name != __name__) or name == 'tornado.options'}
+    finally:
+        for name in copy:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+        tornado.options = saved.get('tornado.options', tornado.options)
+    virtual = types.SimpleNamespace(monotonic=clock, time=clock, perf_counter=clock,
+                                    sleep=time.sleep)
+    for module in copy.values():
+        if getattr(module, 'time', None) is time:
+            module.time = virtual
+    return copy
+
+
+class Network:
+    """
+    Carries messages between agents. Each hop takes `latency` seconds plus
+    an exponentially distributed `jitter`. With probability `reorder` a
+    message is held back for up to another `reorder_window` seconds, and
+    with probability `loss` it is dropped. Agents on different sides of a
+    partition can't reach each other at all.
+    """
+
+    def __init__(self, rng, latency=0.001, jitter=0.0, loss=0.0, reorder=0.0,
+                 reorder_window=0.005):
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_window = reorder_window
+        self.nodes = {}
+        self.sides = None
+        self.sent = collections.Counter()
+        self.lost = collections.Counter()
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.expovariate(1.0 / self.jitter)
+        if self.reorder and self.rng.random() < self.reorder:
+            delay += self.rng.uniform(0, self.reorder_window)
+        return delay
+
+    def partition(self, *sides):
+        """
+        Splits the agents, given as lists of ports. Agents not listed are
+        all on one more side.
+        """
+        self.sides = {port: i for i, side in enumerate(sides) for port in side}
+
+    def heal(self):
+        self.sides = None
+
+    def reachable(self, source, destination):
+        if self.sides is None:
+            return True
+        return self.sides.get(source, -1) == self.sides.get(destination, -1)
+
+    def dropped(self, source, destination, endpoint):
+        if source is None or destination is None: # Clients have a reliable link.
+            return False
+        if not self.reachable(source, destination) or (
+                self.loss and self.rng.random() < self.loss):
+            self.lost[endpoint] += 1
+            return True
+        return False
+
+    def later(self, callback):
+        tornado.ioloop.IOLoop.current().call_later(self.delay(), callback)
+
+    def send(self, source, destination, endpoint, body, content_type):
+        """
+        :param source: The sending agent's port, or None for a client.
+        :return: A future for the reply, which never resolves if the request
+            or the reply is lost.
+        """
+        future = tornado.concurrent.Future()
+        self.sent[endpoint] += 1
+        if self.dropped(source, destination, endpoint):
+            return future
+
+        def reply(code, content_type, body):
+            if not self.dropped(destination, source, endpoint):
+                self.later(lambda: future.done() or future.set_result(
+                    PeerResponse(code, content_type, body)))
+
+        self.later(lambda: self.nodes[destination].dispatch(endpoint, body, content_type, reply))
+        return future
+
+
+class Node:
+    """
+    One simulated agent: a private copy of the agent modules serving its
+    handlers straight off the network.
+    """
+
+    def __init__(self, modules, port, ports, network, phases, multi_paxos=False):
+        self.modules = modules
+        self.port = port
+        self.agent = agent = modules['agent']
+        models = modules['models']
+        models.Prepare.node_id = ports.index(port)
+        agent.options.port = port
+        agent.options.multi_paxos = multi_paxos
+        agent.catchup.peers = lambda: [] # Streams over real HTTP.
+        models.agents.agents = [models.Agent(URL, p) for p in ports]
+        models.agents.set_quorums()
+
+        def deliver(peer, message):
+            return network.send(port, peer.port, message.endpoint,
+                                peer.codec.encode(message), peer.codec.content_type)
+
+        send = models.Phase.send
+
+        @tornado.gen.coroutine
+        def timed_send(message, *args, **kwargs):
+            started = tornado.ioloop.IOLoop.current().time()
+            result = yield send(message, *args, **kwargs)
+            phases[message.endpoint].append(tornado.ioloop.IOLoop.current().time() - started)
+            raise tornado.gen.Return(result)
+
+        models.Agent.deliver = deliver
+        models.Phase.send = timed_send
+        agent.TORNADO_SETTINGS = {}
+        self.application = agent.get_app()
+
+    def dispatch(self, endpoint, body, content_type, reply):
+        request = tornado.httputil.HTTPServerRequest(
+            method='POST',
+            uri=endpoint,
+            headers=tornado.httputil.HTTPHeaders({'Content-Type': content_type}),
+            body=body,
+            connection=FrameConnection(reply))
+        self.application(request)
+
+    def chosen(self):
+        """
+        :return: slot -> the value learned there, as canonical JSON so batches
+            and fast entries, whose arguments are lists, compare too.
+        """
+        return {slot: json.dumps([learn.prepare.key, learn.prepare.predicate,
+                                  learn.prepare.argument], sort_keys=True)
+                for slot, learn in self.agent.log.entries.items()}
+
+    def applied(self):
+        """
+        :return: How many times each client write, by (client_id, sequence),
+            was learned here. Writes in a batch count one by one.
+        """
+        unbatch = self.modules['batching'].unbatch
+        return collections.Counter(
+            (write.client_id, write.sequence)
+            for learn in self.agent.log.entries.values()
+            for write in unbatch(learn.prepare)
+            if write.client_id is not None and write.predicate != self.agent.NOOP_PREDICATE)
+
+
+class Simulation:
+
+    def __init__(self, agents=3, seed=1, multi_paxos=False, **network):
+        self.rng = random.Random(seed)
+        random.seed(seed) # Backoff and quorum probing use the global one.
+        self.loop = VirtualLoop()
+        self.network = Network(self.rng, **network)
+        self.phases = collections.defaultdict(list)
+        self.latencies = []
+        self.failures = collections.Counter()
+        self.client_ids = itertools.count()
+        ports = list(range(FIRST_PORT, FIRST_PORT + agents))
+        for port in ports:
+            modules = load_agent(self.loop.time)
+            self.network.nodes[port] = Node(modules, port, ports, self.network,
+                                            self.phases, multi_paxos)
+        self.ports = ports
+
+    def route(self, key):
+        """
+        Spreads writes over the agents by key, the way `client.Router` does.
+        """
+        return self.ports[zlib.crc32(str(key).encode('utf-8')) % len(self.ports)]
+
+    @tornado.gen.coroutine
+    def write(self, key, predicate, argument, client_id, sequence):
+        io_loop = tornado.ioloop.IOLoop.current()
+        started = io_loop.time()
+        body = json.dumps({'key': key, 'predicate': predicate, 'argument': argument,
+                           'client_id': client_id, 'sequence': sequence})
+        port = self.route(key)
+        for _ in range(REDIRECTS + 1):
+            response = yield self.network.send(None, port, '/write', body, 'application/json')
+            if response.code != 503 or not response.body:
+                break
+            # Not leading. Like `client.Router`, go where it points.
+            port = int(json.loads(response.body)['leader'].rsplit(':', 1)[1])
+        if response.code == 200:
+            self.latencies.append(io_loop.time() - started)
+        else:
+            self.failures[response.code] += 1
+
+    @tornado.gen.coroutine
+    def client(self, writes, keys, incr_ratio, timeout):
+        client_id = 'client-{}'.format(next(self.client_ids))
+        for sequence in itertools.count():
+            if not writes:
+                break
+            writes.pop()
+            key = 'key-{}'.format(self.rng.randrange(keys))
+            if self.rng.random() < incr_ratio:
+                write = self.write(key, 'incr', 1, client_id, sequence)
+            else:
+                write = self.write(key, 'set', self.rng.randrange(1000), client_id, sequence)
+            try:
+                yield tornado.gen.with_timeout(
+                    tornado.ioloop.IOLoop.current().time() + timeout, write)
+            except tornado.gen.TimeoutError:
+                self.failures['timeout'] += 1
+
+    @tornado.gen.coroutine
+    def run(self, writes=1000, clients=8, keys=100, incr_ratio=0.0, timeout=10.0,
+            isolate=None, isolate_at=0.0, isolate_for=0.0):
+        io_loop = tornado.ioloop.IOLoop.current()
+        if isolate is not None:
+            io_loop.call_later(isolate_at, self.network.partition, [self.ports[isolate]])
+            io_loop.call_later(isolate_at + isolate_for, self.network.heal)
+        remaining = list(range(writes))
+        started = io_loop.time()
+        yield [self.client(remaining, keys, incr_ratio, timeout) for _ in range(clients)]
+        self.elapsed = io_loop.time() - started
+        yield tornado.gen.sleep(1.0) # Let Learns still in flight land.
+
+    def execute(self, **workload):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.start(**workload))
+        finally:
+            asyncio.set_event_loop(None)
+        return self.report()
+
+    async def start(self, **workload):
+        # Tornado's IOLoop keeps its own clock on top of asyncio's.
+        tornado.ioloop.IOLoop.current().time = self.loop.time
+        await self.run(**workload)
+
+    def diverged(self):
+        """
+        :return: How many slots two agents learned different values for.
+        """
+        chosen = [node.chosen() for node in self.network.nodes.values()]
+        slots = set().union(*chosen)
+        return sum(1 for slot in slots
+                   if len({c[slot] for c in chosen if slot in c}) > 1)
+
+    def applied_twice(self):
+        """
+        :return: How many client writes some agent learned in more than one slot.
+        """
+        return max(sum(1 for count in node.applied().values() if count > 1)
+                   for node in self.network.nodes.values())
+
+    def report(self):
+        commits = len(self.latencies)
+
+        def summary(samples):
+            return {
+                'count': len(samples),
+                'p50_ms': (percentile(samples, 0.5) or 0) * 1000,
+                'p90_ms': (percentile(samples, 0.9) or 0) * 1000,
+                'p99_ms': (percentile(samples, 0.99) or 0) * 1000
+            }
+
+        return {
+            'commits': commits,
+            'failures': dict(self.failures),
+            'seconds': self.elapsed,
+            'commits_per_second': commits / self.elapsed if self.elapsed else 0.0,
+            'write_latency': summary(self.latencies),
+            'phases': {endpoint: summary(samples)
+                       for endpoint, samples in sorted(self.phases.items())},
+            'messages_per_commit': {endpoint: float(count) / commits if commits else None
+                                    for endpoint, count in sorted(self.network.sent.items())
+                                    if endpoint != '/write'},
+            'lost': dict(self.network.lost),
+            'diverged_slots': self.diverged(),
+            'applied_twice': self.applied_twice()
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--agents', type=int, default=3)
+    parser.add_argument('--writes', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--keys', type=int, default=100)
+    parser.add_argument('--incr_ratio', type=float, default=0.0,
+                        help="fraction of writes that are increments")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--multi_paxos', action='store_true')
+    parser.add_argument('--latency', type=float, default=1.0, help="milliseconds per hop")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="mean of the exponential extra delay, in milliseconds")
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--reorder', type=float, default=0.0)
+    parser.add_argument('--isolate', type=int, default=None,
+                        help="cut this agent off from the others for a while")
+    parser.add_argument('--isolate_at', type=float, default=0.1)
+    parser.add_argument('--isolate_for', type=float, default=0.5)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.getLogger('agent').setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    logging.getLogger('tornado').setLevel(logging.WARNING if args.verbose else logging.CRITICAL)
+    simulation = Simulation(agents=args.agents, seed=args.seed, multi_paxos=args.multi_paxos,
+                            latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                            loss=args.loss, reorder=args.reorder)
+    report = simulation.execute(writes=args.writes, clients=args.clients, keys=args.keys,
+                                incr_ratio=args.incr_ratio, isolate=args.isolate,
+                                isolate_at=args.isolate_at, isolate_for=args.isolate_for)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
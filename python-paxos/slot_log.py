@@ -0,0 +1,253 @@
+import logging
+
+import tornado.gen
+import tornado.ioloop
+import tornado.locks
+
+logger = logging.getLogger('agent')
+
+NOOP_PREDICATE = 'noop'
+
+
+class SlotTaken(Exception):
+    """
+    Raised when another proposer has already claimed or chosen a slot. If
+    the slot is free but the write has to go after a later one, `follow` is
+    that later slot.
+    """
+
+    def __init__(self, slot, follow=None):
+        super(SlotTaken, self).__init__(slot)
+        self.slot = slot
+        self.follow = follow
+
+
+class SlotLog:
+    """
+    The replicated log, indexed by slot. Learns may arrive in any order; they
+    are held until every earlier slot has been learned too.
+
+    `commit_index` is the last slot of the contiguous learned prefix, and
+    `apply_index` is the last slot handed to the appliers. Both are -1 while
+    the log is empty. Slots before `start` have been truncated away after a
+    snapshot.
+    """
+
+    def __init__(self):
+        self.appliers = []
+        self.clear()
+
+    def clear(self):
+        self.entries = {}
+        self.start = 0
+        self.commit_index = -1
+        self.apply_index = -1
+        self.next_slot = 0
+
+    def truncate(self, index):
+        """
+        Drops every applied entry up to and including slot `index`.
+        """
+        index = min(index, self.apply_index)
+        for slot in range(self.start, index + 1):
+            self.entries.pop(slot, None)
+        self.start = max(self.start, index + 1)
+
+    def restore(self, index):
+        """
+        Moves an empty log forward to just after a snapshot taken at `index`.
+        """
+        self.start = index + 1
+        self.commit_index = max(self.commit_index, index)
+        self.apply_index = max(self.apply_index, index)
+        self.next_slot = max(self.next_slot, index + 1)
+        for slot in [slot for slot in self.entries if slot <= index]:
+            del self.entries[slot]
+        while self.commit_index + 1 in self.entries:
+            self.commit_index += 1
+        self.apply()
+
+    def learn(self, learn):
+        """
+        Records a learned value. A `Learn` without a slot is appended after
+        the highest slot we know of.
+
+        :return: The slot the value was learned at.
+        """
+        slot = learn.prepare.slot
+        if slot is None:
+            slot = self.next_slot
+        if slot <= self.commit_index:
+            logger.debug("Slot %s was already committed", slot)
+            return slot
+        self.entries[slot] = learn
+        self.next_slot = max(self.next_slot, slot + 1)
+        while self.commit_index + 1 in self.entries:
+            self.commit_index += 1
+        self.apply()
+        return slot
+
+    def apply(self):
+        while self.apply_index < self.commit_index:
+            self.apply_index += 1
+            learn = self.entries[self.apply_index]
+            for applier in self.appliers:
+                applier(learn)
+
+    def committed(self, since=0, limit=None):
+        """
+        Yields the committed entries from slot `since` onwards, in slot order.
+        Anything before `start` is gone and is silently skipped. If a
+        snapshot truncates the rest while the caller is between entries, the
+        entries stop there.
+        """
+        since = max(since, self.start)
+        stop = self.commit_index + 1
+        if limit is not None:
+            stop = min(stop, since + limit)
+        for slot in range(since, stop):
+            learn = self.entries.get(slot)
+            if learn is None: # Truncated by a snapshot while we were streaming.
+                return
+            yield learn
+
+    @property
+    def pending(self):
+        return len(self.entries) - (self.commit_index + 1 - self.start)
+
+    def __contains__(self, slot):
+        return slot in self.entries
+
+    def __len__(self):
+        return self.commit_index + 1
+
+    def report(self):
+        return {
+            'start': self.start,
+            'commit_index': self.commit_index,
+            'apply_index': self.apply_index,
+            'pending': self.pending,
+            'next_slot': self.next_slot
+        }
+
+
+class Holes:
+    """
+    Fills the slots abandoned by their proposers, which would otherwise hold
+    back the commit index forever.
+
+    Call `learned()` after every learn. Once slots below the highest learned
+    one have been empty for `timeout` seconds, `fill(slot)` runs for the
+    first `limit` that still are. `fill` is a coroutine that proposes a
+    no-op; if the slot's own value turns up instead, so much the better.
+    """
+
+    def __init__(self, log, fill, timeout, limit):
+        self.log = log
+        self.fill = fill
+        self.timeout = timeout
+        self.limit = limit
+        self.clear()
+
+    def clear(self):
+        self.watching = False
+        self.filled = 0
+
+    def learned(self):
+        if self.log.pending and not self.watching:
+            self.watching = True
+            tornado.ioloop.IOLoop.current().call_later(
+                self.timeout, self.run, self.log.next_slot)
+
+    @tornado.gen.coroutine
+    def run(self, below):
+        """
+        :param below: The end of the log when the watch started. Later slots
+            haven't been given `timeout` seconds yet.
+        """
+        try:
+            holes = [slot for slot in range(self.log.commit_index + 1, below)
+                     if slot not in self.log][:self.limit]
+            if holes:
+                logger.warning("Slots %s..%s are still empty. Filling them.", holes[0], holes[-1])
+                yield [self.fill(slot) for slot in holes]
+                self.filled += len(holes)
+        finally:
+            self.watching = False
+        self.learned()
+
+    def report(self):
+        return {
+            'watching': self.watching,
+            'filled': self.filled
+        }
+
+
+class Window:
+    """
+    Hands slots out to proposals, with at most `size` of them in flight at
+    once. Slots whose proposal failed are handed out again before new ones so
+    the log doesn't keep a hole.
+    """
+
+    def __init__(self, size):
+        self.resize(size)
+        self.clear()
+
+    def resize(self, size):
+        self.size = size
+        self.semaphore = tornado.locks.Semaphore(size)
+
+    def clear(self):
+        self.next_slot = 0
+        self.abandoned = set()
+        self.in_flight = set()
+
+    @tornado.gen.coroutine
+    def acquire(self, after=None):
+        """
+        :param after: Only hand out a slot later than this one.
+        """
+        yield self.semaphore.acquire()
+        after = -1 if after is None else after
+        abandoned = [slot for slot in self.abandoned if slot > after]
+        if abandoned:
+            slot = min(abandoned)
+            self.abandoned.remove(slot)
+        else:
+            self.advance(after + 1)
+            slot = self.next_slot
+            self.next_slot += 1
+        self.in_flight.add(slot)
+        raise tornado.gen.Return(slot)
+
+    def release(self, slot, chosen=True):
+        self.in_flight.discard(slot)
+        if not chosen:
+            self.abandoned.add(slot)
+        self.semaphore.release()
+
+    def advance(self, slot):
+        self.next_slot = max(self.next_slot, slot)
+
+    def taken(self, slot):
+        """
+        Called for a slot filled some other way, such as by a new leader's
+        repairs, so that it isn't also handed out to a write.
+        """
+        self.abandoned.discard(slot)
+
+    def learned(self, slot):
+        """
+        Called for every slot learned, whoever proposed it, so we never hand
+        out a slot that is already taken.
+        """
+        self.abandoned.discard(slot)
+        self.advance(slot + 1)
+
+    def report(self):
+        return {
+            'size': self.size,
+            'in_flight': len(self.in_flight),
+            'abandoned': len(self.abandoned)
+        }
@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+
+import tornado.gen
+import tornado.ioloop
+
+logger = logging.getLogger('agent')
+
+
+class Snapshot:
+
+    def __init__(self, index=-1, state=None):
+        self.index = index
+        self.state = state or {}
+
+    def to_json(self):
+        return {
+            'index': self.index,
+            'state': self.state
+        }
+
+    @classmethod
+    def from_json(cls, js):
+        return cls(index=js['index'], state=js['state'])
+
+
+def write_atomically(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp, filename)
+    fsync_directory(filename)
+
+
+def fsync_directory(filename):
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Snapshotter:
+    """
+    Every `every` applied slots, captures the applied state and truncates the
+    log prefix it covers.
+
+    The state is made of named parts. Each part has `snapshot()`, returning
+    something JSON serializable that later changes to the part don't touch,
+    `restore(state)`, and `compact(index)` to drop whatever it keeps for
+    slots up to `index`. Listeners are called with every new snapshot and
+    may return a future to wait for.
+    """
+
+    def __init__(self, log, every, filename=None):
+        self.log = log
+        self.every = every
+        self.filename = filename
+        self.parts = {}
+        self.listeners = []
+        self.clear()
+        log.appliers.append(self.applied)
+
+    def clear(self):
+        self.latest = Snapshot()
+        self.scheduled = False
+        self.taking = False
+
+    def register(self, name, part):
+        self.parts[name] = part
+
+    def applied(self, learn):
+        if self.scheduled or not self.every:
+            return
+        if self.log.apply_index - self.latest.index >= self.every:
+            self.scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(self.take)
+
+    def capture(self):
+        """
+        :return: A `Snapshot` of the state as of the last applied slot.
+        """
+        return Snapshot(index=self.log.apply_index, state={
+            name: part.snapshot() for name, part in self.parts.items()})
+
+    @tornado.gen.coroutine
+    def take(self):
+        """
+        The state is captured right away, but serialized and written out on
+        an executor. The log is truncated once the snapshot is on disk.
+        """
+        self.scheduled = False
+        index = self.log.apply_index
+        if index <= self.latest.index or self.taking:
+            raise tornado.gen.Return(self.latest)
+        snapshot = self.capture()
+        if self.filename:
+            self.taking = True
+            try:
+                yield tornado.ioloop.IOLoop.current().run_in_executor(
+                    None, self.write, snapshot)
+            finally:
+                self.taking = False
+        self.latest = snapshot
+        self.log.truncate(index)
+        for part in self.parts.values():
+            part.compact(index)
+        yield [listener(snapshot) for listener in self.listeners]
+        logger.info("Took a snapshot at slot %s", index)
+        raise tornado.gen.Return(snapshot)
+
+    def write(self, snapshot):
+        write_atomically(self.filename, json.dumps(snapshot.to_json()))
+
+    def install(self, snapshot):
+        for name, part in self.parts.items():
+            if name in snapshot.state:
+                part.restore(snapshot.state[name])
+        self.latest = snapshot
+        self.log.restore(snapshot.index)
+
+    def adopt(self, snapshot):
+        """
+        Installs a snapshot taken by another agent and keeps it as our own.
+        """
+        self.install(snapshot)
+        if self.filename:
+            self.write(snapshot)
+        for listener in self.listeners:
+            listener(snapshot)
+        logger.info("Adopted a snapshot at slot %s", snapshot.index)
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as fp:
+            snapshot = Snapshot.from_json(json.load(fp))
+        self.install(snapshot)
+        logger.info("Loaded the snapshot at slot %s", snapshot.index)
+        return snapshot
+
+    def report(self):
+        return {
+            'index': self.latest.index,
+            'every': self.every
+        }
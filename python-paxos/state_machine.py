@@ -0,0 +1,157 @@
+import logging
+
+import tornado.gen
+import tornado.ioloop
+import tornado.locks
+
+from batching import unbatch
+from fast import FAST_PREDICATE, unorder
+from models import Learn, Prepare
+from slot_log import NOOP_PREDICATE
+
+logger = logging.getLogger('agent')
+
+
+class KeyValueStore:
+    """
+    Applies learned writes to a map of keys to values, in slot order, so
+    reads can be served from memory.
+
+    Supported predicates are `set`, `delete`, `incr` (adds `argument`, 1 by
+    default) and `append` (extends a list or string). Each key remembers the
+    slot that last wrote it as its version.
+
+    A fast write may be ordered into the log more than once, if its proposer
+    was slow to do it and an acceptor stepped in. `ordered` maps the ballot
+    of every fast write applied since the snapshot before last to its slot,
+    so only the first copy is applied.
+
+    A client write can end up in the log more than once too, if it was
+    retried on another agent after the first one proposed it. `written` maps
+    the `(client_id, sequence)` of every such write applied since the
+    snapshot before last to its slot, and later copies are skipped.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.applied = tornado.locks.Condition()
+        self.clear()
+        log.appliers.append(self.apply)
+
+    def clear(self):
+        self.values = {}
+        self.versions = {}
+        self.ordered = {}
+        self.written = {}
+        self.horizon = -1
+
+    def apply(self, learn):
+        slot = self.log.apply_index
+        if learn.prepare.predicate == FAST_PREDICATE:
+            writes = self.first_copies(unorder(learn.prepare), slot)
+        else:
+            writes = self.first_writes(unbatch(learn.prepare), slot)
+        for prepare in writes:
+            self.execute(prepare, slot)
+        self.applied.notify_all()
+
+    def first_copies(self, prepares, slot):
+        for prepare in prepares:
+            if prepare.id not in self.ordered:
+                self.ordered[prepare.id] = slot
+                yield prepare
+
+    def first_writes(self, prepares, slot):
+        for prepare in prepares:
+            if prepare.client_id is None:
+                yield prepare
+            elif (prepare.client_id, prepare.sequence) not in self.written:
+                self.written[(prepare.client_id, prepare.sequence)] = slot
+                yield prepare
+
+    def without_copies(self, learn, slot):
+        """
+        `learn` as it was applied at `slot`: without the writes that were
+        skipped as copies of ones applied at an earlier slot.
+
+        :return: The `Learn`, or None if every write in it was a copy.
+        """
+        prepare = learn.prepare
+        if prepare.predicate == FAST_PREDICATE:
+            firsts = [self.ordered.get(write.id, slot) == slot for write in unorder(prepare)]
+        else:
+            firsts = [write.client_id is None or
+                      self.written.get((write.client_id, write.sequence), slot) == slot
+                      for write in unbatch(prepare)]
+        if all(firsts):
+            return learn
+        if not any(firsts):
+            return None
+        return Learn(prepare=Prepare(**dict(prepare.to_json(), argument=[
+            entry for entry, first in zip(prepare.argument, firsts) if first])))
+
+    def execute(self, prepare, slot):
+        key, predicate, argument = prepare.key, prepare.predicate, prepare.argument
+        if predicate == NOOP_PREDICATE:
+            return
+        elif predicate == 'set':
+            self.values[key] = argument
+        elif predicate == 'delete':
+            self.values.pop(key, None)
+        elif predicate == 'incr':
+            self.values[key] = self.values.get(key, 0) + (1 if argument is None else argument)
+        elif predicate == 'append':
+            current = self.values.get(key)
+            if current is None:
+                current = '' if isinstance(argument, str) else []
+            if isinstance(current, list):
+                self.values[key] = current + [argument]
+            else:
+                self.values[key] = current + argument
+        else:
+            logger.warning("Skipping unknown predicate %s at slot %s", predicate, slot)
+            return
+        self.versions[key] = slot
+
+    def get(self, key):
+        """
+        :return: A `(value, version)` pair, or `(None, None)` for a missing key.
+        """
+        if key not in self.values:
+            return None, None
+        return self.values[key], self.versions[key]
+
+    @tornado.gen.coroutine
+    def wait_for(self, index, timeout):
+        """
+        Waits until every slot up to `index` has been applied.
+
+        :return: False if that took longer than `timeout` seconds.
+        """
+        deadline = tornado.ioloop.IOLoop.current().time() + timeout
+        while self.log.apply_index < index:
+            woken = yield self.applied.wait(timeout=deadline)
+            if not woken:
+                raise tornado.gen.Return(self.log.apply_index >= index)
+        raise tornado.gen.Return(True)
+
+    def snapshot(self):
+        return {'values': dict(self.values), 'versions': dict(self.versions),
+                'ordered': sorted(self.ordered.items()),
+                'written': [[client_id, sequence, slot] for (client_id, sequence), slot
+                            in sorted(self.written.items(), key=lambda item: item[1])]}
+
+    def restore(self, state):
+        self.values = dict(state['values'])
+        self.versions = dict(state['versions'])
+        self.ordered = dict(state.get('ordered', []))
+        self.written = {(client_id, sequence): slot
+                        for client_id, sequence, slot in state.get('written', [])}
+
+    def compact(self, index):
+        self.ordered = {id: slot for id, slot in self.ordered.items() if slot > self.horizon}
+        self.written = {write: slot for write, slot in self.written.items() if slot > self.horizon}
+        self.horizon = index
+
+    def report(self):
+        return {'keys': len(self.values)}
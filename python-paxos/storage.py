@@ -0,0 +1,212 @@
+"""
+Durable acceptor state. Every promise, accept and learn is appended to a file
+of fixed-width records that is mmapped in, the same layout trick as
+`persistence/memory-map.py`. Writers share fsyncs: any number of records
+appended while a flush is in progress are made durable by the next one.
+"""
+import collections
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from models import Prepare
+from snapshot import fsync_directory
+
+logger = logging.getLogger('agent')
+
+PROMISED = b'P'
+PROPOSED = b'R'
+ELECTED = b'E'
+ACCEPTED = b'A'
+LEARNED = b'L'
+FAST_ACCEPTED = b'F'
+WITHDRAWN = b'W'
+
+# kind, ballot, slot, payload length
+HEADER = struct.Struct('<cqqI')
+RECORD_SIZE = 256
+GROW_BY = 4096
+
+
+class AcceptorStore:
+    """
+    An append-only log of `RECORD_SIZE` byte records. A record's payload is the
+    JSON of its `Prepare`; payloads that don't fit in one record run on into
+    as many following records as they need.
+    """
+
+    def __init__(self, filename, record_size=RECORD_SIZE):
+        self.filename = filename
+        self.record_size = record_size
+        self.capacity = record_size - HEADER.size
+        self.waiting = []
+        self.flushing = False
+        self.rewriting = False
+        self.flushes = collections.Counter()
+        self.latencies = collections.deque(maxlen=1000)
+        self.fp = open(filename, 'a+b')
+        if os.fstat(self.fp.fileno()).st_size == 0:
+            os.ftruncate(self.fp.fileno(), GROW_BY * record_size)
+        self.mapped = mmap.mmap(self.fp.fileno(), 0)
+        self.records = 0
+
+    @tornado.gen.coroutine
+    def rewrite(self, records):
+        """
+        Replaces the whole store with `records`. Used after a snapshot to drop
+        everything the snapshot covers. The new file is written, synced and
+        renamed into place on an executor, like the group fsync. Records
+        appended meanwhile are carried over, and flushes wait until they are
+        in the new file.
+
+        :param records: `(kind, prepare)` pairs, read before the first yield.
+        :return: False if a flush or another rewrite was in progress and
+            nothing was done.
+        """
+        if self.flushing or self.rewriting:
+            raise tornado.gen.Return(False)
+        self.rewriting = True
+        records, since = list(records), self.records
+        try:
+            fresh = yield tornado.ioloop.IOLoop.current().run_in_executor(
+                None, self.replacement, records)
+        finally:
+            self.rewriting = False
+            if self.waiting: # Runs after the swap below.
+                tornado.ioloop.IOLoop.current().spawn_callback(self.flush)
+        fresh.extend(self.mapped[since * self.record_size:self.records * self.record_size])
+        self.mapped.close()
+        self.fp.close()
+        self.fp, self.mapped, self.records = fresh.fp, fresh.mapped, fresh.records
+        raise tornado.gen.Return(True)
+
+    def replacement(self, records):
+        """
+        :return: A new store holding `records`, on disk in place of this one.
+        """
+        tmp = self.filename + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        fresh = AcceptorStore(tmp, self.record_size)
+        for kind, prepare in records:
+            fresh.append(kind, prepare)
+        fresh.mapped.flush()
+        os.fsync(fresh.fp.fileno())
+        os.rename(tmp, self.filename)
+        fsync_directory(self.filename)
+        fresh.filename = self.filename
+        return fresh
+
+    def extend(self, data):
+        """
+        Appends whole records copied from another store with the same
+        record size.
+        """
+        end = self.records * self.record_size + len(data)
+        if end > len(self.mapped):
+            self.mapped.resize(end + GROW_BY * self.record_size)
+        start = self.records * self.record_size
+        self.mapped[start:end] = data
+        self.records += len(data) // self.record_size
+
+    def close(self):
+        self.mapped.flush()
+        self.mapped.close()
+        self.fp.close()
+
+    def records_for(self, length):
+        return max(1, -(-(HEADER.size + length) // self.record_size))
+
+    def replay(self):
+        """
+        Yields every (kind, prepare) in the order it was appended, and leaves
+        the store positioned to append after the last of them.
+        """
+        idx, size = 0, len(self.mapped)
+        while (idx + 1) * self.record_size <= size:
+            start = idx * self.record_size
+            kind, ballot, slot, length = HEADER.unpack_from(self.mapped, start)
+            if kind == b'\x00':
+                break
+            payload = self.mapped[start + HEADER.size:start + HEADER.size + length]
+            try:
+                prepare = Prepare(**json.loads(payload.decode('utf-8')))
+            except ValueError:
+                logger.warning("Discarding torn record %s in %s", idx, self.filename)
+                break
+            idx += self.records_for(length)
+            yield kind, prepare
+        self.records = idx
+
+    def append(self, kind, prepare):
+        payload = json.dumps(prepare.to_json()).encode('utf-8')
+        needed = self.records_for(len(payload))
+        end = (self.records + needed) * self.record_size
+        if end > len(self.mapped):
+            self.mapped.resize(end + GROW_BY * self.record_size)
+        start = self.records * self.record_size
+        slot = -1 if prepare.slot is None else prepare.slot
+        # Header last, so a torn write never looks like a whole record.
+        self.mapped[start + HEADER.size:start + HEADER.size + len(payload)] = payload
+        HEADER.pack_into(self.mapped, start, kind, prepare.id, slot, len(payload))
+        self.records += needed
+
+    def sync(self):
+        """
+        :return: A future that resolves once everything appended so far is
+            on disk.
+        """
+        future = tornado.concurrent.Future()
+        self.waiting.append((future, time.time()))
+        if not self.flushing and not self.rewriting: # A rewrite flushes when it's done.
+            tornado.ioloop.IOLoop.current().spawn_callback(self.flush)
+        return future
+
+    @tornado.gen.coroutine
+    def flush(self):
+        if self.flushing or self.rewriting:
+            return
+        self.flushing = True
+        io_loop = tornado.ioloop.IOLoop.current()
+        try:
+            while self.waiting:
+                batch, self.waiting = self.waiting, []
+                try:
+                    yield io_loop.run_in_executor(None, os.fsync, self.fp.fileno())
+                except Exception as e:
+                    logger.error("fsync of %s failed: %s", self.filename, e)
+                    for future, _ in batch:
+                        future.set_exception(e)
+                    continue
+                now = time.time()
+                self.flushes[len(batch)] += 1
+                for future, started in batch:
+                    self.latencies.append(now - started)
+                    future.set_result(None)
+        finally:
+            self.flushing = False
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        flushes = sum(self.flushes.values())
+        synced = sum(size * count for size, count in self.flushes.items())
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            'records': self.records,
+            'flushes': flushes,
+            'mean_batch': float(synced) / flushes if flushes else 0.0,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99)
+        }
@@ -1,15 +1,40 @@
+import collections
 import unittest
 import mock
 import json
+import os
+import random
+import shutil
+import tempfile
+import time
 
 import tornado.testing
 import tornado.httpclient
 import tornado.concurrent
+import tornado.httputil
+import tornado.iostream
 
 import agent
+import simulator
+from client import Router
+from backoff import Backoff
+from batching import Batcher, batched, unbatch
+from catchup import CatchUp
+from dedup import Dedup
+from fast import FAST_PREDICATE, ordered
+from groups import group_port
+from metrics import Metrics, HISTOGRAM
+from codec import BINARY, JSON, codec_for
+from settings import GROUP_PORT_OFFSET, QUORUM_SPARE
+from slot_log import NOOP_PREDICATE, Holes, SlotLog, Window
+from snapshot import Snapshotter
+from state_machine import KeyValueStore
+from storage import ACCEPTED, AcceptorStore, LEARNED, PROMISED
+from transport import PeerConnection, PeerServer
 from models import (
-    Accept, Agent, Agents, agents, Learn, Phase, Prepare, Promise,
-    Promises, Propose, Success
+    Accept, Agent, Agents, agents, ballot_node, ballot_round, Elect, Elected,
+    FastAccept, LeaderPromise, Learn, make_ballot, Phase, Prepare, Promise, Promises,
+    Propose, Success, Withdraw
 )
 
 
@@ -51,6 +76,7 @@ class TestPhase(tornado.testing.AsyncTestCase):
 
         fut = tornado.concurrent.Future()
         response = mock.Mock()
+        response.code = 200
         response.body = json.dumps(phase.to_json())
         fut.set_result(response)
 
@@ -80,6 +106,7 @@ class TestPhase(tornado.testing.AsyncTestCase):
 
         fut = tornado.concurrent.Future()
         response = mock.Mock()
+        response.code = 200
         response.body = json.dumps(phase.to_json())
         fut.set_result(response)
 
@@ -90,8 +117,51 @@ class TestPhase(tornado.testing.AsyncTestCase):
         client.fetch.return_value = fut
         with mock.patch('tornado.httpclient.AsyncHTTPClient',
                         return_value=client):
-            responses = yield phase.send(agents.quorum())
+            responses, issued, conflicting = yield phase.send(agents.quorum())
             self.assertEqual(len(responses), len(agents.quorum()))
+            self.assertEqual(len(issued), len(agents.quorum()))
+
+    @tornado.testing.gen_test
+    def test_send_returns_once_required_have_issued(self):
+        phase = Phase(prepare=Prepare(id=1, key='foo'))
+        phase.endpoint = '/testing'
+        response = mock.Mock()
+        response.code = 200
+        answered = tornado.concurrent.Future()
+        answered.set_result(response)
+        slow = tornado.concurrent.Future()
+        quorum = [Agent('http://slow', 1), Agent('http://fast', 2),
+                  Agent('http://fast', 3)]
+
+        def send(agent, message):
+            return slow if agent.url == 'http://slow' else answered
+
+        with mock.patch('models.Agent.send', autospec=True, side_effect=send):
+            responses, issued, conflicting = yield phase.send(
+                quorum, required=2, timeout=5)
+        self.assertEqual(len(issued), 2)
+        self.assertFalse(slow.done())
+
+    @tornado.testing.gen_test
+    def test_send_returns_at_once_when_no_reply_is_required(self):
+        phase = Phase(prepare=Prepare(id=1, key='foo'))
+        phase.endpoint = '/testing'
+        never = tornado.concurrent.Future()
+        with mock.patch('models.Agent.send', return_value=never) as send:
+            responses, issued, conflicting = yield phase.send(
+                agents.all()[:1], required=0, timeout=5)
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(issued, [])
+
+    @tornado.testing.gen_test
+    def test_send_gives_up_after_timeout(self):
+        phase = Phase(prepare=Prepare(id=1, key='foo'))
+        phase.endpoint = '/testing'
+        never = tornado.concurrent.Future()
+        with mock.patch('models.Agent.send', return_value=never):
+            responses, issued, conflicting = yield phase.send(
+                agents.all(), timeout=0.01)
+        self.assertEqual(responses, [])
 
 
 class TestSubclasses(tornado.testing.AsyncTestCase):
@@ -100,6 +170,7 @@ class TestSubclasses(tornado.testing.AsyncTestCase):
     def assert_send_works(self, obj, expected_endpoint):
         fut = tornado.concurrent.Future()
         response = mock.Mock()
+        response.code = 200
         response.body = '{}'
         fut.set_result(response)
 
@@ -113,7 +184,7 @@ class TestSubclasses(tornado.testing.AsyncTestCase):
             with mock.patch('tornado.httpclient.AsyncHTTPClient',
                             return_value=client):
                 agent = agents.all()[0]
-                responses = yield obj.send([agent])
+                responses, issued, conflicting = yield obj.send([agent])
                 self.assertEqual(len(responses), 1)
                 req.assert_any_call(
                     url=agent.url + ':' + str(agent.port) + obj.endpoint,
@@ -128,7 +199,7 @@ class TestSubclasses(tornado.testing.AsyncTestCase):
         prepare = Prepare(id=3, key='biz', predicate='set', argument='a')
         self.assertEqual(prepare.to_json(), {
             'id': 3, 'key': 'biz', 'predicate': 'set', 'argument': 'a'})
-        target = Prepare._id
+        target = make_ballot(Prepare._round, Prepare.node_id)
         prepare = Prepare(key='buzz', predicate='a', argument='b')
         self.assertEqual(prepare.to_json(), {
             'id': target, 'key': 'buzz', 'predicate': 'a', 'argument': 'b'})
@@ -210,6 +281,359 @@ class TestContainers(tornado.testing.AsyncTestCase):
         self.assertEqual(promises.highest_numbered(key='biz').to_json(),
                          promise3.to_json())
 
+    def test_promises_track_the_highest_ballot_through_removals(self):
+        promises = Promises([Promise(prepare=Prepare(id=id, key=key, predicate='set', argument=id))
+                             for key, id in [('biz', 1), ('biz', 5), ('baz', 3), ('baz', 4)]])
+        promises.compact(0)
+        self.assertEqual(len(promises), 2)
+        promises.add(Promise(prepare=Prepare(id=2, key='biz', predicate='set', argument=2)))
+        promises.remove(Prepare(id=5, key='biz', predicate='set', argument=5))
+        self.assertEqual(promises.highest_numbered().prepare.id, 4)
+        self.assertEqual(promises.get('biz').prepare.id, 2)
+        promises.remove(Prepare(id=4, key='baz', predicate='set', argument=4))
+        self.assertEqual(promises.highest_numbered().prepare.id, 2)
+        self.assertIsNone(promises.get('baz'))
+
+    def test_one_ballot_can_be_promised_for_keys_of_any_type(self):
+        promises = Promises([Promise(prepare=Prepare(id=7, key=key, slot=slot))
+                             for slot, key in enumerate(['foo', None, 'bar'])])
+        self.assertEqual(promises.highest_numbered().prepare.id, 7)
+        promises.remove(Prepare(id=7, key='foo'))
+        promises.reindex()
+        self.assertEqual(len(promises), 2)
+
+
+class TestCodec(unittest.TestCase):
+
+    def round_trip(self, message):
+        return BINARY.decode(type(message), BINARY.encode(message))
+
+    def test_binary_round_trips_prepares(self):
+        prepare = Prepare(slot=7, **batched('foo', [
+            {'key': 'foo', 'predicate': 'set', 'argument': [1, 2.5, None, True]},
+            {'key': 'foo', 'predicate': 'set', 'argument': {'a': 'ü', 'b': 2 ** 70}},
+        ]))
+        self.assertEqual(self.round_trip(prepare).to_json(), prepare.to_json())
+        slotless = Prepare(id=3, key='biz', predicate='set', argument='a')
+        self.assertEqual(self.round_trip(slotless).to_json(), slotless.to_json())
+        identified = Prepare(id=3, key='biz', predicate='set', argument='a', client_id='c', sequence=4)
+        self.assertEqual(self.round_trip(identified).to_json(), identified.to_json())
+
+    def test_binary_round_trips_replies(self):
+        prepare = Prepare(id=3, key='biz', predicate='set', argument='a', slot=1)
+        elected = Elected(prepare=prepare, accepted=[prepare])
+        self.assertEqual(self.round_trip(elected).to_json(), elected.to_json())
+        success = Success(prepare=prepare)
+        self.assertEqual(self.round_trip(success).to_json(), success.to_json())
+        self.assertLess(len(BINARY.encode(success)), len(JSON.encode(success)))
+
+    def test_unknown_content_types_fall_back_to_json(self):
+        self.assertIs(codec_for('application/x-paxos; charset=binary'), BINARY)
+        self.assertIs(codec_for('text/plain'), JSON)
+        self.assertIs(codec_for(None), JSON)
+
+
+class TestQuorum(tornado.testing.AsyncTestCase):
+
+    def cluster(self, *rtts):
+        cluster = Agents([Agent('http://127.0.0.1', port) for port in range(len(rtts))])
+        for agent, rtt in zip(cluster.all(), rtts):
+            if rtt is not None:
+                agent.observe(rtt, ok=True)
+        return cluster
+
+    @mock.patch('models.PROBE_RATE', 0)
+    def test_prefers_the_fastest_healthy_agents(self):
+        cluster = self.cluster(0.5, 0.01, 0.2, 0.02, 0.03)
+        self.assertEqual([a.port for a in cluster.quorum()], [1, 3, 4])
+        for _ in range(5):
+            cluster.all()[1].observe(None, ok=False)
+        self.assertFalse(cluster.all()[1].healthy)
+        self.assertEqual([a.port for a in cluster.quorum(excluding=3, size=2)], [4, 2])
+
+    def test_flexible_quorums_must_intersect(self):
+        cluster = self.cluster(*[0.01] * 5)
+        self.assertEqual((cluster.phase1, cluster.phase2), (3, 3))
+        cluster.set_quorums(phase1=4, phase2=2)
+        self.assertEqual((cluster.phase1, cluster.phase2), (4, 2))
+        with self.assertRaises(ValueError):
+            cluster.set_quorums(phase1=3, phase2=2)
+        with self.assertRaises(ValueError):
+            cluster.set_quorums(phase1=6, phase2=1)
+
+    def test_fast_quorums_intersect_both_phases(self):
+        cluster = self.cluster(*[0.01] * 5)
+        self.assertEqual(cluster.fast, 3)
+        cluster.set_quorums(phase1=4, phase2=2)
+        self.assertEqual(cluster.fast, 4)
+        with self.assertRaises(ValueError):
+            cluster.set_quorums(phase1=4, phase2=2, fast=3)
+
+    @mock.patch('models.PROBE_RATE', 0)
+    def test_unmeasured_agents_go_first(self):
+        cluster = self.cluster(0.01, None, 0.02)
+        self.assertEqual(cluster.quorum(size=1)[0].port, 1)
+
+    @mock.patch('models.PROBE_RATE', 1)
+    def test_probes_slower_agents(self):
+        cluster = self.cluster(0.01, 0.02, 0.5)
+        self.assertEqual([a.port for a in cluster.quorum(size=2)], [0, 2])
+
+    @tornado.testing.gen_test
+    def test_send_tracks_round_trips_and_errors(self):
+        peer = Agent('http://127.0.0.1', 1)
+        peer.connection = mock.Mock()
+        failed = tornado.concurrent.Future()
+        failed.set_exception(IOError("unreachable"))
+        peer.connection.fetch.return_value = failed
+        with self.assertRaises(IOError):
+            yield peer.send(Learn(prepare=Prepare(id=1)))
+        answered = tornado.concurrent.Future()
+        answered.set_result(mock.Mock(code=200))
+        peer.connection.fetch.return_value = answered
+        yield peer.send(Learn(prepare=Prepare(id=1)))
+        report = peer.report()
+        self.assertEqual(report['samples'], 2)
+        self.assertGreater(report['error_rate'], 0)
+        self.assertIsNotNone(report['rtt_ms'])
+
+
+class TestBackoff(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_delays_grow_and_are_capped(self):
+        backoff = Backoff(base=0.001, cap=0.004, deadline=1)
+        deadline = backoff.start()
+        with mock.patch('random.uniform', side_effect=lambda low, high: high) as uniform:
+            for attempt in range(1, 5):
+                self.assertTrue((yield backoff.wait(attempt, deadline)))
+        self.assertEqual([call[0][1] for call in uniform.call_args_list],
+                         [0.002, 0.004, 0.004, 0.004])
+        self.assertEqual(backoff.report()['writes_retried'], 1)
+        self.assertEqual(backoff.report()['retries'], 4)
+
+    @tornado.testing.gen_test
+    def test_gives_up_at_the_deadline(self):
+        backoff = Backoff(base=10, cap=10, deadline=0.01)
+        with mock.patch('random.uniform', return_value=1):
+            retrying = yield backoff.wait(1, backoff.start())
+        self.assertFalse(retrying)
+        self.assertEqual(backoff.report()['gave_up'], 1)
+
+
+class TestDedup(tornado.testing.AsyncTestCase):
+
+    def done(self, value):
+        fut = tornado.concurrent.Future()
+        fut.set_result(value)
+        return fut
+
+    @tornado.testing.gen_test
+    def test_a_retry_gets_the_first_outcome(self):
+        dedup = Dedup(size=10)
+        write = mock.Mock(return_value=self.done('first'))
+        self.assertEqual((yield dedup.run(('c', 0), write)), 'first')
+        self.assertEqual((yield dedup.run(('c', 0), write)), 'first')
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(dedup.report()['hits'], 1)
+
+    @tornado.testing.gen_test
+    def test_a_retry_waits_for_a_write_in_flight(self):
+        dedup = Dedup(size=10)
+        running = tornado.concurrent.Future()
+        write = mock.Mock(return_value=running)
+        first, second = dedup.run(('c', 0), write), dedup.run(('c', 0), write)
+        running.set_result('first')
+        self.assertEqual((yield [first, second]), ['first', 'first'])
+        self.assertEqual(write.call_count, 1)
+
+    @tornado.testing.gen_test
+    def test_failed_writes_are_forgotten(self):
+        dedup = Dedup(size=10)
+        failed = tornado.concurrent.Future()
+        failed.set_exception(ValueError())
+        write = mock.Mock(side_effect=[failed, self.done('second')])
+        with self.assertRaises(ValueError):
+            yield dedup.run(('c', 0), write)
+        self.assertEqual((yield dedup.run(('c', 0), write)), 'second')
+        self.assertEqual(write.call_count, 2)
+
+    @tornado.testing.gen_test
+    def test_a_write_that_may_be_chosen_is_not_forgotten_until_settled(self):
+        dedup = Dedup(size=10)
+        error = ValueError()
+        error.unsettled = 3
+        failed = tornado.concurrent.Future()
+        failed.set_exception(error)
+        write = mock.Mock(side_effect=[failed, self.done('second')])
+        with self.assertRaises(ValueError):
+            yield dedup.run(('c', 0), write)
+        with self.assertRaises(ValueError):
+            yield dedup.run(('c', 0), write)
+        dedup.settled(3)
+        self.assertEqual((yield dedup.run(('c', 0), write)), 'second')
+        self.assertEqual(write.call_count, 2)
+
+    @tornado.testing.gen_test
+    def test_evicts_the_least_recently_used(self):
+        dedup = Dedup(size=2)
+        for sequence in range(3):
+            yield dedup.run(('c', sequence), lambda: self.done(sequence))
+        self.assertEqual(list(dedup.results), [('c', 1), ('c', 2)])
+
+
+class TestBallots(unittest.TestCase):
+
+    def setUp(self):
+        self.round, self.node_id = Prepare._round, Prepare.node_id
+
+    def tearDown(self):
+        Prepare._round, Prepare.node_id = self.round, self.node_id
+
+    def test_ballots_are_unique_per_node_and_ordered_by_round(self):
+        Prepare.node_id = 2
+        mine = Prepare().id
+        self.assertEqual(ballot_node(mine), 2)
+        self.assertGreater(make_ballot(ballot_round(mine) + 1, 0), mine)
+        self.assertNotEqual(mine, make_ballot(ballot_round(mine), 1))
+
+    def test_observing_a_ballot_moves_past_it(self):
+        Prepare.node_id = 0
+        theirs = make_ballot(Prepare._round + 10, 1)
+        Prepare.observe(theirs)
+        self.assertGreater(Prepare().id, theirs)
+
+
+class TestBatcher(tornado.testing.AsyncTestCase):
+
+    def committer(self):
+        committed = []
+
+        @tornado.gen.coroutine
+        def commit(request):
+            committed.append(request)
+            raise tornado.gen.Return(
+                Success(prepare=Prepare(id=7, slot=3, **request)))
+        return commit, committed
+
+    @tornado.testing.gen_test
+    def test_full_batch_commits_as_one_instance(self):
+        commit, committed = self.committer()
+        batcher = Batcher(commit, max_size=3, linger=1000)
+        futures = [batcher.submit({'key': 'foo', 'predicate': 'incr', 'argument': i})
+                   for i in range(3)]
+        successes = yield futures
+        self.assertEqual(len(committed), 1)
+        self.assertEqual([s.prepare.argument for s in successes], [0, 1, 2])
+        self.assertEqual({s.prepare.id for s in successes}, {7})
+        self.assertEqual(batcher.report()['sizes'], {'3': 1})
+
+    @tornado.testing.gen_test
+    def test_linger_flushes_partial_batches_per_key(self):
+        commit, committed = self.committer()
+        batcher = Batcher(commit, max_size=10, linger=1)
+        foo = batcher.submit({'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        bar = batcher.submit({'key': 'bar', 'predicate': 'set', 'argument': 'b'})
+        successes = yield [foo, bar]
+        self.assertEqual(len(committed), 2)
+        self.assertEqual(successes[1].prepare.key, 'bar')
+        self.assertEqual(batcher.report()['mean'], 1.0)
+
+    @tornado.testing.gen_test
+    def test_failures_reach_every_waiting_write(self):
+        @tornado.gen.coroutine
+        def commit(request):
+            raise tornado.web.HTTPError(500)
+        batcher = Batcher(commit, max_size=2, linger=1000)
+        futures = [batcher.submit({'key': 'foo', 'predicate': 'set', 'argument': i})
+                   for i in range(2)]
+        for future in futures:
+            with self.assertRaises(tornado.web.HTTPError):
+                yield future
+
+    def test_unbatch_round_trips(self):
+        requests = [{'key': 'foo', 'predicate': 'set', 'argument': i} for i in range(2)]
+        prepare = Prepare(id=1, slot=4, **batched('foo', requests))
+        self.assertEqual([p.to_json() for p in unbatch(prepare)],
+                         [Prepare(id=1, slot=4, **r).to_json() for r in requests])
+
+
+class TestAcceptorStore(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(TestAcceptorStore, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'acceptor.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(TestAcceptorStore, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_replays_what_was_appended(self):
+        store = AcceptorStore(self.filename, record_size=64)
+        written = [
+            (PROMISED, Prepare(id=1, key='foo', predicate='set', argument='a')),
+            (ACCEPTED, Prepare(id=2, key='foo', predicate='set', argument='x' * 500, slot=0)),
+            (LEARNED, Prepare(id=2, key='foo', predicate='set', argument='b', slot=1)),
+        ]
+        for kind, prepare in written:
+            store.append(kind, prepare)
+        yield store.sync()
+        store.close()
+
+        store = AcceptorStore(self.filename, record_size=64)
+        replayed = list(store.replay())
+        self.assertEqual([(k, p.to_json()) for k, p in replayed],
+                         [(k, p.to_json()) for k, p in written])
+        store.append(LEARNED, Prepare(id=3, key='bar', slot=2))
+        store.close()
+        store = AcceptorStore(self.filename, record_size=64)
+        self.assertEqual(len(list(store.replay())), 4)
+        store.close()
+
+    @tornado.testing.gen_test
+    def test_concurrent_syncs_share_a_flush(self):
+        store = AcceptorStore(self.filename)
+        with mock.patch('os.fsync') as fsync:
+            futures = []
+            for i in range(10):
+                store.append(ACCEPTED, Prepare(id=i, key='foo', slot=i))
+                futures.append(store.sync())
+            yield futures
+        self.assertEqual(fsync.call_count, 1)
+        self.assertEqual(store.report()['mean_batch'], 10.0)
+        store.close()
+
+    @tornado.testing.gen_test
+    def test_rewrites_off_the_loop_and_keeps_what_was_appended_meanwhile(self):
+        store = AcceptorStore(self.filename, record_size=64)
+        for i in range(3):
+            store.append(LEARNED, Prepare(id=i, key='foo', slot=i))
+        live = [(PROMISED, Prepare(id=9, key='foo'))]
+        rewriting = store.rewrite(live)
+        self.assertFalse(rewriting.done())
+        store.append(ACCEPTED, Prepare(id=10, key='foo', argument='x' * 100, slot=3))
+        synced = store.sync()
+        self.assertFalse((yield store.rewrite(live))) # One at a time.
+        self.assertTrue((yield rewriting))
+        self.assertFalse(synced.done()) # Its record is only in the new file now.
+        yield synced
+        store.close()
+        store = AcceptorStore(self.filename, record_size=64)
+        self.assertEqual([(kind, prepare.id) for kind, prepare in store.replay()],
+                         [(PROMISED, 9), (ACCEPTED, 10)])
+        store.close()
+
+    def test_grows_past_its_initial_size(self):
+        store = AcceptorStore(self.filename, record_size=64)
+        for i in range(5000):
+            store.append(LEARNED, Prepare(id=i, key='foo', slot=i))
+        store.close()
+        store = AcceptorStore(self.filename, record_size=64)
+        self.assertEqual(len(list(store.replay())), 5000)
+        store.close()
+
 
 class Base(tornado.testing.AsyncHTTPTestCase):
 
@@ -228,8 +652,35 @@ class Base(tornado.testing.AsyncHTTPTestCase):
     def setUp(self):
         agent.current_promises.clear()
         agent.completed_rounds.clear()
+        agent.leader_promise.clear()
+        agent.leader.clear()
+        agent.log.clear()
+        agent.window.clear()
+        agent.snapshotter.clear()
+        agent.kv.clear()
+        agents.set_quorums()
+        agent.catchup.clear()
+        agent.holes.clear()
+        agent.feed.clear()
+        agent.dedup.clear()
+        agent.unordered.clear()
+        agent.fast_paths.clear()
+        agent.accepted_at.clear()
+        agent.slot_ballots.clear()
+        agent.metrics.clear()
         super(Base, self).setUp()
 
+    def reply(self, code, message):
+        response = mock.Mock()
+        response.code = code
+        response.body = json.dumps(message.to_json())
+        return response
+
+    def sent(self, responses, issued, conflicting=None):
+        fut = tornado.concurrent.Future()
+        fut.set_result((responses, issued, conflicting or []))
+        return fut
+
 class TestProposer(Base):
 
     def test_allows_non_conflicting_writes(self):
@@ -239,22 +690,24 @@ class TestProposer(Base):
         prepare_success.code = 200
         prepare_success.body = json.dumps(promise.to_json())
         fut = tornado.concurrent.Future()
-        fut.set_result([prepare_success, prepare_success])
+        fut.set_result(([prepare_success, prepare_success],
+                        [prepare_success, prepare_success], []))
 
         propose_success = mock.Mock()
         propose_success.code = 200
         propose_success.body = json.dumps(Promise(prepare=prepare).to_json())
         propose_fut = tornado.concurrent.Future()
-        propose_fut.set_result([propose_success, propose_success])
+        propose_fut.set_result(([propose_success, propose_success],
+                                [propose_success, propose_success], []))
 
         learn_success = mock.Mock()
         learn_success.code = 200
         learn_success.body = ''
         learn_fut = tornado.concurrent.Future()
-        learn_fut.set_result([learn_success, learn_success])
+        learn_fut.set_result([learn_success] * len(agents.all()))
         with mock.patch('models.Prepare.send', return_value=fut) as send:
             with mock.patch('models.Propose.send', return_value=propose_fut) as propose_send:
-                with mock.patch('models.Learn.fanout', return_value=learn_fut) as learn_fanout:
+                with mock.patch('models.Learn.notify') as learn_fanout:
                     response = self.post('/write', body={
                         'key': 'foo',
                         'predicate': 'set',
@@ -262,6 +715,1215 @@ class TestProposer(Base):
 
         self.assertEqual(response.code, 200)
 
+    def test_moves_to_the_next_slot_when_another_proposer_has_it(self):
+        taken = self.reply(409, Promise(prepare=Prepare(
+            id=make_ballot(0, 2), key='bar', predicate='set', argument='b', slot=0)))
+        promised = self.reply(200, Promise())
+        learned = tornado.concurrent.Future()
+        learned.set_result([mock.Mock()] * len(agents.all()))
+        with mock.patch('models.Prepare.send', side_effect=[
+                self.sent([taken, promised], [promised]),
+                self.sent([promised] * 2, [promised] * 2)]) as send:
+            with mock.patch('models.Propose.send',
+                            return_value=self.sent([promised] * 2, [promised] * 2)):
+                with mock.patch('models.Learn.notify'):
+                    response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Success.from_response(response).prepare.slot, 1)
+        self.assertIsNone(agent.current_promises.at_slot(0))
+
+    def test_a_chosen_earlier_attempt_is_success(self):
+        ours = {'key': 'foo', 'predicate': 'set', 'argument': 'a', 'client_id': 'c', 'sequence': 7}
+        taken = self.reply(409, Promise(prepare=Prepare(id=make_ballot(0, 2), slot=0, **ours)))
+        with mock.patch('models.Prepare.send', return_value=self.sent([taken], [])) as send:
+            with mock.patch('models.Propose.send') as propose_send:
+                response = self.post('/write', body=ours)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Success.from_response(response).prepare.slot, 0)
+        self.assertEqual(send.call_count, 1)
+        self.assertFalse(propose_send.called)
+
+    def test_a_claim_is_not_repaired(self):
+        claim = self.reply(409, Promise(prepare=Prepare(id=make_ballot(0, 2), slot=0)))
+        promised = self.reply(200, Promise())
+        with mock.patch('models.Prepare.send', return_value=self.sent([claim, promised], [promised])):
+            with mock.patch('models.Propose.send',
+                            return_value=self.sent([promised] * 2, [promised] * 2)) as propose_send:
+                with mock.patch('models.Learn.notify'):
+                    response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(propose_send.call_count, 1)
+        self.assertEqual(Success.from_response(response).prepare.key, 'foo')
+
+    def test_retried_writes_are_committed_once(self):
+        success = Success(prepare=Prepare(key='foo', predicate='set', argument='a', slot=3))
+        committed = tornado.concurrent.Future()
+        committed.set_result(success)
+        body = {'key': 'foo', 'predicate': 'set', 'argument': 'a', 'client_id': 'c', 'sequence': 7}
+        with mock.patch('agent.commit', return_value=committed) as commit:
+            first = self.post('/write', body=body)
+            second = self.post('/write', body=body)
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(Success.from_response(second).prepare.slot, 3)
+
+    def test_a_retry_of_a_learned_write_gets_its_slot(self):
+        body = {'key': 'foo', 'predicate': 'set', 'argument': 'a', 'client_id': 'c', 'sequence': 7}
+        agent.log.learn(Learn(prepare=Prepare(id=make_ballot(0, 2), slot=0, **body)))
+        with mock.patch('agent.commit') as commit:
+            response = self.post('/write', body=body)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Success.from_response(response).prepare.slot, 0)
+        self.assertFalse(commit.called)
+
+    def test_a_claim_does_not_move_a_write_that_went_out(self):
+        agent.backoff.clear()
+        ours = {'key': 'foo', 'predicate': 'set', 'argument': 'a', 'client_id': 'c', 'sequence': 7}
+        promised = self.reply(200, Promise())
+        rejected = self.reply(400, Promise(prepare=Prepare(id=make_ballot(Prepare._round + 100, 2))))
+        claim = self.reply(409, Promise(prepare=Prepare(id=make_ballot(Prepare._round + 101, 2), slot=0)))
+        repaired = self.reply(409, Promise(prepare=Prepare(id=make_ballot(Prepare._round + 101, 2), slot=0, **ours)))
+        with mock.patch.object(agent.backoff, 'base', 0.001):
+            with mock.patch('models.Prepare.send', side_effect=[
+                    self.sent([promised] * 2, [promised] * 2),
+                    self.sent([claim] * 2, []),
+                    self.sent([repaired], [])]) as send:
+                with mock.patch('models.Propose.send',
+                                return_value=self.sent([rejected] * 2, [], [rejected] * 2)):
+                    with mock.patch('models.Learn.notify'):
+                        response = self.post('/write', body=ours)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Success.from_response(response).prepare.slot, 0)
+        self.assertEqual(send.call_count, 3)
+
+
+class TestWithdraw(Base):
+
+    def test_a_failed_write_withdraws_its_promises(self):
+        promised = self.reply(200, Promise())
+        with mock.patch('models.Prepare.send', return_value=self.sent([promised], [])):
+            with mock.patch('models.Withdraw.notify', autospec=True) as notify:
+                response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 500)
+        self.assertEqual(len(agent.current_promises), 0)
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(notify.call_args[0][0].prepare.key, 'foo')
+
+    def test_a_committed_write_leaves_nothing_to_withdraw(self):
+        promised = self.reply(200, Promise())
+        with mock.patch('models.Prepare.send', return_value=self.sent([promised] * 2, [promised] * 2)):
+            with mock.patch('models.Propose.send', return_value=self.sent([promised] * 2, [promised] * 2)):
+                with mock.patch('models.Learn.notify'):
+                    with mock.patch('models.Withdraw.notify') as notify:
+                        response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(agent.current_promises), 0)
+        self.assertFalse(notify.called)
+
+    def test_acceptor_drops_a_withdrawn_promise(self):
+        prepare = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=0)
+        self.assertEqual(self.post('/prepare', prepare.to_json()).code, 200)
+        self.assertEqual(len(agent.current_promises), 1)
+        self.assertEqual(self.post('/withdraw', Withdraw(prepare=prepare).to_json()).code, 200)
+        self.assertEqual(len(agent.current_promises), 0)
+
+
+class TestQuorums(Base):
+
+    def test_our_own_acceptor_counts_towards_a_majority(self):
+        peers, required = agent.quorum_for(agents.majority)
+        self.assertEqual(required, 1)
+        self.assertEqual(len(peers), 1 + QUORUM_SPARE)
+        self.assertNotIn(agent.options.port, [peer.port for peer in peers])
+
+
+class TestDuelingProposers(Base):
+
+    def test_backs_off_and_gives_up_when_pre_empted_until_the_deadline(self):
+        agent.backoff.clear()
+        rejected = self.reply(400, Promise(prepare=Prepare(id=make_ballot(1000, 2))))
+        with mock.patch.object(agent.backoff, 'deadline', 0.05):
+            with mock.patch.object(agent.backoff, 'base', 0.005):
+                with mock.patch('models.Prepare.send',
+                                side_effect=lambda *a: self.sent([rejected] * 2, [], [rejected] * 2)) as send:
+                    response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 503)
+        report = agent.backoff.report()
+        self.assertEqual(report['writes_retried'], 1)
+        self.assertEqual(report['retries'], send.call_count - 1)
+        self.assertEqual(report['gave_up'], 1)
+        self.assertGreater(Prepare().id, make_ballot(1000, 2))
+        self.assertIsNone(agent.current_promises.get('foo'))
+
+
+class TestRouter(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return agent.get_app()
+
+    def test_keys_stick_to_one_agent(self):
+        router = Router('http://127.0.0.1', [1, 2, 3])
+        self.assertEqual(router.route('foo'), router.route('foo'))
+        self.assertEqual(sorted(router.route('foo')), sorted(router.urls))
+        self.assertEqual(len({router.route('key-{}'.format(i))[0] for i in range(30)}), 3)
+
+    @tornado.testing.gen_test
+    def test_fails_over_to_the_next_agent(self):
+        sock, closed = tornado.testing.bind_unused_port()
+        sock.close()
+        router = Router('http://127.0.0.1', [closed, self.get_http_port()])
+        key = next(k for k in ('key-{}'.format(i) for i in range(100))
+                   if router.route(k)[0].endswith(str(closed)))
+        with mock.patch('agent.commit', return_value=self.committed()):
+            response = yield router.write(key, 'set', 'a')
+        self.assertEqual(response.code, 200)
+
+    def response(self, url, code, headers=None):
+        fut = tornado.concurrent.Future()
+        fut.set_result(tornado.httpclient.HTTPResponse(
+            tornado.httpclient.HTTPRequest(url), code,
+            headers=tornado.httputil.HTTPHeaders(headers or {})))
+        return fut
+
+    @tornado.testing.gen_test
+    def test_retries_a_timed_out_write_on_the_same_agent(self):
+        router = Router('http://127.0.0.1', [1, 2, 3], retries=2)
+        url = router.route('foo')[0] + '/write'
+        timeout = tornado.httpclient.HTTPClientError(599)
+        with mock.patch.object(router.client, 'fetch',
+                               side_effect=[timeout, timeout, self.response(url, 200)]) as fetch:
+            response = yield router.write('foo', 'set', 'a')
+        self.assertEqual(response.code, 200)
+        self.assertEqual([call[0][0] for call in fetch.call_args_list], [url] * 3)
+        self.assertEqual(len({call[1]['body'] for call in fetch.call_args_list}), 1)
+
+    @tornado.testing.gen_test
+    def test_follows_a_redirect_to_the_leader(self):
+        router = Router('http://127.0.0.1', [1, 2, 3])
+        first, leader = router.route('foo')[:2]
+        with mock.patch.object(router.client, 'fetch', side_effect=[
+                self.response(first, 503, {'X-Leader': leader}),
+                self.response(leader, 200)]) as fetch:
+            response = yield router.write('foo', 'set', 'a')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(fetch.call_args_list[1][0][0], leader + '/write')
+
+    def committed(self):
+        fut = tornado.concurrent.Future()
+        fut.set_result(Success(prepare=Prepare(key='foo', predicate='set', argument='a', slot=0)))
+        return fut
+
+
+class TestMultiPaxos(Base):
+
+    def learned(self):
+        fut = tornado.concurrent.Future()
+        fut.set_result([mock.Mock()] * len(agents.all()))
+        return fut
+
+    def test_leader_skips_phase_one_once_elected(self):
+        elected = self.reply(200, Elected(prepare=Prepare(id=0, slot=0)))
+        accepted = self.reply(200, Accept(prepare=self.get_prepare()))
+        with mock.patch.object(agent.options.mockable(), 'multi_paxos', True):
+            with mock.patch('models.Elect.send',
+                            return_value=self.sent([elected] * 2, [elected] * 2)) as elect:
+                with mock.patch('models.Accept.send',
+                                return_value=self.sent([accepted] * 2, [accepted] * 2)) as accept:
+                    with mock.patch('models.Prepare.send') as prepare:
+                        with mock.patch('models.Learn.notify'):
+                            first = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+                            second = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'b'})
+        self.assertEqual(first.code, 200)
+        self.assertEqual(second.code, 200)
+        self.assertEqual(elect.call_count, 1)
+        self.assertEqual(accept.call_count, 2)
+        self.assertFalse(prepare.called)
+        self.assertEqual(Success.from_response(second).prepare.slot, 1)
+
+    def test_phases_wait_for_their_own_quorum_sizes(self):
+        agents.set_quorums(phase1=3, phase2=1)
+        elected = self.reply(200, Elected(prepare=Prepare(id=0, slot=0)))
+        accepted = self.reply(200, Accept(prepare=self.get_prepare()))
+        with mock.patch.object(agent.options.mockable(), 'multi_paxos', True):
+            with mock.patch('models.Elect.send',
+                            return_value=self.sent([elected] * 2, [elected] * 2)) as elect:
+                with mock.patch('models.Accept.send',
+                                return_value=self.sent([], [])) as accept:
+                    with mock.patch('models.Learn.notify'):
+                        response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        # Our own acceptor is one of each quorum.
+        self.assertEqual(elect.call_args[0][1], 2)
+        self.assertEqual(accept.call_args[0][1], 0)
+        self.assertEqual(len(accept.call_args[0][0]), QUORUM_SPARE)
+
+    def test_leader_falls_back_when_pre_empted(self):
+        elected = self.reply(200, Elected(prepare=Prepare(id=0, slot=0)))
+        rejected = self.reply(400, Promise(prepare=Prepare(id=make_ballot(Prepare._round + 100, 1))))
+        promised = self.reply(200, Promise())
+        with mock.patch.object(agent.options.mockable(), 'multi_paxos', True):
+            with mock.patch('models.Elect.send',
+                            return_value=self.sent([elected] * 2, [elected] * 2)):
+                with mock.patch('models.Accept.send',
+                                return_value=self.sent([rejected], [], [rejected])):
+                    with mock.patch('models.Prepare.send',
+                                    return_value=self.sent([promised] * 2, [promised] * 2)) as prepare:
+                        with mock.patch('models.Propose.send',
+                                        return_value=self.sent([promised] * 2, [promised] * 2)):
+                            with mock.patch('models.Learn.notify'):
+                                response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 200)
+        self.assertTrue(prepare.called)
+        self.assertFalse(agent.leader.elected)
+        # The Accept may have been chosen, so the write stays in its slot.
+        self.assertEqual(agent.log.entries[0].prepare.argument, 'a')
+
+    @mock.patch.object(LeaderPromise, 'lease_duration', 0)
+    def test_acceptor_rejects_accepts_from_a_pre_empted_leader(self):
+        old = Prepare(id=5, slot=0)
+        new = Prepare(id=6, slot=0)
+        self.assertEqual(self.post('/elect', Elect(prepare=old).to_json()).code, 200)
+        self.assertEqual(self.post('/elect', Elect(prepare=new).to_json()).code, 200)
+        self.assertEqual(self.post('/elect', Elect(prepare=old).to_json()).code, 400)
+
+        write = Prepare(id=5, key='foo', predicate='set', argument='a', slot=0)
+        response = self.post('/accept', Accept(prepare=write).to_json())
+        self.assertEqual(response.code, 400)
+        self.assertEqual(Promise.from_response(response).prepare.id, 6)
+
+    @mock.patch.object(LeaderPromise, 'lease_duration', 0)
+    def test_elected_reports_accepted_values(self):
+        write = Prepare(id=5, key='foo', predicate='set', argument='a', slot=3)
+        self.assertEqual(self.post('/accept', Accept(prepare=write).to_json()).code, 200)
+        response = self.post('/elect', Elect(prepare=Prepare(id=6, slot=0)).to_json())
+        elected = Elected.from_response(response)
+        self.assertEqual(elected.prepare.slot, 4)
+        self.assertEqual([p.to_json() for p in elected.accepted], [write.to_json()])
+
+        response = self.post('/elect', Elect(prepare=Prepare(id=7, slot=4)).to_json())
+        self.assertEqual(Elected.from_response(response).accepted, [])
+
+    def test_elections_report_values_accepted_on_the_classic_path(self):
+        write = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=2,
+                        client_id='c', sequence=1)
+        self.assertEqual(self.post('/propose', Propose(prepare=write).to_json()).code, 200)
+        response = self.post('/elect', Elect(prepare=Prepare(id=make_ballot(1, 2), slot=0)).to_json())
+        elected = Elected.from_response(response)
+        self.assertEqual([p.to_json() for p in elected.accepted], [write.to_json()])
+        self.assertEqual(elected.prepare.slot, 3)
+
+    def test_an_election_covers_the_classic_path_too(self):
+        self.post('/elect', Elect(prepare=Prepare(id=make_ballot(1, 2), slot=0)).to_json())
+        lower = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=4)
+        self.assertEqual(self.post('/prepare', lower.to_json()).code, 400)
+        self.assertEqual(self.post('/propose', Propose(prepare=lower).to_json()).code, 400)
+
+    def test_acceptors_refuse_accepts_for_chosen_slots(self):
+        chosen = Prepare(id=5, key='foo', predicate='set', argument='a', slot=0)
+        self.post('/learn', Learn(prepare=chosen).to_json())
+        other = Prepare(id=6, key='bar', predicate='set', argument='b', slot=0)
+        response = self.post('/accept', Accept(prepare=other).to_json())
+        self.assertEqual(response.code, 409)
+        self.assertEqual(agent.log.entries[0].prepare.to_json(), chosen.to_json())
+
+    def test_a_new_leader_repairs_what_its_own_acceptor_accepted(self):
+        mine = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=0)
+        self.assertEqual(self.post('/accept', Accept(prepare=mine).to_json()).code, 200)
+        agent.leader_promise.lease_expires = 0
+        elected = self.reply(200, Elected(prepare=Prepare(id=0, slot=0)))
+        with mock.patch('models.Elect.send', return_value=self.sent([elected] * 2, [elected] * 2)):
+            with mock.patch('agent.accept', side_effect=lambda *a: self.learned()) as accept:
+                self.io_loop.run_sync(lambda: agent.elect(agent.quorum_for(2), agent.quorum_for(2)))
+        repair = accept.call_args_list[0][0][0]
+        self.assertEqual((repair.slot, repair.argument), (0, 'a'))
+
+    def test_a_write_the_new_leader_repairs_is_not_chosen_again(self):
+        ours = {'key': 'foo', 'predicate': 'set', 'argument': 'a', 'client_id': 'c', 'sequence': 7}
+        mine = Prepare(id=make_ballot(0, 1), slot=0, **ours)
+        self.assertEqual(self.post('/accept', Accept(prepare=mine).to_json()).code, 200)
+        agent.leader_promise.lease_expires = 0
+        elected = self.reply(200, Elected(prepare=Prepare(id=0, slot=0)))
+        with mock.patch.object(agent.options.mockable(), 'multi_paxos', True):
+            with mock.patch('models.Elect.send', return_value=self.sent([elected] * 2, [elected] * 2)):
+                with mock.patch('agent.accept', side_effect=lambda *a: self.learned()) as accept:
+                    response = self.post('/write', body=ours)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Success.from_response(response).prepare.slot, 0)
+        self.assertEqual(accept.call_count, 1)
+
+    def test_new_leader_repairs_and_fills_gaps(self):
+        previous = Prepare(id=3, key='foo', predicate='set', argument='a', slot=1)
+        elected = self.reply(200, Elected(prepare=Prepare(id=9, slot=3),
+                                          accepted=[previous]))
+        accepted = self.reply(200, Accept(prepare=self.get_prepare()))
+        with mock.patch.object(agent.options.mockable(), 'multi_paxos', True):
+            with mock.patch('models.Elect.send',
+                            return_value=self.sent([elected] * 2, [elected] * 2)):
+                with mock.patch('agent.accept', side_effect=lambda *a: self.learned()) as accept:
+                    self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'b'})
+        proposed = {call[0][0].slot: call[0][0] for call in accept.call_args_list}
+        self.assertEqual(sorted(proposed), [0, 1, 2, 3])
+        self.assertEqual(proposed[0].predicate, 'noop')
+        self.assertEqual(proposed[1].argument, 'a')
+        self.assertEqual(proposed[3].argument, 'b')
+
+    def test_acceptors_learn_from_piggybacked_commit_indexes(self):
+        writes = [Prepare(id=5, key='foo', predicate='set', argument=i, slot=i) for i in range(3)]
+        for write in writes[:2]:
+            self.assertEqual(self.post('/accept', Accept(prepare=write).to_json()).code, 200)
+        self.assertEqual(len(agent.log), 0)
+        self.post('/accept', Accept(prepare=writes[2], commit=1).to_json())
+        self.assertEqual(agent.log.commit_index, 1)
+        self.assertEqual(agent.kv.get('foo'), (1, 1))
+
+    def test_writes_are_acknowledged_before_everyone_learns(self):
+        elected = self.reply(200, Elected(prepare=Prepare(id=0, slot=0)))
+        accepted = self.reply(200, Accept(prepare=self.get_prepare()))
+        with mock.patch.object(agent.options.mockable(), 'multi_paxos', True):
+            with mock.patch('models.Elect.send',
+                            return_value=self.sent([elected] * 2, [elected] * 2)):
+                with mock.patch('models.Accept.send',
+                                return_value=self.sent([accepted] * 2, [accepted] * 2)):
+                    with mock.patch('models.Learn.fanout') as fanout:
+                        with mock.patch('models.Learn.notify') as notify:
+                            self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+                            response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'b'})
+        self.assertEqual(response.code, 200)
+        self.assertFalse(fanout.called)
+        self.assertEqual(notify.call_count, 2)
+        self.assertEqual(agent.log.commit_index, 1)
+
+    def test_classic_writes_wait_for_a_leaders_lease(self):
+        self.post('/elect', Elect(prepare=Prepare(id=5, slot=0)).to_json())
+        self.assertEqual(self.post('/prepare', Prepare(id=6, key='bar', predicate='set', argument='b').to_json()).code, 200)
+        write = Prepare(id=7, key='foo', predicate='set', argument='a', slot=0)
+        self.post('/elect', Elect(prepare=Prepare(id=7, slot=0)).to_json())
+        self.assertEqual(self.post('/accept', Accept(prepare=write).to_json()).code, 200)
+        response = self.post('/prepare', Prepare(id=8, key='bar', predicate='set', argument='b').to_json())
+        self.assertEqual(response.code, 423)
+
+    @mock.patch.object(LeaderPromise, 'lease_duration', 0)
+    def test_classic_prepare_pre_empts_the_leader(self):
+        self.post('/elect', Elect(prepare=Prepare(id=5, slot=0)).to_json())
+        self.post('/prepare', Prepare(id=6, key='bar', predicate='set', argument='b').to_json())
+        write = Prepare(id=5, key='foo', predicate='set', argument='a', slot=0)
+        self.assertEqual(self.post('/accept', Accept(prepare=write).to_json()).code, 400)
+
+    def test_writes_go_to_the_node_holding_the_lease(self):
+        write = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=0)
+        self.assertEqual(self.post('/accept', Accept(prepare=write).to_json()).code, 200)
+        with mock.patch('models.Prepare.send') as send:
+            response = self.post('/write', body={'key': 'bar', 'predicate': 'set', 'argument': 'b'})
+        leader = agents.agents[1]
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['X-Leader'], '{}:{}'.format(leader.url, leader.port))
+        self.assertFalse(send.called)
+        # Our own acceptor didn't promise the write, so the leader goes on.
+        self.assertEqual(agent.leader_promise.prepare.id, write.id)
+
+    def test_a_lease_on_the_peers_redirects_writes(self):
+        leased = self.reply(423, Promise(prepare=Prepare(id=make_ballot(3, 2))))
+        with mock.patch('models.Prepare.send', return_value=self.sent([leased] * 2, [])):
+            with mock.patch('models.Withdraw.notify'):
+                response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 503)
+        self.assertEqual(json.loads(response.body)['leader'], '{}:{}'.format(
+            agents.agents[2].url, agents.agents[2].port))
+
+    def test_a_leader_stays_on_when_accepts_go_unanswered(self):
+        elected = self.reply(200, Elected(prepare=Prepare(id=0, slot=0)))
+        with mock.patch.object(agent.options.mockable(), 'multi_paxos', True):
+            with mock.patch('models.Elect.send',
+                            return_value=self.sent([elected] * 2, [elected] * 2)):
+                with mock.patch('models.Accept.send', return_value=self.sent([], [])):
+                    with mock.patch('models.Prepare.send') as prepare:
+                        response = self.post('/write', body={'key': 'foo', 'predicate': 'set', 'argument': 'a'})
+        self.assertEqual(response.code, 500)
+        self.assertTrue(agent.leader.elected)
+        self.assertFalse(prepare.called)
+
+
+class TestSlotLog(Base):
+
+    def learn(self, slot, argument):
+        prepare = Prepare(id=slot, key='foo', predicate='set',
+                          argument=argument, slot=slot)
+        return self.post('/learn', Learn(prepare=prepare).to_json())
+
+    def test_out_of_order_learns_wait_for_the_prefix(self):
+        self.learn(1, 'b')
+        self.learn(2, 'c')
+        self.assertEqual(agent.log.commit_index, -1)
+        self.assertEqual(agent.log.pending, 2)
+        self.assertEqual(self.fetch('/read').body, b'')
+
+        self.learn(0, 'a')
+        self.assertEqual(agent.log.commit_index, 2)
+        self.assertEqual(agent.log.apply_index, 2)
+        lines = self.fetch('/read').body.decode().splitlines()
+        self.assertEqual([json.loads(l)['prepare']['argument'] for l in lines],
+                         ['a', 'b', 'c'])
+
+    def test_appliers_see_slots_in_order(self):
+        applied = []
+        agent.log.appliers.append(lambda learn: applied.append(learn.prepare.slot))
+        try:
+            for slot in (2, 0, 1):
+                self.learn(slot, slot)
+        finally:
+            agent.log.appliers.pop()
+        self.assertEqual(applied, [0, 1, 2])
+
+    @tornado.testing.gen_test
+    def test_window_bounds_in_flight_slots(self):
+        window = Window(2)
+        first = yield window.acquire()
+        second = yield window.acquire()
+        third = window.acquire()
+        self.assertFalse(third.done())
+        window.release(first, chosen=False)
+        self.assertEqual((yield third), first)
+        window.learned(5)
+        self.assertEqual(window.next_slot, 6)
+
+    @tornado.testing.gen_test
+    def test_window_hands_out_slots_after_a_floor(self):
+        window = Window(4)
+        window.release((yield window.acquire()), chosen=False)
+        self.assertEqual((yield window.acquire(after=2)), 3)
+        self.assertEqual((yield window.acquire()), 0)
+
+
+class TestKeyValue(Base):
+
+    def learn(self, slot, key, predicate, argument=None):
+        prepare = Prepare(id=slot, key=key, predicate=predicate, argument=argument, slot=slot)
+        self.assertEqual(self.post('/learn', Learn(prepare=prepare).to_json()).code, 200)
+
+    def committed(self, slot):
+        fut = tornado.concurrent.Future()
+        fut.set_result(Success(prepare=Prepare(predicate='noop', slot=slot)))
+        return fut
+
+    def test_applies_writes_in_slot_order(self):
+        self.learn(1, 'foo', 'append', 'b')
+        self.assertEqual(agent.kv.get('foo'), (None, None))
+        self.learn(0, 'foo', 'set', 'a')
+        self.learn(2, 'n', 'batch', [{'predicate': 'incr', 'argument': 2},
+                                     {'predicate': 'incr'}])
+        self.learn(3, 'gone', 'set', 1)
+        self.learn(4, 'gone', 'delete')
+        self.assertEqual(agent.kv.get('foo'), ('ab', 1))
+        self.assertEqual(agent.kv.get('n'), (3, 2))
+        self.assertEqual(agent.kv.get('gone'), (None, None))
+
+    def test_fast_writes_ordered_twice_are_applied_once(self):
+        writes = [Prepare(key='n', predicate='incr', argument=2), Prepare(key='n', predicate='incr')]
+        self.learn(0, 'n', FAST_PREDICATE, ordered('n', writes)['argument'])
+        self.learn(1, 'n', FAST_PREDICATE, ordered('n', writes[:1])['argument'])
+        self.assertEqual(agent.kv.get('n'), (3, 0))
+
+    def test_client_writes_learned_twice_are_applied_once(self):
+        write = Prepare(key='n', predicate='incr', client_id='c', sequence=0)
+        for slot in range(2):
+            learn = Learn(prepare=Prepare(**dict(write.to_json(), id=slot, slot=slot)))
+            self.post('/learn', learn.to_json())
+        self.learn(2, 'n', 'batch', [{'predicate': 'incr', 'client_id': 'c', 'sequence': 0},
+                                     {'predicate': 'incr', 'client_id': 'c', 'sequence': 1}])
+        self.assertEqual(agent.kv.get('n'), (2, 2))
+
+    def test_leader_reads_locally_under_a_lease(self):
+        self.learn(0, 'foo', 'set', 'a')
+        agent.leader.elect(5)
+        agent.leader.renew(time.monotonic())
+        with mock.patch('agent.commit') as commit:
+            response = self.fetch('/kv/foo')
+        self.assertFalse(commit.called)
+        self.assertEqual(json.loads(response.body), {'key': 'foo', 'value': 'a', 'version': 0})
+
+    def test_reads_without_a_lease_commit_a_barrier(self):
+        self.learn(0, 'foo', 'set', 'a')
+        with mock.patch('agent.commit', return_value=self.committed(0)) as commit:
+            response = self.fetch('/kv/foo')
+            missing = self.fetch('/kv/bar')
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(commit.call_args[0][0]['predicate'], 'noop')
+        self.assertEqual(commit.call_args[0][0]['key'], 'bar')
+        self.assertEqual(json.loads(response.body)['value'], 'a')
+        self.assertEqual(missing.code, 404)
+
+    def test_reads_wait_for_the_barrier_to_apply(self):
+        with mock.patch('agent.commit', return_value=self.committed(0)):
+            with mock.patch('agent.READ_TIMEOUT', 0.05):
+                response = self.fetch('/kv/foo')
+        self.assertEqual(response.code, 503)
+
+    def lead(self, ballot, slot=0):
+        self.assertEqual(self.post('/elect', Elect(prepare=Prepare(id=ballot, slot=slot)).to_json()).code, 200)
+        write = Prepare(id=ballot, key='foo', predicate='set', argument=ballot, slot=slot)
+        return self.post('/accept', Accept(prepare=write).to_json())
+
+    def test_acceptors_refuse_elections_during_a_lease(self):
+        self.assertEqual(self.lead(5).code, 200)
+        self.assertEqual(self.post('/elect', Elect(prepare=Prepare(id=6, slot=1)).to_json()).code, 400)
+        agent.leader_promise.lease_expires = 0
+        self.assertEqual(self.post('/elect', Elect(prepare=Prepare(id=6, slot=1)).to_json()).code, 200)
+
+    def test_an_election_alone_grants_no_lease(self):
+        self.post('/elect', Elect(prepare=Prepare(id=5, slot=0)).to_json())
+        self.assertEqual(self.post('/elect', Elect(prepare=Prepare(id=6, slot=0)).to_json()).code, 200)
+
+    def test_a_leaseholder_can_be_elected_again(self):
+        self.assertEqual(self.lead(make_ballot(0, 1)).code, 200)
+        self.assertEqual(self.lead(make_ballot(1, 1), slot=1).code, 200)
+        self.assertEqual(agent.leader_promise.lease_node, 1)
+
+    def test_a_later_leaders_accept_takes_the_lease_over(self):
+        self.assertEqual(self.lead(make_ballot(0, 1)).code, 200)
+        write = Prepare(id=make_ballot(1, 2), key='foo', predicate='set', argument='b', slot=1)
+        self.assertEqual(self.post('/accept', Accept(prepare=write).to_json()).code, 200)
+        self.assertEqual(agent.leader_promise.lease_node, 2)
+        self.assertEqual(self.post('/elect', Elect(prepare=Prepare(id=make_ballot(2, 1), slot=2)).to_json()).code, 400)
+
+
+class TestSnapshots(Base):
+
+    def learn(self, slot, key='foo'):
+        prepare = Prepare(id=slot, key=key, predicate='set', argument=slot, slot=slot)
+        return self.post('/learn', Learn(prepare=prepare).to_json())
+
+    def read(self, url):
+        response = self.fetch(url)
+        return response, [json.loads(l)['prepare']['slot']
+                          for l in response.body.decode().splitlines()]
+
+    def test_read_pages_by_slot(self):
+        for slot in range(5):
+            self.learn(slot)
+        response, slots = self.read('/read?since=1&limit=2')
+        self.assertEqual(slots, [1, 2])
+        self.assertEqual(response.headers['X-Commit-Index'], '4')
+
+    def test_snapshot_truncates_the_log(self):
+        for slot in range(5):
+            self.learn(slot, key='foo' if slot % 2 else 'bar')
+        snapshot = self.io_loop.run_sync(agent.snapshotter.take)
+        self.assertEqual(snapshot.index, 4)
+        self.assertEqual(snapshot.state['learned']['foo']['id'], 3)
+        self.assertEqual(agent.log.entries, {})
+        self.assertEqual(len(list(agent.completed_rounds)), 2)
+
+        self.learn(5)
+        response, slots = self.read('/read?since=0')
+        self.assertEqual(slots, [5])
+        self.assertEqual(response.headers['X-Log-Start'], '5')
+
+    def test_snapshots_are_written_out_off_the_loop(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        for slot in range(3):
+            self.learn(slot)
+        with mock.patch.object(agent.snapshotter, 'filename', os.path.join(dir, 'snapshot.json')):
+            taking = agent.snapshotter.take()
+            self.assertFalse(taking.done())
+            self.assertEqual(agent.log.start, 0) # Not before the snapshot is on disk.
+            snapshot = self.io_loop.run_sync(lambda: taking)
+            with open(agent.snapshotter.filename) as fp:
+                self.assertEqual(json.load(fp)['index'], snapshot.index)
+        self.assertEqual(agent.log.start, 3)
+
+    def test_read_stops_where_a_snapshot_truncated_it(self):
+        for slot in range(6):
+            self.learn(slot)
+        flush = agent.Reader.flush
+
+        def truncating_flush(handler, *args, **kwargs):
+            agent.snapshotter.take()
+            return flush(handler, *args, **kwargs)
+
+        with mock.patch('agent.READ_CHUNK', 2):
+            with mock.patch.object(agent.Reader, 'flush', truncating_flush):
+                with mock.patch.object(agent.Reader, 'log_exception') as log_exception:
+                    response, slots = self.read('/read?since=0')
+        self.assertFalse(log_exception.called)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(slots, [0, 1])
+        self.assertEqual(agent.log.start, 6)
+
+    def test_snapshots_are_taken_as_slots_apply(self):
+        with mock.patch.object(agent.snapshotter, 'every', 3):
+            for slot in range(4):
+                self.learn(slot)
+            self.fetch('/stats')
+        self.assertGreaterEqual(agent.snapshotter.latest.index, 2)
+        self.assertEqual(agent.log.start, agent.snapshotter.latest.index + 1)
+
+    def test_restart_from_snapshot_and_compacted_store(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        agent.snapshotter.filename = os.path.join(dir, 'snapshot.json')
+        agent.recover(AcceptorStore(os.path.join(dir, 'acceptor.log')))
+        try:
+            for slot in range(3):
+                self.learn(slot)
+            self.io_loop.run_sync(agent.snapshotter.take)
+            self.learn(3)
+            self.assertEqual(len(list(AcceptorStore(os.path.join(dir, 'acceptor.log')).replay())), 1)
+        finally:
+            agent.store.close()
+            agent.store = None
+
+        agent.completed_rounds.clear()
+        agent.log.clear()
+        agent.snapshotter.clear()
+        agent.snapshotter.load()
+        agent.recover(AcceptorStore(os.path.join(dir, 'acceptor.log')))
+        try:
+            self.assertEqual(agent.log.start, 3)
+            self.assertEqual(agent.log.commit_index, 3)
+            self.assertEqual(agent.completed_rounds.highest_numbered('foo').prepare.id, 3)
+        finally:
+            agent.snapshotter.filename = None
+            agent.store.close()
+            agent.store = None
+
+
+class TestCatchUp(Base):
+
+    def setUp(self):
+        super(TestCatchUp, self).setUp()
+        self.lagging = SlotLog()
+        self.kv = KeyValueStore(self.lagging)
+        self.snapshotter = Snapshotter(self.lagging, every=0)
+        self.snapshotter.register('kv', self.kv)
+        peer = Agent('http://127.0.0.1', self.get_http_port())
+        self.catchup = CatchUp(self.lagging, lambda: [peer], self.learn,
+                               self.snapshotter.install, delay=0, timeout=5)
+
+    @tornado.gen.coroutine
+    def learn(self, prepares):
+        for prepare in prepares:
+            self.lagging.learn(Learn(prepare=prepare))
+
+    def commit(self, slots):
+        for slot in slots:
+            prepare = Prepare(id=slot, key='k{}'.format(slot % 3), predicate='set',
+                              argument=slot, slot=slot)
+            self.post('/learn', Learn(prepare=prepare).to_json())
+
+    @tornado.testing.gen_test
+    def test_streams_the_missing_range(self):
+        self.lagging.learn(Learn(prepare=Prepare(id=0, key='k0', predicate='set', argument=0, slot=0)))
+        agent.log.learn(Learn(prepare=Prepare(id=0, key='k0', predicate='set', argument=0, slot=0)))
+        for slot in range(1, 8):
+            agent.log.learn(Learn(prepare=Prepare(id=slot, key='k{}'.format(slot % 3),
+                                                  predicate='set', argument=slot, slot=slot)))
+        self.catchup.target = 7
+        with mock.patch('agent.READ_CHUNK', 2):
+            yield self.catchup.run()
+        self.assertEqual(self.lagging.commit_index, 7)
+        self.assertEqual(self.kv.get('k1'), (7, 7))
+        self.assertEqual(self.catchup.report()['slots'], 7)
+        self.assertFalse(self.catchup.running)
+
+    @tornado.testing.gen_test
+    def test_starts_from_a_snapshot_when_the_range_was_truncated(self):
+        for slot in range(6):
+            agent.log.learn(Learn(prepare=Prepare(id=slot, key='k{}'.format(slot % 3),
+                                                  predicate='set', argument=slot, slot=slot)))
+        yield agent.snapshotter.take()
+        agent.log.learn(Learn(prepare=Prepare(id=6, key='k0', predicate='set', argument=6, slot=6)))
+        self.catchup.target = 6
+        yield self.catchup.run()
+        self.assertEqual(self.catchup.report()['snapshots'], 1)
+        self.assertEqual(self.lagging.start, 7)
+        self.assertEqual(self.lagging.commit_index, 6)
+        self.assertEqual(self.kv.get('k0'), (6, 6))
+        self.assertEqual(self.kv.get('k2'), (5, 5))
+
+    def test_gaps_in_learns_trigger_a_catch_up(self):
+        with mock.patch.object(agent.catchup, 'delay', 60):
+            self.commit([0, 3])
+        self.assertEqual(agent.catchup.target, 2)
+        self.assertTrue(agent.catchup.running)
+
+
+class TestHoles(Base):
+
+    def learn(self, slot):
+        agent.log.learn(Learn(prepare=Prepare(id=slot, key='foo', predicate='set', argument=slot, slot=slot)))
+
+    @tornado.testing.gen_test
+    def test_fills_empty_slots_below_the_highest_learned(self):
+        filled = []
+
+        @tornado.gen.coroutine
+        def fill(slot):
+            filled.append(slot)
+
+        holes = Holes(agent.log, fill, timeout=60, limit=10)
+        for slot in (0, 3, 5):
+            self.learn(slot)
+        holes.learned()
+        self.assertTrue(holes.watching)
+        self.learn(8)
+        yield holes.run(6)
+        self.assertEqual(filled, [1, 2, 4])
+        self.assertEqual(holes.report()['filled'], 3)
+
+    def test_an_empty_slot_gets_a_no_op(self):
+        promised = self.reply(200, Promise())
+        self.learn(1)
+        with mock.patch('models.Prepare.send', return_value=self.sent([promised] * 2, [promised] * 2)):
+            with mock.patch('models.Propose.send', return_value=self.sent([promised] * 2, [promised] * 2)):
+                with mock.patch('models.Learn.notify'):
+                    self.io_loop.run_sync(lambda: agent.holes.run(1))
+        self.assertEqual(agent.log.commit_index, 1)
+        self.assertEqual(agent.log.entries[0].prepare.predicate, NOOP_PREDICATE)
+
+    def test_a_chosen_value_is_learned_instead(self):
+        chosen = Prepare(id=make_ballot(0, 2), key='foo', predicate='set', argument='a', slot=0)
+        self.learn(1)
+        with mock.patch('models.Prepare.send', return_value=self.sent([self.reply(409, Promise(prepare=chosen))], [])):
+            self.io_loop.run_sync(lambda: agent.holes.run(1))
+        self.assertEqual(agent.log.commit_index, 1)
+        self.assertEqual(agent.log.entries[0].prepare.to_json(), chosen.to_json())
+
+
+class TestWatch(Base):
+
+    def learn(self, slot, predicate='set'):
+        agent.log.learn(Learn(prepare=Prepare(id=slot, key='foo', predicate=predicate,
+                                              argument=slot, slot=slot)))
+
+    def slots(self, body):
+        return [json.loads(line)['prepare']['slot'] for line in body.splitlines() if line]
+
+    @tornado.testing.gen_test
+    def test_streams_entries_as_they_are_applied(self):
+        self.learn(0)
+        chunks = []
+        url = self.get_url('/watch?since=0&timeout=0.5')
+        watching = self.http_client.fetch(url, streaming_callback=chunks.append)
+        yield tornado.gen.sleep(0.05)
+        self.assertEqual(agent.feed.report()['watchers'], 1)
+        self.learn(2)
+        self.learn(1, predicate='noop')
+        self.learn(3)
+        yield watching
+        self.assertEqual(self.slots(b''.join(chunks)), [0, 2, 3])
+        self.assertEqual(agent.feed.report()['watchers'], 0)
+
+    @tornado.testing.gen_test
+    def test_subscribers_behind_the_buffer_read_from_the_log(self):
+        for slot in range(6):
+            self.learn(slot)
+        with mock.patch.object(agent.feed, 'lines', collections.deque(list(agent.feed.lines)[-2:])):
+            response = yield self.http_client.fetch(self.get_url('/watch?since=1&timeout=0'))
+        self.assertEqual(self.slots(response.body), [1, 2, 3, 4, 5])
+
+    @tornado.testing.gen_test
+    def test_skips_copies_of_a_write(self):
+        ours = {'key': 'foo', 'predicate': 'incr', 'client_id': 'c', 'sequence': 7}
+        agent.log.learn(Learn(prepare=Prepare(id=1, slot=0, **ours)))
+        agent.log.learn(Learn(prepare=Prepare(id=2, slot=1, key='foo', predicate='batch', argument=[
+            {'predicate': 'incr', 'client_id': 'c', 'sequence': 7},
+            {'predicate': 'incr', 'client_id': 'c', 'sequence': 8}])))
+        agent.log.learn(Learn(prepare=Prepare(id=3, slot=2, **ours)))
+        watched = yield self.http_client.fetch(self.get_url('/watch?since=0&timeout=0'))
+        with mock.patch.object(agent.feed, 'lines', collections.deque()):
+            behind = yield self.http_client.fetch(self.get_url('/watch?since=0&timeout=0'))
+        read = yield self.http_client.fetch(self.get_url('/read?since=0'))
+        for response in (watched, behind, read):
+            self.assertEqual(self.slots(response.body), [0, 1])
+            batch = json.loads(response.body.splitlines()[1])['prepare']
+            self.assertEqual([entry['sequence'] for entry in batch['argument']], [8])
+        self.assertEqual(agent.kv.get('foo'), (2, 1))
+
+    @tornado.testing.gen_test
+    def test_sends_heartbeats_while_idle(self):
+        with mock.patch('agent.WATCH_HEARTBEAT', 0.01):
+            response = yield self.http_client.fetch(self.get_url('/watch?timeout=0.1'))
+        self.assertTrue(response.body.startswith(b'\n'))
+        self.assertEqual(response.body.strip(), b'')
+
+
+class TestFastPath(Base):
+
+    def setUp(self):
+        super(TestFastPath, self).setUp()
+        patcher = mock.patch.object(agent.options.mockable(), 'fast_path', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def proposed(self, slot):
+        fut = tornado.concurrent.Future()
+        fut.set_result(Success(prepare=Prepare(slot=slot, **ordered('n', [Prepare(id=9, key='n', predicate='incr')]))))
+        return fut
+
+    def test_commits_in_one_round_trip(self):
+        accepted = self.reply(200, FastAccept(prepare=Prepare(id=1, key='n', slot=4)))
+        with mock.patch('models.FastAccept.send',
+                        return_value=self.sent([accepted] * 2, [accepted] * 2)) as send:
+            with mock.patch('agent.propose', return_value=self.proposed(5)) as propose:
+                response = self.post('/write', body={'key': 'n', 'predicate': 'incr', 'argument': 1})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(propose.call_args[0][1], 4) # Ordered after slot 4.
+        self.assertEqual(agent.fast_paths['commits'], 1)
+        self.assertEqual(len(agent.unordered), 1)
+
+    def test_orders_first_when_an_acceptor_conflicts(self):
+        conflict = self.reply(400, Promise(prepare=Prepare(key='n', predicate='set', slot=3)))
+        with mock.patch('models.FastAccept.send',
+                        return_value=self.sent([conflict, conflict], [], [conflict, conflict])):
+            with mock.patch('agent.propose', return_value=self.proposed(5)):
+                response = self.post('/write', body={'key': 'n', 'predicate': 'incr', 'argument': 1})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Success.from_response(response).prepare.slot, 5)
+        self.assertEqual(agent.fast_paths['conflicts'], 1)
+
+    def test_writes_that_dont_commute_take_the_classic_path(self):
+        with mock.patch('models.FastAccept.send') as send:
+            with mock.patch('agent.propose', return_value=self.proposed(0)):
+                self.post('/write', body={'key': 'n', 'predicate': 'set', 'argument': 1})
+        self.assertFalse(send.called)
+
+    def test_acceptor_refuses_during_a_write_that_doesnt_commute(self):
+        fast = FastAccept(prepare=Prepare(key='n', predicate='incr'))
+        agent.current_promises.add(Promise(prepare=Prepare(key='n', predicate='set', slot=0)))
+        self.assertEqual(self.post('/fast', fast.to_json()).code, 400)
+        agent.current_promises.clear()
+        agent.current_promises.add(Promise(prepare=Prepare(key='n', predicate='incr', slot=0)))
+        self.assertEqual(self.post('/fast', fast.to_json()).code, 200)
+        self.assertIn(fast.prepare, agent.unordered)
+
+    def test_writes_that_dont_commute_wait_for_fast_writes_to_be_ordered(self):
+        fast = Prepare(key='n', predicate='incr')
+        self.post('/fast', FastAccept(prepare=fast).to_json())
+        response = self.post('/prepare', Prepare(key='n', predicate='set', slot=1).to_json())
+        self.assertEqual(response.code, 400)
+        self.post('/learn', Learn(prepare=Prepare(slot=3, **ordered('n', [fast]))).to_json())
+        self.assertNotIn(fast, agent.unordered)
+        response = self.post('/prepare', Prepare(key='n', predicate='set', slot=1).to_json())
+        self.assertEqual(response.code, 409)
+        self.assertEqual(Promise.from_response(response).prepare.slot, 3)
+
+    def test_read_barriers_are_ordered_after_fast_writes_to_the_key(self):
+        fast = Prepare(key='n', predicate='incr')
+        self.post('/fast', FastAccept(prepare=fast).to_json())
+        barrier = Prepare(key='n', predicate=NOOP_PREDICATE, slot=1)
+        self.assertEqual(self.post('/prepare', barrier.to_json()).code, 400)
+        self.post('/learn', Learn(prepare=Prepare(slot=3, **ordered('n', [fast]))).to_json())
+        response = self.post('/prepare', barrier.to_json())
+        self.assertEqual(response.code, 409)
+        self.assertEqual(Promise.from_response(response).prepare.slot, 3)
+
+    def test_proposals_move_past_fast_writes(self):
+        follow = self.reply(409, Promise(prepare=Prepare(key='n', slot=3)))
+        promised = self.reply(200, Promise())
+        with mock.patch('models.Prepare.send', side_effect=[
+                self.sent([follow, promised], [promised]),
+                self.sent([promised] * 2, [promised] * 2)]):
+            with mock.patch('models.Propose.send',
+                            return_value=self.sent([promised] * 2, [promised] * 2)):
+                with mock.patch('models.Learn.notify'):
+                    response = self.post('/write', body={'key': 'n', 'predicate': 'set', 'argument': 1})
+        self.assertEqual(Success.from_response(response).prepare.slot, 4)
+        self.assertIn(0, agent.window.abandoned)
+
+    def test_unordered_writes_survive_a_restart(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        filename = os.path.join(dir, 'acceptor.log')
+        fast = Prepare(key='n', predicate='incr')
+        agent.recover(AcceptorStore(filename))
+        try:
+            self.assertEqual(self.post('/fast', FastAccept(prepare=fast).to_json()).code, 200)
+        finally:
+            agent.store.close()
+            agent.store = None
+
+        agent.unordered.clear()
+        agent.recover(AcceptorStore(filename))
+        try:
+            self.assertIn(fast, agent.unordered)
+        finally:
+            agent.store.close()
+            agent.store = None
+
+
+class TestMetrics(Base):
+
+    def test_histograms_are_cumulative(self):
+        registry = Metrics(buckets=(0.01, 0.1))
+        registry.declare('latency', HISTOGRAM, 'Latency.')
+        for seconds in (0.005, 0.05, 1.0):
+            registry.observe('latency', seconds, (('phase', '/prepare'),))
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE latency histogram', lines)
+        self.assertIn('latency_bucket{phase="/prepare",le="0.01"} 1', lines)
+        self.assertIn('latency_bucket{phase="/prepare",le="0.1"} 2', lines)
+        self.assertIn('latency_bucket{phase="/prepare",le="+Inf"} 3', lines)
+        self.assertIn('latency_count{phase="/prepare"} 3', lines)
+
+    @tornado.testing.gen_test
+    def test_phases_record_their_outcome_and_round_trips(self):
+        peer = Agent('http://127.0.0.1', 1)
+        peer.connection = mock.Mock()
+        answered = tornado.concurrent.Future()
+        answered.set_result(mock.Mock(code=400))
+        peer.connection.fetch.return_value = answered
+        yield Prepare(id=1, slot=0).send([peer], 1)
+        self.assertEqual(agent.metrics.counters[
+            ('paxos_phase_total', (('phase', '/prepare'), ('outcome', 'preempted')))], 1)
+        self.assertEqual(agent.metrics.histograms[
+            ('paxos_peer_seconds', (('endpoint', '/prepare'), ('peer', 1)))].count, 1)
+
+    def test_serves_requests_and_gauges(self):
+        self.assertEqual(self.post('/prepare', self.get_prepare().to_json()).code, 200)
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        lines = response.body.decode('utf-8').splitlines()
+        self.assertIn('paxos_requests_total{handler="PrepareAcceptor",code="200"} 1.0', lines)
+        self.assertIn('paxos_promises_in_progress 1', lines)
+        self.assertIn('paxos_quorum_size{{phase="1"}} {}'.format(agents.phase1), lines)
+
+
+class TestGroups(Base):
+
+    def setUp(self):
+        super(TestGroups, self).setUp()
+        agent.groups.configure(count=2, index=0, port=8888)
+        self.addCleanup(agent.groups.configure)
+
+    def key_for(self, group):
+        return next(key for key in ('key-{}'.format(i) for i in range(100))
+                    if agent.groups.owner(key) == group)
+
+    def relayed(self, code, body):
+        response = mock.Mock()
+        response.code = code
+        response.body = json.dumps(body).encode('utf-8')
+        response.headers = {'Content-Type': 'application/json'}
+        fut = tornado.concurrent.Future()
+        fut.set_result(response)
+        return fut
+
+    def test_keys_are_spread_over_the_groups(self):
+        owners = [agent.groups.owner('key-{}'.format(i)) for i in range(30)]
+        self.assertEqual(set(owners), {0, 1})
+        self.assertEqual(owners, [agent.groups.owner('key-{}'.format(i)) for i in range(30)])
+        self.assertEqual(agent.groups.url(1), 'http://127.0.0.1:{}'.format(8888 + 2 * GROUP_PORT_OFFSET))
+
+    def test_writes_for_another_group_are_forwarded(self):
+        key = self.key_for(1)
+        with mock.patch.object(agent.groups, 'fetch',
+                               return_value=self.relayed(200, {'status': 'SUCCESS'})) as fetch:
+            with mock.patch('agent.commit') as commit:
+                response = self.post('/write', body={'key': key, 'predicate': 'set', 'argument': 'a'})
+        self.assertFalse(commit.called)
+        self.assertEqual(fetch.call_args[0][0], 1)
+        self.assertEqual(fetch.call_args[0][1].uri, '/write')
+        self.assertEqual(json.loads(response.body), {'status': 'SUCCESS'})
+
+    def test_reads_for_another_group_are_forwarded(self):
+        with mock.patch.object(agent.groups, 'fetch',
+                               return_value=self.relayed(404, {})) as fetch:
+            self.assertEqual(self.fetch('/kv/' + self.key_for(1)).code, 404)
+            self.fetch('/read?group=1&since=3')
+        self.assertEqual(fetch.call_args[0][1].uri, '/read?group=1&since=3')
+
+    def test_reads_of_the_log_name_a_group(self):
+        with mock.patch.object(agent.groups, 'fetch') as fetch:
+            self.assertEqual(self.fetch('/read?since=3').code, 400)
+            self.assertEqual(self.fetch('/read?group=2').code, 400)
+            self.assertEqual(self.fetch('/read?group=0').code, 200)
+        self.assertFalse(fetch.called)
+
+    def test_watches_and_stats_name_a_group(self):
+        with mock.patch.object(agent.groups, 'fetch') as fetch:
+            for url in ('/watch?timeout=0', '/stats', '/metrics'):
+                self.assertEqual(self.fetch(url).code, 400)
+                self.assertEqual(self.fetch(url + ('&' if '?' in url else '?') + 'group=0').code, 200)
+        self.assertFalse(fetch.called)
+
+    def test_stats_for_another_group_are_forwarded(self):
+        with mock.patch.object(agent.groups, 'fetch',
+                               return_value=self.relayed(200, {'group': {'index': 1}})) as fetch:
+            response = self.fetch('/stats?group=1')
+        self.assertEqual(fetch.call_args[0][0], 1)
+        self.assertEqual(json.loads(response.body), {'group': {'index': 1}})
+
+    def test_watches_of_another_group_are_relayed_as_they_stream(self):
+        lines = [b'{"prepare": {"slot": 3}}\n', b'\n', b'{"prepare": {"slot": 4}}\n']
+
+        @tornado.gen.coroutine
+        def fetch(group, request, header_callback, streaming_callback):
+            for line in ('HTTP/1.1 200 OK\r\n', 'X-Log-Start: 3\r\n', '\r\n'):
+                header_callback(line)
+            for line in lines:
+                streaming_callback(line)
+                yield tornado.gen.moment
+            raise tornado.gen.Return(mock.Mock(code=200))
+
+        with mock.patch.object(agent.groups, 'fetch', side_effect=fetch) as relayed:
+            chunks = []
+            response = self.fetch('/watch?group=1&since=3', streaming_callback=chunks.append)
+        self.assertEqual(relayed.call_args[0][1].uri, '/watch?group=1&since=3')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['X-Log-Start'], '3')
+        self.assertEqual(b''.join(chunks), b''.join(lines))
+
+    def test_writes_owned_here_are_committed_here(self):
+        committed = tornado.concurrent.Future()
+        committed.set_result(Success(prepare=Prepare(key='k', predicate='set', argument='a', slot=0)))
+        with mock.patch.object(agent.groups, 'fetch') as fetch:
+            with mock.patch('agent.commit', return_value=committed):
+                response = self.post('/write', body={'key': self.key_for(0), 'predicate': 'set', 'argument': 'a'})
+        self.assertFalse(fetch.called)
+        self.assertEqual(response.code, 200)
+
+    def test_groups_talk_to_their_counterparts(self):
+        cluster = Agents([Agent('http://127.0.0.1', port) for port in (8888, 8889)])
+        cluster.shift_ports(group_port(0, 1))
+        self.assertEqual([a.port for a in cluster.all()], [group_port(8888, 1), group_port(8889, 1)])
+
+
+class TestPeerTransport(Base):
+
+    def setUp(self):
+        super(TestPeerTransport, self).setUp()
+        sock, self.peer_port = tornado.testing.bind_unused_port()
+        self.server = PeerServer(self._app)
+        self.server.add_sockets([sock])
+        self.connection = PeerConnection('127.0.0.1', self.peer_port)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+        super(TestPeerTransport, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_messages_share_one_stream(self):
+        peer = Agent('http://127.0.0.1', self.peer_port)
+        peer.connection = self.connection
+        learns = [Learn(prepare=Prepare(id=i, key='foo', predicate='set', argument=i, slot=i))
+                  for i in range(20)]
+        responses = yield [peer.send(learn) for learn in learns]
+        self.assertEqual({r.code for r in responses}, {200})
+        self.assertEqual([Success.from_response(r).prepare.slot for r in responses],
+                         list(range(20)))
+        self.assertEqual(agent.log.commit_index, 19)
+        stream = self.connection.stream
+        yield peer.send(learns[0])
+        self.assertIs(self.connection.stream, stream)
+
+    @tornado.testing.gen_test
+    def test_rejections_keep_their_status(self):
+        yield self.connection.fetch('/prepare', json.dumps(
+            Prepare(id=5, key='foo', predicate='set', argument='a').to_json()).encode())
+        response = yield self.connection.fetch('/prepare', json.dumps(
+            Prepare(id=4, key='foo', predicate='set', argument='a').to_json()).encode())
+        self.assertEqual(response.code, 400)
+
+    @tornado.testing.gen_test
+    def test_frames_carry_the_codec(self):
+        peer = Agent('http://127.0.0.1', self.peer_port)
+        peer.connection = self.connection
+        peer.codec = BINARY
+        prepare = Prepare(id=1, key='foo', predicate='set', argument='a', slot=0)
+        response = yield peer.send(Learn(prepare=prepare))
+        self.assertEqual(response.headers['Content-Type'], BINARY.content_type)
+        self.assertEqual(Success.from_response(response).to_json(),
+                         Success(prepare=prepare).to_json())
+
+    @tornado.testing.gen_test
+    def test_unanswered_requests_time_out(self):
+        peer = Agent('http://127.0.0.1', self.peer_port)
+        peer.connection = self.connection
+        yield peer.send(Learn(prepare=Prepare(id=0, key='foo', predicate='set', argument=0, slot=0)))
+        with mock.patch.object(PeerServer, 'dispatch'): # The peer never answers.
+            with mock.patch.dict('models.PHASE_TIMEOUTS', {'/learn': 0.05}):
+                with self.assertRaises(tornado.gen.TimeoutError):
+                    yield peer.send(Learn(prepare=Prepare(id=1, key='foo', predicate='set', argument=1, slot=1)))
+        self.assertEqual(self.connection.pending, {})
+        self.assertGreater(peer.error_rate, 0)
+
+    @tornado.testing.gen_test
+    def test_backs_off_after_failing_to_connect(self):
+        sock, port = tornado.testing.bind_unused_port()
+        sock.close()
+        connection = PeerConnection('127.0.0.1', port)
+        with self.assertRaises(Exception):
+            yield connection.fetch('/learn', b'{}')
+        self.assertGreater(connection.retry_at, 0)
+        with mock.patch('tornado.tcpclient.TCPClient.connect') as connect:
+            with self.assertRaises(tornado.iostream.StreamClosedError):
+                yield connection.fetch('/learn', b'{}')
+            self.assertFalse(connect.called)
+
+    @tornado.testing.gen_test
+    def test_reconnects_after_the_stream_drops(self):
+        yield self.connection.fetch('/learn', json.dumps(
+            Learn(prepare=self.get_prepare()).to_json()).encode())
+        self.connection.stream.close()
+        yield tornado.gen.moment
+        response = yield self.connection.fetch('/learn', json.dumps(
+            Learn(prepare=self.get_prepare()).to_json()).encode())
+        self.assertEqual(response.code, 200)
+
+    @tornado.testing.gen_test
+    def test_a_dropped_stream_fails_only_its_own_requests(self):
+        learn = json.dumps(Learn(prepare=self.get_prepare()).to_json()).encode()
+        yield self.connection.fetch('/learn', learn)
+        old = self.connection.stream
+        old.close()
+        yield tornado.gen.moment
+        dispatch = PeerServer.dispatch
+
+        def later(server, *args):
+            tornado.ioloop.IOLoop.current().call_later(0.05, dispatch, server, *args)
+
+        with mock.patch.object(PeerServer, 'dispatch', later):
+            answered = self.connection.fetch('/learn', learn)
+            yield tornado.gen.sleep(0.01)
+            self.connection.closed(old) # The old stream's reader finds out late.
+            response = yield answered
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.connection.pending, {self.connection.stream: {}})
+
+
+class TestRecovery(Base):
+
+    @mock.patch.object(LeaderPromise, 'lease_duration', 0)
+    def test_restarted_acceptor_keeps_its_promises(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        filename = os.path.join(dir, 'acceptor.log')
+        agent.recover(AcceptorStore(filename))
+        try:
+            higher = Prepare(id=10, key='foo', predicate='set', argument='b')
+            self.assertEqual(self.post('/prepare', higher.to_json()).code, 200)
+            learned = Prepare(id=4, key='bar', predicate='set', argument='c', slot=0)
+            self.post('/learn', Learn(prepare=learned).to_json())
+        finally:
+            agent.store.close()
+            agent.store = None
+
+        agent.current_promises.clear()
+        agent.completed_rounds.clear()
+        agent.log.clear()
+        agent.recover(AcceptorStore(filename))
+        try:
+            lower = Prepare(id=9, key='foo', predicate='set', argument='a')
+            self.assertEqual(self.post('/prepare', lower.to_json()).code, 400)
+            self.assertEqual(agent.log.commit_index, 0)
+        finally:
+            agent.store.close()
+            agent.store = None
+
 
 class TestPrepareAcceptor(Base):
 
@@ -280,7 +1942,7 @@ class TestPrepareAcceptor(Base):
         target = Promise.from_response(failure)
         self.assertEqual(target.to_json(), {'prepare': higher_prepare.to_json()})
 
-    def test_returns_lower_numbered_in_progress_promises(self):
+    def test_does_not_report_promises_as_values(self):
         lower_prepare = Prepare(id=0, key='foo', predicate='set', argument='a')
         higher_prepare = Prepare(id=1, key='foo', predicate='set', argument='b')
 
@@ -290,10 +1952,51 @@ class TestPrepareAcceptor(Base):
         self.assertEqual(agent.current_promises.highest_numbered().to_json(),
                          {'prepare': lower_prepare.to_json()})
 
-        failure = self.post('/prepare', higher_prepare.to_json())
-        self.assertEqual(failure.code, 200)
-        target = Promise.from_response(failure)
-        self.assertEqual(target.to_json(), {'prepare': lower_prepare.to_json()})
+        success = self.post('/prepare', higher_prepare.to_json())
+        self.assertEqual(success.code, 200)
+        self.assertEqual(Promise.from_response(success).to_json(), {'prepare': None})
+        self.assertEqual(agent.current_promises.highest_numbered().to_json(),
+                         {'prepare': higher_prepare.to_json()})
+
+    def test_refuses_slots_that_were_already_chosen(self):
+        chosen = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=0)
+        self.post('/learn', Learn(prepare=chosen).to_json())
+        late = Prepare(id=make_ballot(1, 2), key='bar', predicate='set', argument='b', slot=0)
+        response = self.post('/prepare', late.to_json())
+        self.assertEqual(response.code, 409)
+        self.assertEqual(Promise.from_response(response).prepare.to_json(), chosen.to_json())
+
+    def test_refuses_a_slot_another_proposer_claimed(self):
+        first = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=3)
+        second = Prepare(id=make_ballot(1, 2), key='bar', predicate='set', argument='b', slot=3)
+        self.assertEqual(self.post('/prepare', first.to_json()).code, 200)
+        response = self.post('/prepare', second.to_json())
+        self.assertEqual(response.code, 409)
+        claim = Promise.from_response(response).prepare
+        self.assertEqual((claim.id, claim.slot, claim.predicate), (first.id, 3, None))
+
+    def test_lets_a_no_op_past_a_claim(self):
+        first = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=3)
+        recovery = Prepare(id=make_ballot(1, 2), predicate=agent.NOOP_PREDICATE, slot=3)
+        self.assertEqual(self.post('/prepare', first.to_json()).code, 200)
+        self.assertEqual(self.post('/prepare', recovery.to_json()).code, 200)
+
+    def test_returns_the_value_accepted_for_the_slot(self):
+        accepted = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=3)
+        self.assertEqual(self.post('/propose', Propose(prepare=accepted).to_json()).code, 200)
+        later = Prepare(id=make_ballot(1, 2), key='bar', predicate='set', argument='b', slot=3)
+        response = self.post('/prepare', later.to_json())
+        self.assertEqual(response.code, 200)
+        self.assertEqual(Promise.from_response(response).prepare.to_json(), accepted.to_json())
+        self.assertEqual(agent.slot_ballots[3], later.id)
+
+    def test_refuses_ballots_below_the_slots_promise(self):
+        higher = Prepare(id=make_ballot(1, 1), key='foo', predicate='set', argument='a', slot=3)
+        lower = Prepare(id=make_ballot(0, 2), key='bar', predicate='set', argument='b', slot=3)
+        self.assertEqual(self.post('/prepare', higher.to_json()).code, 200)
+        response = self.post('/prepare', lower.to_json())
+        self.assertEqual(response.code, 400)
+        self.assertEqual(Promise.from_response(response).prepare.id, higher.id)
 
 
 class TestProposeAcceptor(Base):
@@ -314,6 +2017,35 @@ class TestProposeAcceptor(Base):
 
         self.assertIsNone(agent.current_promises.highest_numbered())
 
+    def test_refuses_ballots_below_the_slots_promise(self):
+        higher = Prepare(id=make_ballot(1, 1), key='foo', predicate='set', argument='a', slot=3)
+        lower = Prepare(id=make_ballot(0, 2), key='bar', predicate='set', argument='b', slot=3)
+        self.assertEqual(self.post('/prepare', higher.to_json()).code, 200)
+        response = self.post('/propose', Propose(prepare=lower).to_json())
+        self.assertEqual(response.code, 400)
+        self.assertNotIn(3, agent.accepted_at)
+
+    def test_refuses_slots_that_were_already_chosen(self):
+        chosen = Prepare(id=make_ballot(0, 1), key='foo', predicate='set', argument='a', slot=0)
+        self.post('/learn', Learn(prepare=chosen).to_json())
+        late = Prepare(id=make_ballot(1, 2), key='bar', predicate='set', argument='b', slot=0)
+        response = self.post('/propose', Propose(prepare=late).to_json())
+        self.assertEqual(response.code, 409)
+        self.assertEqual(agent.log.entries[0].prepare.to_json(), chosen.to_json())
+
+
+
+class TestCodecNegotiation(Base):
+
+    def test_agents_answer_in_the_format_they_were_sent(self):
+        prepare = self.get_prepare()
+        response = self.fetch('/prepare', method='POST',
+                              body=BINARY.encode(prepare),
+                              headers={'Content-Type': BINARY.content_type})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], BINARY.content_type)
+        self.assertEqual(Promise.from_response(response).to_json(),
+                         Promise().to_json())
 
 
 class TestLearner(Base):
@@ -329,5 +2061,72 @@ class TestLearner(Base):
                          self.get_prepare().to_json())
 
 
+class TestSimulator(unittest.TestCase):
+
+    def run_once(self, seed, **network):
+        return simulator.Simulation(agents=3, seed=seed, **network).execute(
+            writes=40, clients=4, keys=5)
+
+    def test_runs_are_reproducible(self):
+        first = self.run_once(7, jitter=0.001, reorder=0.1)
+        self.assertEqual(first, self.run_once(7, jitter=0.001, reorder=0.1))
+        self.assertNotEqual(first, self.run_once(8, jitter=0.001, reorder=0.1))
+
+    def test_agents_agree_on_every_slot(self):
+        report = self.run_once(3, jitter=0.001)
+        self.assertEqual(report['commits'], 40)
+        self.assertEqual(report['failures'], {})
+        self.assertEqual(report['diverged_slots'], 0)
+        self.assertEqual(report['applied_twice'], 0)
+        self.assertLessEqual({'/prepare', '/propose', '/learn'}, set(report['messages_per_commit']))
+
+    def test_counts_diverged_batches(self):
+        simulation = simulator.Simulation(agents=2)
+        for node, argument in zip(simulation.network.nodes.values(), ([1], [2])):
+            node.agent.log.entries[0] = Learn(prepare=Prepare(
+                key='k', predicate='batch', argument=[{'predicate': 'incr', 'argument': argument}], slot=0))
+            node.agent.log.entries[1] = Learn(prepare=Prepare(
+                key='k', predicate='fast', argument=[{'id': 1, 'predicate': 'incr'}], slot=1))
+        self.assertEqual(simulation.diverged(), 1)
+
+    def test_contended_slots_apply_every_write_once(self):
+        simulation = simulator.Simulation(agents=3, seed=5, jitter=0.002)
+        report = simulation.execute(writes=60, clients=6, keys=2, incr_ratio=1.0)
+        self.assertEqual(report['commits'], 60)
+        self.assertEqual(report['applied_twice'], 0)
+        for node in simulation.network.nodes.values():
+            self.assertEqual(sum(node.applied().values()), 60)
+
+    def assert_applied_once(self, seeds, **options):
+        for seed in seeds:
+            report = simulator.Simulation(agents=3, seed=seed, **options).execute(
+                writes=300, incr_ratio=0.5)
+            self.assertEqual(report['applied_twice'], 0, seed)
+            self.assertEqual(report['diverged_slots'], 0, seed)
+
+    def test_lossy_reordering_runs_apply_every_write_once(self):
+        # Seeds that once chose a retried write in a second slot.
+        self.assert_applied_once([1, 11], latency=0.001, loss=0.1, reorder=0.3)
+
+    def test_lossy_reordering_leaders_apply_every_write_once(self):
+        self.assert_applied_once([1, 4], multi_paxos=True, latency=0.001, loss=0.05, reorder=0.2)
+
+    def test_routes_keys_like_the_client(self):
+        simulation = simulator.Simulation(agents=3)
+        router = Router(simulator.URL, simulation.ports)
+        for key in ('key-{}'.format(i) for i in range(20)):
+            self.assertTrue(router.route(key)[0].endswith(str(simulation.route(key))))
+
+    def test_partitioned_messages_are_lost(self):
+        network = simulator.Network(random.Random(1))
+        network.partition([7000])
+        self.assertFalse(network.reachable(7000, 7001))
+        self.assertTrue(network.reachable(7001, 7002))
+        self.assertFalse(network.dropped(None, 7000, '/write'))
+        self.assertTrue(network.dropped(7001, 7000, '/prepare'))
+        network.heal()
+        self.assertTrue(network.reachable(7000, 7001))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,229 @@
+"""
+A persistent, multiplexed transport for agent-to-agent traffic. Each agent
+keeps one framed TCP stream open to every peer, and tags each request with an
+ID so any number of Prepare/Accept/Learn messages can be in flight on it at
+once. Clients keep talking HTTP.
+
+A frame is a `FRAME` header followed by the endpoint (requests only) and the
+body. Requests carry a code of 0; responses carry the HTTP status. The body's
+content type is sent as an index into `CONTENT_TYPES`.
+"""
+import logging
+import struct
+import time
+from urllib.parse import urlparse
+
+import tornado.concurrent
+import tornado.gen
+import tornado.httputil
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.tcpclient
+import tornado.tcpserver
+
+logger = logging.getLogger('agent')
+
+# request id, code, content type, endpoint length, body length
+FRAME = struct.Struct('>IHBHI')
+CONTENT_TYPES = ['application/json', 'application/x-paxos']
+MIN_BACKOFF = 0.05
+MAX_BACKOFF = 5.0
+REQUEST_TIMEOUT = 5.0
+
+
+def pack_frame(request_id, code, content_type, endpoint, body):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    content_type = CONTENT_TYPES.index(content_type)
+    return FRAME.pack(request_id, code, content_type, len(endpoint),
+                      len(body)) + endpoint + body
+
+
+@tornado.gen.coroutine
+def read_frame(stream):
+    header = yield stream.read_bytes(FRAME.size)
+    request_id, code, content_type, endpoint_length, body_length = FRAME.unpack(header)
+    endpoint = b''
+    if endpoint_length:
+        endpoint = yield stream.read_bytes(endpoint_length)
+    body = b''
+    if body_length:
+        body = yield stream.read_bytes(body_length)
+    raise tornado.gen.Return(
+        (request_id, code, CONTENT_TYPES[content_type], endpoint, body))
+
+
+class PeerResponse:
+    """
+    Quacks enough like `tornado.httpclient.HTTPResponse` for the phases.
+    """
+
+    def __init__(self, code, content_type, body):
+        self.code = code
+        self.headers = {'Content-Type': content_type}
+        self.body = body
+
+
+class PeerConnection:
+    """
+    The client end of a stream to one peer. Connects lazily, and after a
+    failure waits out an exponential backoff before trying again. Requests
+    made while backing off fail straight away, and a request the peer hasn't
+    answered by its deadline fails with `tornado.gen.TimeoutError`.
+
+    `pending` holds the unanswered requests by stream, so a stream that
+    drops fails only those sent on it and not those on its replacement.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.stream = None
+        self.pending = {} # stream -> {request id: future}
+        self.next_id = 0
+        self.backoff = MIN_BACKOFF
+        self.retry_at = 0
+        self.connecting = tornado.locks.Lock()
+
+    @classmethod
+    def to(cls, url, port):
+        return cls(urlparse(url).hostname, port)
+
+    @tornado.gen.coroutine
+    def connect(self):
+        with (yield self.connecting.acquire()):
+            if self.stream is not None and not self.stream.closed():
+                raise tornado.gen.Return(self.stream)
+            if time.time() < self.retry_at:
+                raise tornado.iostream.StreamClosedError()
+            try:
+                stream = yield tornado.tcpclient.TCPClient().connect(self.host, self.port)
+            except Exception:
+                self.retry_at = time.time() + self.backoff
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+                logger.warning("Can't reach peer %s:%s. Retrying in %.2fs",
+                               self.host, self.port, self.retry_at - time.time())
+                raise
+            stream.set_nodelay(True)
+            self.stream = stream
+            self.backoff = MIN_BACKOFF
+            tornado.ioloop.IOLoop.current().spawn_callback(self.read, stream)
+            raise tornado.gen.Return(stream)
+
+    @tornado.gen.coroutine
+    def read(self, stream):
+        try:
+            while True:
+                request_id, code, content_type, _, body = yield read_frame(stream)
+                future = self.pending.get(stream, {}).pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(PeerResponse(code, content_type, body))
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.closed(stream)
+
+    def closed(self, stream):
+        if stream is self.stream:
+            self.stream = None
+        for future in self.pending.pop(stream, {}).values():
+            if not future.done():
+                future.set_exception(tornado.iostream.StreamClosedError())
+
+    @tornado.gen.coroutine
+    def fetch(self, endpoint, body, content_type=CONTENT_TYPES[0], timeout=REQUEST_TIMEOUT):
+        stream = yield self.connect()
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) % 2 ** 32
+        future = tornado.concurrent.Future()
+        pending = self.pending.setdefault(stream, {})
+        pending[request_id] = future
+        try:
+            stream.write(pack_frame(request_id, 0, content_type,
+                                    endpoint.encode('utf-8'), body))
+        except tornado.iostream.StreamClosedError:
+            self.closed(stream)
+            raise
+        try:
+            response = yield tornado.gen.with_timeout(
+                tornado.ioloop.IOLoop.current().time() + timeout, future)
+        except tornado.gen.TimeoutError:
+            pending.pop(request_id, None) # A late reply is dropped.
+            if not pending and self.pending.get(stream) is pending:
+                del self.pending[stream]
+            raise
+        raise tornado.gen.Return(response)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+
+class FrameConnection:
+    """
+    Stands in for the HTTP connection under a `RequestHandler`, so frames can
+    be served by the same handlers as HTTP requests. Whatever the handler
+    writes is collected and sent back as one response frame.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.code = 200
+        self.content_type = CONTENT_TYPES[0]
+        self.chunks = []
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None):
+        self.code = start_line.code
+        content_type = headers.get('Content-Type', '').split(';')[0]
+        if content_type in CONTENT_TYPES:
+            self.content_type = content_type
+        return self.write(chunk)
+
+    def write(self, chunk, callback=None):
+        if chunk:
+            self.chunks.append(chunk)
+        future = tornado.concurrent.Future()
+        future.set_result(None)
+        return future
+
+    def finish(self):
+        self.respond(self.code, self.content_type, b''.join(self.chunks))
+
+
+class PeerServer(tornado.tcpserver.TCPServer):
+    """
+    Serves frames from peers by dispatching them to `application`.
+    """
+
+    def __init__(self, application, **kwargs):
+        super(PeerServer, self).__init__(**kwargs)
+        self.application = application
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        stream.set_nodelay(True)
+        try:
+            while True:
+                request_id, _, content_type, endpoint, body = yield read_frame(stream)
+                self.dispatch(stream, request_id, content_type,
+                              endpoint.decode('utf-8'), body)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def dispatch(self, stream, request_id, content_type, endpoint, body):
+        def respond(code, response_type, response_body):
+            if not stream.closed():
+                stream.write(pack_frame(request_id, code, response_type, b'',
+                                        response_body))
+
+        request = tornado.httputil.HTTPServerRequest(
+            method='POST',
+            uri=endpoint,
+            headers=tornado.httputil.HTTPHeaders({'Content-Type': content_type}),
+            body=body,
+            connection=FrameConnection(respond))
+        self.application(request)
@@ -0,0 +1,59 @@
+import collections
+import itertools
+import json
+
+import tornado.locks
+
+from slot_log import NOOP_PREDICATE
+
+
+class Feed:
+    """
+    A shared fan-out buffer for `/watch`. Each applied slot is serialized
+    once, when it is applied, and every subscriber writes out the same line.
+    The buffer holds the last `size` slots; a subscriber that falls further
+    behind reads from the log instead. Writes that `kv` skipped as copies of
+    earlier ones are left out, as they are from `/read`.
+    """
+
+    def __init__(self, log, size, kv):
+        self.log = log
+        self.kv = kv
+        self.lines = collections.deque(maxlen=size)
+        self.changed = tornado.locks.Condition()
+        self.watchers = 0
+        log.appliers.append(self.applied)
+
+    def clear(self):
+        self.lines.clear()
+
+    def applied(self, learn):
+        slot = self.log.apply_index
+        if self.lines and self.lines[-1][0] != slot - 1:
+            self.lines.clear() # The log jumped ahead to a snapshot.
+        self.lines.append((slot, line_for(self.kv.without_copies(learn, slot))))
+        self.changed.notify_all()
+
+    def since(self, slot):
+        """
+        :return: `(slot, line)` pairs for every buffered slot from `slot`
+            on, or None if the buffer doesn't reach back that far. Lines for
+            no-ops, and for slots holding only copies, are None.
+        """
+        if slot > self.log.apply_index:
+            return []
+        if not self.lines or self.lines[0][0] > slot:
+            return None
+        return list(itertools.islice(self.lines, slot - self.lines[0][0], None))
+
+    def report(self):
+        return {
+            'watchers': self.watchers,
+            'buffered': len(self.lines)
+        }
+
+
+def line_for(learn):
+    if learn is None or learn.prepare.predicate == NOOP_PREDICATE:
+        return None
+    return json.dumps(learn.to_json()) + "\n"
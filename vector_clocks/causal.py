@@ -0,0 +1,63 @@
+class HoldBack:
+    """
+    Causal broadcast delivery. `delivered` is a `VectorClock` counting the
+    messages delivered here from each node. A node's own broadcasts count as
+    delivered when it sends them.
+
+    Every broadcast carries `deps`, the sender's `delivered` right after it
+    counted the broadcast itself. So `deps[sender]` is the broadcast's
+    sequence number, and every other entry says how many messages from that
+    node have to be delivered before this one can be. A message that arrives
+    too early is parked under the first dependency it is missing, as
+    `(index, count)`: "wait until `delivered[index]` reaches `count`". Each
+    delivery looks only at the messages parked under the count it has just
+    reached. A message parked there either gets delivered or moves on to its
+    next missing dependency, so a backlog of thousands is never rescanned.
+    `pending` holds the `(index, sequence number)` of every parked message, so
+    a retried one is dropped rather than parked twice.
+    """
+
+    def __init__(self, delivered):
+        self.delivered = delivered
+        self.blocked = {}
+        self.pending = set()
+
+    def missing(self, sender, deps):
+        """
+        :return: The first `(index, count)` that `deps` needs and we haven't delivered, or None.
+        """
+        times = self.delivered.times
+        for i, t in enumerate(deps.times):
+            if i == sender:
+                t -= 1
+            if times[i] < t:
+                return i, t
+
+    def add(self, sender, deps, message):
+        """
+        :param sender: The sender's index.
+        :param deps: The message's `VectorClock` of dependencies.
+        :return: The messages that can be delivered now, in causal order. Each is counted as delivered.
+        """
+        seq = deps.times[sender]
+        if seq <= self.delivered.times[sender] or (sender, seq) in self.pending:
+            return [] # Delivered or held already. The sender retried it.
+        ready = []
+        self.park(sender, deps, message, ready)
+        for sender, deps, message in ready:
+            self.delivered.times[sender] = deps.times[sender]
+            self.unblock(sender, deps.times[sender], ready)
+        return [message for sender, deps, message in ready]
+
+    def park(self, sender, deps, message, ready):
+        missing = self.missing(sender, deps)
+        if missing is None:
+            ready.append((sender, deps, message))
+        else:
+            self.blocked.setdefault(missing, []).append((sender, deps, message))
+            self.pending.add((sender, deps.times[sender]))
+
+    def unblock(self, index, count, ready):
+        for sender, deps, message in self.blocked.pop((index, count), ()):
+            self.pending.discard((sender, deps.times[sender]))
+            self.park(sender, deps, message, ready)
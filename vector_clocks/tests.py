@@ -0,0 +1,196 @@
+import importlib.util
+import json
+import os
+import unittest
+
+import mock
+import tornado.concurrent
+import tornado.gen
+import tornado.httpclient
+import tornado.testing
+
+from causal import HoldBack
+from clocks import VectorClock
+
+PORTS = [8888, 8889, 8890]
+
+
+def load_server():
+    """
+    Imports `vc-server.py`, whose name isn't a valid module name.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vc-server.py')
+    spec = importlib.util.spec_from_file_location('vc_server', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+vc_server = load_server()
+
+
+def clock(*times):
+    c = VectorClock.for_ports(PORTS)
+    for i, t in enumerate(times):
+        c.times[i] = t
+    return c
+
+
+class TestVectorClock(unittest.TestCase):
+
+    def test_delta_holds_only_changed_entries(self):
+        self.assertEqual(clock(3, 1, 4).delta(clock(3, 0, 2)), [[1, 1], [2, 4]])
+        self.assertEqual(clock(1, 2, 3).delta(clock(1, 2, 3)), [])
+
+    def test_apply_rebuilds_the_clock_from_a_delta(self):
+        sent, received = clock(0, 0, 0), clock(0, 0, 0)
+        for now in (clock(1, 0, 0), clock(1, 2, 0), clock(1, 2, 5)):
+            received.apply(now.delta(sent))
+            sent = now
+            self.assertEqual(list(received.times), list(now.times))
+
+    def test_merge_takes_the_larger_entries(self):
+        c = clock(1, 5, 0)
+        c.merge(clock(2, 3, 0))
+        self.assertEqual(list(c.times), [2, 5, 0])
+
+    def test_copies_are_independent(self):
+        c = clock(1, 0, 0)
+        copy = c.copy()
+        c.increment(8889)
+        self.assertEqual(list(copy.times), [1, 0, 0])
+        self.assertEqual(c.to_json(), {8888: 1, 8889: 1, 8890: 0})
+
+
+class TestHoldBack(unittest.TestCase):
+
+    def setUp(self):
+        self.delivered = clock(0, 0, 0)
+        self.holdback = HoldBack(self.delivered)
+
+    def test_delivers_messages_that_arrive_in_order(self):
+        self.assertEqual(self.holdback.add(1, clock(0, 1, 0), 'a'), ['a'])
+        self.assertEqual(self.holdback.add(1, clock(0, 2, 0), 'b'), ['b'])
+        self.assertEqual(list(self.delivered.times), [0, 2, 0])
+
+    def test_holds_a_message_until_its_predecessor_arrives(self):
+        self.assertEqual(self.holdback.add(1, clock(0, 2, 0), 'b'), [])
+        self.assertEqual(self.holdback.add(1, clock(0, 3, 0), 'c'), [])
+        self.assertEqual(self.holdback.add(1, clock(0, 1, 0), 'a'), ['a', 'b', 'c'])
+        self.assertEqual(self.holdback.blocked, {})
+        self.assertEqual(self.holdback.pending, set())
+
+    def test_waits_for_dependencies_on_other_senders(self):
+        # 8890 sent its message after delivering 8889's first one.
+        self.assertEqual(self.holdback.add(2, clock(0, 1, 1), 'reply'), [])
+        self.assertEqual(self.holdback.add(1, clock(0, 1, 0), 'question'), ['question', 'reply'])
+
+    def test_drops_duplicates(self):
+        self.assertEqual(self.holdback.add(1, clock(0, 2, 0), 'b'), [])
+        self.assertEqual(self.holdback.add(1, clock(0, 2, 0), 'b'), [])
+        self.assertEqual(self.holdback.add(1, clock(0, 1, 0), 'a'), ['a', 'b'])
+        self.assertEqual(self.holdback.add(1, clock(0, 1, 0), 'a'), [])
+        self.assertEqual(self.holdback.add(1, clock(0, 2, 0), 'b'), [])
+
+    def test_concurrent_senders_are_delivered_independently(self):
+        self.assertEqual(self.holdback.add(2, clock(0, 0, 2), 'y'), [])
+        self.assertEqual(self.holdback.add(1, clock(0, 1, 0), 'a'), ['a'])
+        self.assertEqual(self.holdback.add(2, clock(0, 0, 1), 'x'), ['x', 'y'])
+        self.assertEqual(list(self.delivered.times), [0, 1, 2])
+
+    def test_delivers_a_shuffled_backlog_in_causal_order(self):
+        # Each node's n-th message depends on everything sent before it in `order`.
+        order = [1, 2, 1, 0, 2, 2, 1, 0]
+        sent, messages = clock(0, 0, 0), []
+        for i, sender in enumerate(order):
+            sent.times[sender] += 1
+            messages.append((sender, sent.copy(), i))
+        delivered = []
+        for sender, deps, i in reversed(messages):
+            delivered.extend(self.holdback.add(sender, deps, i))
+        self.assertEqual(delivered, list(range(len(order))))
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        del vc_server.my_list[:]
+
+    def tearDown(self):
+        del vc_server.my_list[:]
+
+    def test_dumps_the_list_with_plain_clocks(self):
+        vc_server.my_list.append({'value': 1, 'vector_clock': vc_server.frozen(vc_server.vector_clock)})
+        dumped = json.loads(json.dumps(vc_server.list_json(), indent=2))
+        self.assertEqual(dumped, [{'value': 1, 'vector_clock': {str(port): 0 for port in vc_server.ports}}])
+
+
+class TestPeers(tornado.testing.AsyncTestCase):
+
+    def message(self, value):
+        return {'value': value, 'sender': 8888, 'vector_clock': vc_server.frozen(vc_server.vector_clock),
+                'deps': vc_server.frozen(vc_server.delivered)}
+
+    def response(self, code):
+        fut = tornado.concurrent.Future()
+        fut.set_result(mock.Mock(code=code))
+        return fut
+
+    @tornado.testing.gen_test
+    def test_sends_to_every_peer_at_once(self):
+        peers = [vc_server.Peer(port) for port in (8889, 8890, 8891)]
+        answers = [tornado.concurrent.Future() for _ in peers]
+        for peer, answer in zip(peers, answers):
+            peer.client = mock.Mock(fetch=mock.Mock(return_value=answer))
+            self.io_loop.spawn_callback(peer.run)
+        with mock.patch.object(vc_server, 'peers', peers):
+            yield vc_server.fanout(self.message(1))
+        yield tornado.gen.sleep(0.01)
+        # Nobody has answered, yet every peer has its request.
+        self.assertEqual([peer.client.fetch.call_count for peer in peers], [1, 1, 1])
+        for answer in answers:
+            answer.set_result(mock.Mock(code=200))
+        yield [peer.queue.join() for peer in peers]
+
+    @tornado.testing.gen_test
+    def test_a_full_queue_holds_the_sender_back(self):
+        with mock.patch.object(vc_server, 'PEER_QUEUE_SIZE', 1):
+            peer = vc_server.Peer(8889)
+        with mock.patch.object(vc_server, 'peers', [peer]):
+            yield vc_server.fanout(self.message(1))
+            waiting = vc_server.fanout(self.message(2))
+            yield tornado.gen.sleep(0.01)
+            self.assertFalse(waiting.done())
+            first = yield peer.queue.get()
+            yield waiting
+        self.assertEqual(first['value'], 1)
+        self.assertEqual(peer.queue.qsize(), 1)
+
+    @tornado.testing.gen_test
+    def test_retries_a_failed_send_without_blocking(self):
+        peer = vc_server.Peer(8889)
+        peer.client = mock.Mock(fetch=mock.Mock(side_effect=[
+            tornado.httpclient.HTTPClientError(599), self.response(500), self.response(200)]))
+        events = []
+
+        @tornado.gen.coroutine
+        def send():
+            yield peer.send(self.message(1))
+            events.append('sent')
+
+        @tornado.gen.coroutine
+        def tick():
+            for _ in range(3):
+                events.append('tick')
+                yield tornado.gen.moment
+
+        with mock.patch.object(vc_server, 'RETRY_DELAY', 0.01):
+            yield [send(), tick()]
+        self.assertEqual(peer.client.fetch.call_count, 3)
+        self.assertEqual(len({call[1]['body'] for call in peer.client.fetch.call_args_list}), 1)
+        # The IOLoop went on with other work while the send waited to retry.
+        self.assertEqual(events, ['tick'] * 3 + ['sent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
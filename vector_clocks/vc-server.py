@@ -1,6 +1,4 @@
 import json
-import time
-import threading
 import os
 import operator
 import logging
@@ -12,73 +10,152 @@ import tornado.web
 import tornado.netutil
 import tornado.gen
 import tornado.process
-import requests
+import tornado.queues
 import collections
 from tornado.options import define, options
 
+from causal import HoldBack
+from clocks import VectorClock
+
 define("port", default=8888, help="run on the given port", type=int)
 
 logging.getLogger().setLevel(logging.DEBUG)
 my_list = []
 ports = [8888, 8889, 8890, 8891]
-vector_clock = {8888:0, 8889:0, 8890:0, 8891:0}
-
-threads = collections.deque()
+vector_clock = VectorClock.for_ports(ports)
+# How many broadcasts from each node have been delivered here, our own included.
+delivered = VectorClock.for_ports(ports)
+# Messages that arrived before something they causally depend on.
+holdback = HoldBack(delivered)
+# The last clock and deps each other node sent us, which its next message's deltas apply to.
+received = {}
+received_deps = {}
+# The link sequence number of the last message each other node sent us. Anything not newer is a late copy.
+received_seq = {}
+
+# Messages waiting to go out to each peer. An append waits for room here
+# rather than being turned away.
+PEER_QUEUE_SIZE = 1000
+# Seconds to wait before sending a message to a peer that didn't take it.
+RETRY_DELAY = 0.1
 
 def frozen(clock):
-    return {k: int(v) for k, v in clock.items()}
+    return clock.copy()
 
 
 def increment_clock():
     global vector_clock
-    vector_clock[options.port] += 1
+    vector_clock.increment(options.port)
 
 
-def send_message_sync(message, port):
+class Peer:
     """
-    Synchronously sends a message to a process listening on 0.0.0.0:[port]. If anything
-    but 200 comes back we're probably still in the process of handling events on that node.
-    In that case it's API will return 503 (Service Unavailable) and we'll try again.
-
-    :param message: A dict of the form
-        ..code-block: json
-            {
-                "sender": [port],
-                "vector_clock": <dict<port>, <timestamp>>,
-                "value": <int>
-            }
-    :param port: The port to which the message should be sent.
-    :return: Nothing.
+    Another node, and the messages we still owe it. One coroutine per peer
+    delivers them in order, so a slow or dead peer holds up nobody but
+    itself.
     """
-    url = 'http://0.0.0.0:{}/message'
-    while True:
-        try:
-            resp = requests.post(url.format(port),
-                        headers={'Content-Type': 'application/json'},
-                        data=json.dumps(message), timeout=1)
-            if resp.status_code == 200: break
-        except Exception as e:
-            print(e)
-            time.sleep(0.1)
-            continue
-
-
-def fanout_sync(message):
+
+    def __init__(self, port):
+        self.port = port
+        self.queue = tornado.queues.Queue(maxsize=PEER_QUEUE_SIZE)
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.sent = VectorClock(vector_clock.nodes)
+        self.sent_deps = VectorClock(vector_clock.nodes)
+        self.seq = 0
+
+    def encode(self, message):
+        """
+        Swaps the message's clock and deps for the entries that changed since the last ones this peer got, and
+        numbers it on this link so the peer can tell a late copy from the next message.
+        """
+        clock = message['vector_clock']
+        deps = message['deps']
+        self.seq += 1
+        encoded = {'sender': message['sender'], 'value': message['value'], 'seq': self.seq,
+                   'delta': clock.delta(self.sent), 'deps_delta': deps.delta(self.sent_deps)}
+        self.sent = clock
+        self.sent_deps = deps
+        return json.dumps(encoded)
+
+    @tornado.gen.coroutine
+    def send(self, message):
+        """
+        Sends a message to the process listening on 0.0.0.0:[port] until it comes back with a 200.
+
+        :param message: A dict of the form
+            ..code-block: json
+                {
+                    "sender": [port],
+                    "vector_clock": <VectorClock>,
+                    "deps": <VectorClock>,
+                    "value": <int>
+                }
+            It goes out as
+            ..code-block: json
+                {
+                    "sender": [port],
+                    "seq": <int>,
+                    "delta": [[<index>, <timestamp>], ...],
+                    "deps_delta": [[<index>, <count>], ...],
+                    "value": <int>
+                }
+        """
+        url = 'http://0.0.0.0:{}/message'.format(self.port)
+        body = self.encode(message)
+        while True:
+            try:
+                resp = yield self.client.fetch(url, method='POST', body=body,
+                    headers={'Content-Type': 'application/json'},
+                    request_timeout=1, raise_error=False)
+                if resp.code == 200: break
+            except Exception as e:
+                logging.warning("Sending to %s failed: %s", self.port, e)
+            yield tornado.gen.sleep(RETRY_DELAY)
+
+    @tornado.gen.coroutine
+    def run(self):
+        while True:
+            message = yield self.queue.get()
+            try:
+                yield self.send(message)
+            finally:
+                self.queue.task_done()
+
+
+peers = []
+
+
+def start_peers():
+    for port in ports:
+        if port != options.port:
+            peer = Peer(port)
+            peers.append(peer)
+            tornado.ioloop.IOLoop.current().spawn_callback(peer.run)
+
+
+@tornado.gen.coroutine
+def fanout(message):
     """
-    Synchronously issues requests to all nodes in the list of ports above. Sorry, no service discovery.
+    Queues a message for every other node. Sorry, no service discovery. Resolves once every peer's queue has
+    taken it, which is immediate unless some peer is more than `PEER_QUEUE_SIZE` messages behind.
 
     :param message: A dict of the form
         ..code-block: json
             {
                 "sender": [port],
-                "vector_clock": <dict<port>, <timestamp>>,
+                "vector_clock": <VectorClock>,
+                "deps": <VectorClock>,
                 "value": <int>
             }
     """
-    for port in ports:
-        if port == options.port:
-            continue
-        send_message_sync(message, port)
+    yield [peer.queue.put(message) for peer in peers]
+
+
+def list_json():
+    """
+    :return: `my_list` with each entry's clock as a plain dict, ready for `json.dumps`.
+    """
+    return [{'value': entry['value'], 'vector_clock': entry['vector_clock'].to_json()} for entry in my_list]
 
 
 def process_event(request):
@@ -108,15 +185,12 @@ def update_times(sender, last_knowns):
         1) For every time listed in the incoming vector, set the time in the local vector equal to the maximum of the two.
         2) Increment the sender by an extra 1, to account for transit time.
 
-    :param last_knowns:
+    :param last_knowns: The sender's `VectorClock`.
     :return: Nothing. Almost everything happens by side effect. I'm so sorry.
     """
     global vector_clock
-    last_knowns[str(sender)] += 1 # Algorithm says adjust for transit time.
-    for port, t in last_knowns.items():
-        port = int(port)
-        if int(last_knowns[str(port)]) > int(vector_clock[port]):
-            vector_clock[port] = int(last_knowns[str(port)])
+    last_knowns.increment(sender) # Algorithm says adjust for transit time.
+    vector_clock.merge(last_knowns)
 
 
 def process_message(message):
@@ -127,7 +201,7 @@ def process_message(message):
     :param message: The message send by another API node, after receiving a client facing /append.
         ..code-block:
             {
-                'vector_clock': <dict<int>, <int>> ,
+                'vector_clock': <VectorClock>,
                 'sender': <int>,
                 'value': <int>
             }
@@ -145,8 +219,9 @@ def process_message(message):
 def process_messages():
     """
     Processing one message is an "atomic action" as defined in Fidge's paper. For this we have to increment the local
-    clock by 1. This method goes through all the messages awaiting processing, and kicks off their processing. The
-    side effects are updating our local vector, and actually adding elements to the globally maintained `my_list`.
+    clock by 1. This method goes through all the delivered messages awaiting processing, which `holdback` has put in
+    causal order, and kicks off their processing. The side effects are updating our local vector, and actually adding
+    elements to the globally maintained `my_list`.
 
     :return: Nothing.
     """
@@ -159,15 +234,6 @@ def process_messages():
 
 class AppendHandler(tornado.web.RequestHandler):
 
-    def busy(self):
-        """
-        Ends a request while messages are still being sent.
-        :return:
-        """
-        self.clear()
-        self.set_status(503)
-        self.finish()
-
     def get(self):
         """
         This method returns to the user the global `my_list`. Before it does that it processes messages with
@@ -175,23 +241,20 @@ class AppendHandler(tornado.web.RequestHandler):
         :return:
         """
         process_messages()
-        self.write(json.dumps(my_list))
+        self.write(json.dumps(list_json()))
 
+    @tornado.gen.coroutine
     def post(self):
         """
-        Appends an element to the globally maintained `my_list`.
+        Appends an element to the globally maintained `my_list`, and answers once the broadcast is queued for every
+        peer.
         """
-        while threads:
-            thread = threads.popleft()
-            if thread.is_alive():
-                threads.append(thread)
-                return self.busy()
         process_messages() # Increments happen per-message.
         increment_clock() # This one is separate for the client-requested append.
         value = process_event(self.request)
-        thread = threading.Thread(target=lambda: fanout_sync({'value': value, 'sender': options.port, 'vector_clock': frozen(vector_clock)}))
-        thread.start()
-        threads.append(thread)
+        delivered.increment(options.port)
+        yield fanout({'value': value, 'sender': options.port, 'vector_clock': frozen(vector_clock),
+                      'deps': frozen(delivered)})
         self.write("OK")
 
 
@@ -199,10 +262,26 @@ class MessageHandler(tornado.web.RequestHandler):
 
     def post(self):
         """
-        Queues a message from another API for processing.
+        Hands a message from another API to `holdback`, and queues for processing whatever that lets it deliver. Its
+        clock and deps are rebuilt here, in the order the sender sent them, from the last ones we got from the same
+        sender. A copy of a message we already have, which a retry can bring in late, is dropped before its deltas
+        can wind the clocks back.
         :return:
         """
-        messages.append(json.loads(self.request.body))
+        message = json.loads(self.request.body)
+        sender = message['sender']
+        seq = message.pop('seq')
+        if seq <= received_seq.get(sender, 0):
+            logging.debug("Dropping a late copy of message %s from %s", seq, sender)
+            self.write("OK")
+            return
+        received_seq[sender] = seq
+        clock = received.setdefault(sender, VectorClock(vector_clock.nodes))
+        clock.apply(message.pop('delta'))
+        message['vector_clock'] = clock.copy()
+        deps = received_deps.setdefault(sender, VectorClock(vector_clock.nodes))
+        deps.apply(message.pop('deps_delta'))
+        messages.extend(holdback.add(vector_clock.nodes[sender], deps.copy(), message))
         self.write("OK")
 
 
@@ -218,8 +297,9 @@ if __name__ == '__main__':
         server = tornado.httpserver.HTTPServer(application)
         server.bind(options.port)
         server.start()
+        start_peers()
         tornado.ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
         process_messages()
         print("Vector Clock", vector_clock)
-        print(json.dumps(my_list, indent=2))
+        print(json.dumps(list_json(), indent=2))